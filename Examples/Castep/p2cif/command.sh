@@ -0,0 +1,19 @@
+python=$1
+shift
+params=$*
+p2cif=`cd ../../..; pwd`/p2cif
+# The files are copied so that the cif files and the scan indices are not written into the examples
+work=`mktemp -d`
+for d in MgO Na2SO42 AsparticAcid; do
+    mkdir -p $work/$d
+    cp ../$d/phonon.castep ../$d/phonon.phonon $work/$d
+done
+cd $work
+# Stream the cells to stdout, filling a cache and then reading them back from it
+$python $p2cif $params -program castep -cpus 2 -cache cache.json MgO/phonon.castep Na2SO42/phonon.castep AsparticAcid/phonon.castep
+$python $p2cif $params -program castep -cpus 2 -cache cache.json MgO/phonon.castep Na2SO42/phonon.castep AsparticAcid/phonon.castep
+# Convert a directory tree, each cif file is written next to its output file
+$python $p2cif $params -program castep -cpus 2 -dir .
+cat MgO/phonon.cif Na2SO42/phonon.cif AsparticAcid/phonon.cif
+cd /
+rm -rf $work
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Read back the xyz and dcd trajectories written by pdmodes and summarise them
+
+   The dcd file is read record by record, independently of the memory mapped layout used to write it.
+   The length before and after each Fortran record is checked, as are the number of frames and atoms in the header.
+   The largest difference between the frames of the two files is printed, followed by the equilibrium positions
+   (the first frame of every mode) and the size of the displacements of every frame_step'th frame of the dcd file.
+   The sign of a normal mode is arbitrary, so only the size of each component of a displacement is printed."""
+from __future__ import print_function
+import struct
+import sys
+import numpy as np
+
+def read_record(fd):
+    """Read a Fortran unformatted record, checking the markers either side of it"""
+    start = struct.unpack('<i', fd.read(4))[0]
+    data = fd.read(start)
+    end = struct.unpack('<i', fd.read(4))[0]
+    if start != end or len(data) != start:
+        print('Error record markers do not match', start, end, len(data))
+        exit()
+    return data
+
+def read_dcd(filename):
+    with open(filename, 'rb') as fd:
+        header = read_record(fd)
+        if header[0:4] != b'CORD':
+            print('Error not a dcd file', filename)
+            exit()
+        control = struct.unpack('<20i', header[4:84])
+        nframes = control[0]
+        has_cell = control[10]
+        titles = read_record(fd)
+        ntitles = struct.unpack('<i', titles[0:4])[0]
+        titles = [ titles[4+80*i:84+80*i].decode('ascii').strip() for i in range(ntitles) ]
+        natoms = struct.unpack('<i', read_record(fd))[0]
+        cells = []
+        frames = []
+        for frame in range(nframes):
+            if has_cell:
+                cells.append(struct.unpack('<6d', read_record(fd)))
+            xyz = [ np.frombuffer(read_record(fd), dtype='<f4') for axis in range(3) ]
+            frames.append(np.array(xyz).T)
+        if fd.read(1) != b'':
+            print('Error there is data after the last frame of', filename)
+    return titles, natoms, cells, np.array(frames)
+
+def read_xyz(filename):
+    frames = []
+    comments = []
+    with open(filename, 'r') as fd:
+        line = fd.readline()
+        while line != '':
+            natoms = int(line)
+            comments.append(fd.readline().strip())
+            frames.append( [ [ float(x) for x in fd.readline().split()[1:4] ] for i in range(natoms) ] )
+            line = fd.readline()
+    return comments, np.array(frames)
+
+def main(sys):
+    dcdfile, xyzfile, frame_step = sys.argv[1], sys.argv[2], int(sys.argv[3])
+    titles, natoms, cells, dcd_frames = read_dcd(dcdfile)
+    comments, xyz_frames = read_xyz(xyzfile)
+    print('dcd frames', len(dcd_frames), 'atoms', natoms, 'cells', len(cells))
+    for title in titles:
+        print('title', title)
+    print('xyz frames', len(xyz_frames), 'atoms', np.size(xyz_frames, 1))
+    print('first comment', comments[0])
+    print('largest difference between the xyz and dcd frames', np.max(np.abs(xyz_frames - dcd_frames)))
+    print('cell', ' '.join( '{:.6f}'.format(x) for x in cells[0] ))
+    print('largest difference between the cells', np.max(np.abs(np.array(cells) - cells[0])))
+    equilibrium = dcd_frames[0]
+    for i, position in enumerate(equilibrium):
+        print('  atom', i+1, '{:12.5f} {:12.5f} {:12.5f}'.format(*position))
+    for frame in range(0, len(dcd_frames), frame_step):
+        print('frame', frame)
+        for i, displacement in enumerate(np.abs(dcd_frames[frame] - equilibrium)):
+            print('  atom', i+1, '{:12.5f} {:12.5f} {:12.5f}'.format(*displacement))
+
+if __name__ == "__main__":
+    main(sys)
@@ -0,0 +1,7 @@
+python=$1
+shift
+params=$*
+work=`mktemp -d`
+$python ../../../pdmodes $params -program castep -mode 10 -mode 28 -xyz -dcd -outdir $work ../Na2SO42/phonon.castep
+$python checktrajectory.py $work/phonon_modes.dcd $work/phonon_modes.xyz 10
+rm -rf $work
@@ -2,3 +2,8 @@ python=$1
 shift
 params=$*
 $python ../../../preader $params -program castep -masses isotopic ../AsparticAcid/phonon.castep  ../MgO/phonon.castep  ../Na2SO42/phonon.castep 
+# Only calculate the modes in a frequency window, using the subset eigensolver
+$python ../../../preader $params -program castep -masses isotopic -window 100 600 ../AsparticAcid/phonon.castep  ../MgO/phonon.castep  ../Na2SO42/phonon.castep 
+# Block diagonalise the hessian using the symmetry of the cell, with and without a window
+$python ../../../preader $params -program castep -masses isotopic -symmetry ../AsparticAcid/phonon.castep  ../MgO/phonon.castep  ../Na2SO42/phonon.castep 
+$python ../../../preader $params -program castep -masses isotopic -symmetry -window 100 600 ../AsparticAcid/phonon.castep  ../MgO/phonon.castep  ../Na2SO42/phonon.castep 
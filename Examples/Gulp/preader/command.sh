@@ -2,3 +2,6 @@ python=$1
 shift
 params=$*
 $python ../../../preader $params -program gulp ../calcite/calcite.gout ../Na2SO42/na2so42.gout
+# Block diagonalise the hessian using the symmetry of the cell, with and without a window
+$python ../../../preader $params -program gulp -symmetry ../calcite/calcite.gout ../Na2SO42/na2so42.gout
+$python ../../../preader $params -program gulp -symmetry -window 100 500 ../calcite/calcite.gout ../Na2SO42/na2so42.gout
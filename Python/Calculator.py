@@ -26,6 +26,8 @@ from Python.Constants import PI, d2byamuang2
 import string
 
 points_on_sphere = None
+# The number of matrix elements held at once when the LO modes are calculated for many q directions
+longitudinal_modes_batch_size = 16*1024*1024
 
 def initialise_unit_tensor():
     '''Initialise a 3x3 tensor, the argument is a list of 3 real numbers for the diagonals, the returned tensor is an array'''
@@ -181,24 +183,18 @@ def ionic_permittivity(mode_list, oscillator_strengths, frequencies, volume):
        oscillator_strengths are in atomic units
        frequencies are in atomic units
        volume is in atomic units"""
-    permittivity = np.zeros((3, 3))
-    for imode in mode_list:
-        permittivity = permittivity + oscillator_strengths[imode] / (frequencies[imode] * frequencies[imode])
-    # end for
+    mode_list = np.asarray(mode_list, dtype=int)
+    frequencies = np.real(np.asarray(frequencies))[mode_list]
+    strengths = np.asarray(oscillator_strengths)[mode_list]
+    permittivity = np.einsum('mij,m->ij', strengths, 1.0 / (frequencies * frequencies))
     return permittivity * (4 * PI / volume)
 
 def infrared_intensities(oscillator_strengths):
     """Calculate the IR intensities from the trace of the oscillator strengths,
        The intensities are returned in units of (D/A)^2/amu"""
     # Each mode has a 3x3 oscillator strength
-    nmodes = np.size(oscillator_strengths, 0)
-    intensities = np.zeros(nmodes)
-    for imode, strength in enumerate(oscillator_strengths):
-        # We calculate the intensity from the trace of the strengths
-        intensities[imode] = intensities[imode] + strength[0, 0] + strength[1, 1] + strength[2, 2]
-    # end for
-    maxintensity = np.max(intensities)
-    convert = maxintensity
+    # We calculate the intensity from the trace of the strengths
+    intensities = np.einsum('mii->m', np.asarray(oscillator_strengths))
     # convert the intensities to Castep units (D/A)**2/amu
     convert = d2byamuang2
     intensities = intensities / convert
@@ -211,9 +207,9 @@ def longitudinal_modes(frequencies, normal_modes, born_charges, masses, epsilon_
        born_charges are the born charges (Z) stored as
           [Z1x Z1y Z1z] [Z2x Z2y Z2z] [Z3x Z3y Z3z]]
           where 1, 2, 3 are the directions of the field and x, y, z are the coordinates of the atom
-       qlist is a list of direction vectors
-       The subroutine returns a list of (real) frequencies in atomic units
-       Any imaginary frequencies are set to 0
+       qlist is a list of direction vectors, all the directions are diagonalised together as a stack of matrices
+       The subroutine returns a list of (real) frequencies in atomic units for each direction
+       Any imaginary frequencies are returned as negative frequencies
        If projection was requested in the reader, the correction is modified ensure translational invariance"""
     # Use a sqrt that returns a complex number
     # from numpy.lib.scimath import sqrt
@@ -222,74 +218,42 @@ def longitudinal_modes(frequencies, normal_modes, born_charges, masses, epsilon_
     # and U is a hermitian matrix so U-1 = UT
     # D = (UT)-1 f^2 U-1 = U f UT
     # Construct UT from the normal modes
+    # Each row of UT is a mode, flattened to [x1, y1, z1, x2, y2, z2, ...]
     n = np.size(normal_modes, 0)
     m = np.size(normal_modes, 1)*3
-    UT = np.zeros((n, m))
-    for imode, mode in enumerate(normal_modes):
-        n = 0
-        for atom in mode:
-            # in python the first index is the row of the matrix, the second is the column
-            UT[imode, n+0] = atom[0]
-            UT[imode, n+1] = atom[1]
-            UT[imode, n+2] = atom[2]
-            n = n + 3
-        # end for atom
-    # end for imode
-    # zero the nonanalytical correction
-    Wm = np.zeros((n, n))
+    UT = np.reshape(np.asarray(normal_modes, dtype=float), (n, m))
     # convert the frequencies^2 to a real diagonal array
     # Warning we have to make sure the sign is correct here
-    f2 = np.diag(np.sign(frequencies)*np.real(frequencies*frequencies))
-    Dm = np.dot(np.dot(UT.T, f2), UT)
+    frequencies = np.asarray(frequencies)
+    f2 = np.sign(frequencies)*np.real(frequencies*frequencies)
+    Dm = np.dot(UT.T * f2, UT)
     # Make sure the dynamical matrix is real
     Dm = np.real(Dm)
-    # Find its eigenvalues
-    eig_val, eig_vec = np.linalg.eigh(Dm)
-    # Store the results for returning to the main program
+    # Now calculate the nonanalytic part, for each q it is an outer product
+    # Wm = constant * v v^T where v_a = (q . Z_a) / sqrt(m_a)
+    # born contains the polarisability tensor [z1x z1y z1z] [z2x z2y z2z] [z3x z3y z3z]] for each atom
+    # where 1, 2, 3 are the directions of the field and x, y, z are the coordinates of the atom
+    qlist = np.reshape(np.asarray(qlist, dtype=float), (-1, 3))
+    born_charges = np.asarray(born_charges, dtype=float)
+    epsilon_inf = np.real(np.asarray(epsilon_inf))
+    constants = 4.0 * PI / (np.einsum('qi,ij,qj->q', qlist, epsilon_inf, qlist) * volume)
+    vectors = np.einsum('qi,aij->qaj', qlist, born_charges) / np.sqrt(np.asarray(masses, dtype=float))[np.newaxis, :, np.newaxis]
+    vectors = np.reshape(vectors, (len(qlist), m))
+    # If projection was requested when the matrix was read, project out translation
+    # The projection is linear, so P(Dm + Wm)P = P.Dm.P + constant * (Pv)(Pv)^T
+    if reader.eckart:
+        Dm = reader.project(Dm)
+        vectors = reader.project_vectors(vectors)
+    # Diagonalise the corrected dynamical matrices as a stack, a batch at a time to limit the memory used
+    batch = max(1, int(longitudinal_modes_batch_size / (m*m)))
     results = []
-    # Loop over q values
-    for q in qlist:
-        # Now calculate the nonanalytic part
-        constant = 4.0 * PI / (np.dot(np.dot(q, epsilon_inf), q) * volume)
-        # Loop over atom a
-        for a, za in enumerate(born_charges):
-            # atom is the atom index
-            # born contains the polarisability tensor [z1x z1y z1z] [z2x z2y z2z] [z3x z3y z3z]]
-            # where 1, 2, 3 are the directions of the field and x, y, z are the coordinates of the atom
-            za = np.dot(q, za)
-            # Loop over atom b
-            for b, zb in enumerate(born_charges):
-                zb = np.dot(q, zb)
-                terms = np.outer(za, zb) * constant / math.sqrt(masses[a]*masses[b])
-                i = a*3
-                for termi in terms:
-                    j = b*3
-                    for term in termi:
-                        Wm[i, j] = term
-                        j = j + 1
-                    # end for term
-                    i = i + 1
-                # end for i
-            # end loop over b
-        # end loop over a
-        # Construct the full dynamical matrix with the correction
-        Dmq = Dm + Wm
-        # If projection was requested when the matrix was read, project out translation
-        if reader.eckart:
-            reader.project(Dmq)
-        eig_val, eig_vec = np.linalg.eigh(Dmq)
-        # If eig_val less than zero we set it to zero
-        values = []
-        for eig in eig_val:
-            if eig >= 0:
-                val = math.sqrt(eig)
-            else:
-                val = -math.sqrt(-eig)
-            values.append(val)
-        # end of for eig
-        # Sort the eigen values in ascending order and append to the results
-        results.append(np.sort(values))
-    # end loop over q
+    for start in range(0, len(qlist), batch):
+        v = vectors[start:start+batch]
+        Dmq = Dm[np.newaxis, :, :] + constants[start:start+batch, np.newaxis, np.newaxis] * v[:, :, np.newaxis] * v[:, np.newaxis, :]
+        eig_val = np.linalg.eigvalsh(Dmq)
+        # Negative eigenvalues are returned as negative frequencies
+        # The eigenvalues are returned in ascending order
+        results.extend( np.sign(eig_val) * np.sqrt(np.abs(eig_val)) )
     return results
 
 def oscillator_strengths(normal_modes, born_charges):
@@ -297,39 +261,36 @@ def oscillator_strengths(normal_modes, born_charges):
        normal_modes are in the mass weighted coordinate system and normalised
        born charges are in electrons, so atomic units"""
     # Each mode has a 3x3 oscillator strength
-    nmodes = np.size(normal_modes, 0)
-    oscillator_strengths = np.zeros((nmodes, 3, 3))
-    for imode, mode in enumerate(normal_modes):
-        # We calculate the dipole induced by displacement of each atom along the normal mode
-        z_imode = np.zeros(3)
-        for atom, born in enumerate(born_charges):
-            # atom is the atom index
-            # born contains the polarisability tensor [a1x a1y a1z] [a2x a2y a2z] [a3x a3y a3z]]
-            # where 1, 2, 3 are the directions of the field and x, y, z are the coordinates of the atom
-            z_imode = z_imode + np.dot(born, mode[atom])  # the displacement is an array [x, y, z]
-        # end for
-        # The oscillator strength matrix is the outer product of z
-        oscillator_strengths[imode] = np.outer(z_imode, z_imode)
-    # end for
+    # We calculate the dipole induced by displacement of each atom along the normal mode
+    # born contains the polarisability tensor [a1x a1y a1z] [a2x a2y a2z] [a3x a3y a3z]] for each atom
+    # where 1, 2, 3 are the directions of the field and x, y, z are the coordinates of the atom
+    z = np.einsum('mai,aji->mj', np.asarray(normal_modes, dtype=float), np.asarray(born_charges, dtype=float))
+    # The oscillator strength matrix is the outer product of z
+    oscillator_strengths = np.einsum('mi,mj->mij', z, z)
     return oscillator_strengths
 
+def infrared_properties(normal_modes, born_charges, frequencies, volume, mode_list=None, minimum_frequency=0.0, minimum_intensity=0.0):
+    """Calculate the oscillator strengths, the infrared intensities and the ionic permittivity in one call
+       normal_modes are in xyz coordinates (nmodes, nions, 3), born charges are in electrons, so atomic units
+       frequencies and volume are in atomic units
+       mode_list is a list of the modes which contribute to the ionic permittivity, if it is not given
+       the modes with a frequency above minimum_frequency (au) and an intensity above minimum_intensity are used
+       The oscillator strengths (au), intensities ((D/A)^2/amu), ionic permittivity and the mode_list are returned"""
+    strengths = oscillator_strengths(normal_modes, born_charges)
+    intensities = infrared_intensities(strengths)
+    if mode_list is None:
+        selected = (np.real(np.asarray(frequencies)) > minimum_frequency) & (intensities > minimum_intensity)
+        mode_list = np.nonzero(selected)[0].tolist()
+    permittivity = ionic_permittivity(mode_list, strengths, frequencies, volume)
+    return strengths, intensities, permittivity, mode_list
+
 def normal_modes(masses, mass_weighted_normal_modes):
     """ Transform from mass weighted coordinates to xyz. Note this returns an array object.
         The returned normal modes have NOT been renormalised.
         The input masses are in atomic units
         the output normal modes are in atomic units """
-    list_m = []
-    normal_modes = np.zeros_like(mass_weighted_normal_modes)
-    nions = np.size(masses)
-    for a in range(nions):
-        x = 1.0 / math.sqrt(masses[a])
-        atom = [x, x, x]
-        list_m.append(atom)
-    # end of loop of ions
-    array_m = np.array(list_m)
-    for index, mode in enumerate(mass_weighted_normal_modes):
-        normal_modes[index] = mode * array_m
-    return normal_modes
+    array_m = 1.0 / np.sqrt(np.asarray(masses, dtype=float))
+    return np.asarray(mass_weighted_normal_modes, dtype=float) * array_m[np.newaxis, :, np.newaxis]
 
 def project_field(shape, shape_data, projection, efield):
     """Take the field directions in efield and apply shape projection."""
@@ -1362,57 +1323,87 @@ def construct_projection_operator(atoms, xyzs, masses, nats):
        ps[5,i*3+z] = 0.0
    return ps
    
+def degenerate_groups(frequencies, tolerance):
+   '''Group the modes into sets of degenerate frequencies
+      The frequencies are sorted once and neighbours which differ by less than tolerance are put in the same group
+      Returned are
+        order   the indices of the modes sorted by frequency, the modes of each group are together
+        starts  the position in order of the first mode of each group, suitable for np.add.reduceat
+        groups  the group of each mode'''
+   frequencies = np.real(np.asarray(frequencies))
+   order = np.argsort(frequencies, kind='stable')
+   if len(order) == 0:
+       return order, np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+   breaks = np.diff(frequencies[order]) >= tolerance
+   starts = np.concatenate( ( [0], np.nonzero(breaks)[0] + 1 ) )
+   groups = np.empty(len(order), dtype=int)
+   groups[order] = np.concatenate( ( [0], np.cumsum(breaks) ) )
+   return order, starts, groups
+
+def degenerate_average(values, order, starts, groups):
+   '''Average values (the first index is the mode) over each group of degenerate modes
+      order, starts and groups are returned by degenerate_groups()
+      The average of its group is returned for every mode'''
+   values = np.asarray(values)
+   sizes = np.diff(np.append(starts, len(order)))
+   sums = np.add.reduceat(values[order], starts, axis=0)
+   averages = sums / np.reshape(sizes, (-1,) + (1,)*(values.ndim-1))
+   return averages[groups]
+
 def calculate_energy_distribution(cell, frequencies, normal_modes, debug=False):
    '''Calculate energy distribution in the phonon modes
       frequencies are the frequencies in cm-1
-      normal_modes are the mass weighted normal modes'''
+      normal_modes are the mass weighted normal modes
+      All the modes are projected onto the translations and rotations of every molecule at once
+      The projections onto the rigid body motions of each molecule are sums over its atoms,
+      so the atoms are gathered molecule by molecule and the sums are performed with np.add.reduceat
+      The rotations of a molecule are not orthogonal to each other, their overlap is the inertia tensor,
+      so the rotational energy is c.I^-1.c where c are the projections onto the three rotations
+      Returned are the total energy of each mode (nmodes) and the translational, rotational,
+      vibrational and total energies of each molecule in each mode (nmodes, nmolecules)'''
    molecules = cell.molecules
-   atomic_masses = cell.atomic_masses
-   centres_of_mass = cell.centres_of_mass
-   xyz = cell.xyz_coordinates
+   masses = np.array(cell.atomic_masses, dtype=float)
+   xyz = np.array(cell.xyz_coordinates, dtype=float)
    nats = len(xyz)
-   # Calculate the projections operators for each molecule
-   molecular_projection_operators = []
-   molecule_masks = []
-   for atoms in molecules:
-       mol_xyzs  = [ xyz[atom] for atom in atoms]
-       mol_mask = np.zeros(nats*3)
-       for atom in atoms:
-           mol_mask[3*atom+0] = 1
-           mol_mask[3*atom+1] = 1
-           mol_mask[3*atom+2] = 1
-       mol_masses = [ atomic_masses[atom] for atom in atoms]
-       projection_operators = construct_projection_operator(atoms,mol_xyzs,mol_masses,nats)
-       projection_operators = orthogonalise_projection_operator(projection_operators)
-       molecular_projection_operators.append(projection_operators)
-       # 
-       molecule_masks.append(mol_mask) 
-   # Calculate the contributions to the kinetic energy in each mode
-   energies_in_modes = []
-   for imode,mode in enumerate(normal_modes):
-       energies_in_molecules = []
-       mode_cm = mode
-       centre_of_mass_energy = 0.0
-       rotational_energy = 0.0
-       molecular_energies = []
-       for imol,(ps,mask) in enumerate(zip(molecular_projection_operators,molecule_masks)):
-           # Calculate total kinetic energy
-           total_energy = np.dot(mode,mode)
-           # Project out centre of mass motion of each molecule
-           mode_cm = mode - np.dot(mode,ps[0])*ps[0] - np.dot(mode,ps[1])*ps[1] - np.dot(mode,ps[2])*ps[2]
-           centre_of_mass_energy += total_energy - np.dot(mode_cm,mode_cm)
-           # Project out molecular rotation of each molecule
-           mode_cm = mode - np.dot(mode,ps[3])*ps[3] - np.dot(mode,ps[4])*ps[4] - np.dot(mode,ps[5])*ps[5]
-           rotational_energy += total_energy - np.dot(mode_cm,mode_cm)
-           # Now work out the energy of the molecule
-           mode_cm = mask * mode
-           mol_energy = np.dot(mode_cm,mode_cm)
-           molecular_energies.append(mol_energy)
-       # end for imol,ps
-       vibrational_energy = total_energy - centre_of_mass_energy - rotational_energy
-       energies_in_modes.append( (total_energy,centre_of_mass_energy,rotational_energy,vibrational_energy,molecular_energies) )
-   # end for mode in normal modes
-   return energies_in_modes
+   modes = np.reshape(np.asarray(normal_modes, dtype=float), (-1, nats, 3))
+   nmodes = len(modes)
+   nmols = len(molecules)
+   total = np.sum(modes*modes, axis=(1, 2))
+   if nmols == 0:
+       empty = np.zeros( (nmodes, 0) )
+       return total, empty, empty, empty, empty
+   # Gather the atoms molecule by molecule
+   lengths = [ len(atoms) for atoms in molecules ]
+   order = np.concatenate( [ np.asarray(atoms, dtype=int) for atoms in molecules ] )
+   starts = np.concatenate( ( [0], np.cumsum(lengths)[:-1] ) )
+   owner = np.repeat(np.arange(nmols), lengths)
+   mass = masses[order]
+   sqrt_mass = np.sqrt(mass)
+   u = modes[:, order, :]
+   # Mass weighted coordinates relative to the centre of mass of each molecule
+   molecular_mass = np.add.reduceat(mass, starts)
+   centres_of_mass = np.add.reduceat(mass[:, np.newaxis]*xyz[order], starts, axis=0) / molecular_mass[:, np.newaxis]
+   relxyz = sqrt_mass[:, np.newaxis] * (xyz[order] - centres_of_mass[owner])
+   # Translations, the projection operators are sqrt(m) along x, y and z
+   t = np.add.reduceat(sqrt_mass[np.newaxis, :, np.newaxis]*u, starts, axis=1)
+   translational_energy = np.sum(t*t, axis=2) / molecular_mass[np.newaxis, :]
+   # Rotations, the projection operator about axis k is e_k x relxyz and u.(e_k x relxyz) = (relxyz x u)_k
+   c = np.add.reduceat(np.cross(relxyz[np.newaxis, :, :], u), starts, axis=1)
+   r2 = np.sum(relxyz*relxyz, axis=1)
+   inertia = np.add.reduceat(r2[:, np.newaxis, np.newaxis]*np.eye(3) - relxyz[:, :, np.newaxis]*relxyz[:, np.newaxis, :], starts, axis=0)
+   eig_val, eig_vec = np.linalg.eigh(inertia)
+   # Ignore rotations which do not move any atoms (single atoms and the axis of a linear molecule)
+   largest = np.max(eig_val, axis=1, keepdims=True)
+   rotating = (eig_val > 1.0E-8*largest) & (eig_val > 1.0E-12)
+   inverse = np.where(rotating, 1.0 / np.where(rotating, eig_val, 1.0), 0.0)
+   c = np.einsum('nmk,mkl->nml', c, eig_vec)
+   rotational_energy = np.sum(c*c*inverse[np.newaxis, :, :], axis=2)
+   # The energy of each molecule
+   molecular_energy = np.add.reduceat(np.sum(u*u, axis=2), starts, axis=1)
+   vibrational_energy = molecular_energy - translational_energy - rotational_energy
+   if debug:
+       print('Energy distribution: total, translational, rotational', np.sum(total), np.sum(translational_energy), np.sum(rotational_energy))
+   return total, translational_energy, rotational_energy, vibrational_energy, molecular_energy
 # end def
 
 
@@ -111,17 +111,11 @@ class CastepOutputReader(GenericOutputReader):
             # end for ion
             normal_modes.append(a)
         # end for imode
-        self.frequencies = []
-        self._intensities = []
-        self.mass_weighted_normal_modes = []
         # now reads all frequencies imaginary or not
         # imaginary frequencies are indicated by real negative values
-        for i, freq in enumerate(frequencies):
-            self.frequencies.append(freq)
-            self._intensities.append(intensities[i])
-            self.mass_weighted_normal_modes.append(normal_modes[i])
-            # end of if freq
-        # end of for freq
+        self.frequencies = frequencies
+        self._intensities = intensities
+        self.mass_weighted_normal_modes = np.array(normal_modes, dtype=float)
         return
 
     def _read_kpoint_grid(self, line):
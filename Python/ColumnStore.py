@@ -0,0 +1,91 @@
+#!/usr/bin/python
+#
+# Copyright 2015 John Kendrick
+#
+# This file is part of PDielec
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the MIT License
+# along with this program, if not see https://opensource.org/licenses/MIT
+#
+"""Store batches of results as typed columns in a .npz file
+
+   Each record is a dictionary and every record in a store has the same keys.
+   Scalars and fixed shape arrays are stored as one array per key, with the record as the first index.
+   Ragged lists (such as the frequencies) are stored as a flat array together with an offsets array,
+   the values of record i being flat[offsets[i]:offsets[i+1]].
+   Batches are appended to the .npz file as they become available, without rewriting the earlier batches.
+   read_column_store() joins the batches back into a single set of columns."""
+from __future__ import print_function
+import zipfile
+import numpy as np
+
+
+def append_batch(filename, records, ragged):
+    """Append a batch of records to the column store in filename
+       records is a list of dictionaries, each with the same keys
+       ragged  is a list of the keys whose values are lists of varying length
+       The store is created if it does not exist"""
+    if len(records) == 0:
+        return
+    columns = {}
+    for key in records[0]:
+        if key in ragged:
+            lengths = [ len(record[key]) for record in records ]
+            columns[key+'_offsets'] = np.concatenate( ( [0], np.cumsum(lengths) ) ).astype(np.int64)
+            flat = [ value for record in records for value in record[key] ]
+            if len(flat) > 0:
+                columns[key] = np.array(flat)
+            else:
+                columns[key] = np.zeros(0)
+        else:
+            columns[key] = np.array( [ record[key] for record in records ] )
+    with zipfile.ZipFile(filename, mode='a', compression=zipfile.ZIP_DEFLATED) as store:
+        batch = 'batch{:06d}'.format(len(_batch_names(store)))
+        for key, column in columns.items():
+            with store.open(batch+'/'+key+'.npy', mode='w') as fd:
+                np.lib.format.write_array(fd, column, allow_pickle=False)
+    return
+
+
+def read_column_store(filename):
+    """Read all the batches in a column store and return a dictionary of columns
+       The offsets of the ragged columns are adjusted so that they index the joined flat arrays
+       An empty ragged column in a batch is stored as a float array of length zero and is ignored when joining"""
+    with zipfile.ZipFile(filename, mode='r') as store:
+        batches = _batch_names(store)
+        keys = sorted(set(name.split('/')[1][:-4] for name in store.namelist()))
+        columns = { key:[] for key in keys }
+        for batch in batches:
+            for key in keys:
+                with store.open(batch+'/'+key+'.npy') as fd:
+                    columns[key].append(np.lib.format.read_array(fd, allow_pickle=False))
+    results = {}
+    for key in keys:
+        if key.endswith('_offsets'):
+            # Shift the offsets of each batch by the total length of the earlier batches
+            shift = 0
+            offsets = [ np.zeros(1, dtype=np.int64) ]
+            for column in columns[key]:
+                offsets.append(column[1:] + shift)
+                shift = shift + column[-1]
+            results[key] = np.concatenate(offsets)
+        else:
+            # A batch with an empty ragged column does not know the shape or type of the values,
+            # so the empty pieces are left out unless every batch is empty
+            pieces = [ column for column in columns[key] if len(column) > 0 ]
+            if len(pieces) == 0:
+                pieces = columns[key][0:1]
+            results[key] = np.concatenate(pieces)
+    return results
+
+
+def _batch_names(store):
+    """The names of the batches already in the store, in the order they were written"""
+    return sorted(set(name.split('/')[0] for name in store.namelist()))
@@ -189,14 +189,10 @@ class CrystalOutputReader(GenericOutputReader):
                     self.mass_weighted_normal_modes.append(a)
                 self.file_descriptor.readline()
             # end of if n >= 6
-        for i, mode in enumerate(self.mass_weighted_normal_modes):
-            marray = np.array(mode)
-            sumxyz = 0.0
-            for atoms in marray:
-                for xyz in atoms:
-                    sumxyz = sumxyz + xyz*xyz
-            marray = marray / np.sqrt(sumxyz)
-            self.mass_weighted_normal_modes[i] = marray.tolist()
+        # Normalise each mode
+        modes = np.array(self.mass_weighted_normal_modes, dtype=float)
+        norms = np.sqrt(np.sum(modes*modes, axis=(1, 2)))
+        self.mass_weighted_normal_modes = modes / norms[:, np.newaxis, np.newaxis]
         return
 
     def _read_born_charges(self, line):
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+#
+# Copyright 2015 John Kendrick
+#
+# This file is part of PDielec
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the MIT License
+# along with this program, if not see https://opensource.org/licenses/MIT
+#
+
+"""Project the rigid body motions out of a mass weighted hessian"""
+
+from __future__ import print_function
+import numpy as np
+from Python.Calculator import construct_projection_operator
+
+
+class EckartProjector:
+    """Project translations (and optionally rotations) out of a mass weighted hessian
+
+       The projection P.H.P with P = I - B^T.B is applied as a low rank update,
+       where the rows of B are the orthonormal rigid body vectors.
+       This costs O(N^2) rather than the O(N^3) of forming and multiplying the dense projectors.
+       The basis is cached and only recalculated when the masses (or coordinates) change."""
+    def __init__(self, rotations=False):
+        # If true the three rotations are projected out as well as the three translations
+        # This is only appropriate for molecules, not for periodic systems
+        self.rotations = rotations
+        self._key = None
+        self._basis = None
+
+    def basis(self, masses, xyzs=None):
+        """Return the orthonormal rigid body vectors as the rows of an array
+           masses are the atomic masses
+           xyzs are the cartesian coordinates, which are only needed if rotations are projected"""
+        masses = np.asarray(masses, dtype=float)
+        key = (self.rotations, masses.tobytes())
+        if self.rotations:
+            xyzs = np.asarray(xyzs, dtype=float)
+            key = key + (xyzs.tobytes(),)
+        if key == self._key:
+            return self._basis
+        nions = len(masses)
+        if self.rotations:
+            ps = construct_projection_operator(range(nions), xyzs, masses, nions)
+        else:
+            ps = construct_projection_operator(range(nions), np.zeros((nions, 3)), masses, nions)[0:3]
+        # Orthonormalise, dropping any vectors which are linearly dependent (eg rotations of a linear molecule)
+        u, s, vt = np.linalg.svd(ps, full_matrices=False)
+        self._basis = vt[s > 1.0E-8*s[0]]
+        self._key = key
+        return self._basis
+
+    def project_vectors(self, vectors, masses, xyzs=None):
+        """Return the vectors (the rows of an array) with the rigid body motions projected out"""
+        b = self.basis(masses, xyzs)
+        return vectors - np.dot(np.dot(vectors, b.T), b)
+
+    def project(self, hessian, masses, xyzs=None):
+        """Return P.hessian.P, where P projects out the rigid body motions"""
+        b = self.basis(masses, xyzs)
+        hb = np.dot(hessian, b.T)
+        bh = np.dot(b, hessian)
+        bhb = np.dot(bh, b.T)
+        return hessian - np.dot(hb, b) - np.dot(b.T, bh) + np.dot(np.dot(b.T, bhb), b)
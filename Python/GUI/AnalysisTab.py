@@ -1,4 +1,3 @@
-import math
 import numpy as np
 import Python.Calculator as Calculator
 from PyQt5.QtWidgets  import  QWidget, QApplication
@@ -347,43 +346,20 @@ class AnalysisTab(QWidget):
         normal_modes = Calculator.normal_modes(atom_masses, mass_weighted_normal_modes)
         # Reorder the atoms so that the mass weighted normal modes order agrees with the ordering in the cell_of_molecules cell
         nmodes,nions,temp = np.shape(normal_modes)
-        self.new_normal_modes = np.zeros( (nmodes,3*nions) )
-        self.new_mass_weighted_normal_modes = np.zeros( (nmodes,3*nions) )
-        masses = self.cell_of_molecules.atomic_masses
-        for imode,mode in enumerate(mass_weighted_normal_modes):
-            for index,old_index in enumerate(self.original_atomic_order):
-                i = index*3
-                j = old_index*3
-                self.new_mass_weighted_normal_modes[imode,i+0] = mode[old_index][0] 
-                self.new_mass_weighted_normal_modes[imode,i+1] = mode[old_index][1] 
-                self.new_mass_weighted_normal_modes[imode,i+2] = mode[old_index][2] 
-                self.new_normal_modes[imode,i+0] = self.new_mass_weighted_normal_modes[imode,i+0] / math.sqrt(masses[index])
-                self.new_normal_modes[imode,i+1] = self.new_mass_weighted_normal_modes[imode,i+1] / math.sqrt(masses[index])
-                self.new_normal_modes[imode,i+2] = self.new_mass_weighted_normal_modes[imode,i+2] / math.sqrt(masses[index])
+        masses = np.array(self.cell_of_molecules.atomic_masses)
+        reordered_modes = np.asarray(mass_weighted_normal_modes)[:,self.original_atomic_order,:]
+        self.new_mass_weighted_normal_modes = np.reshape(reordered_modes, (nmodes,3*nions))
+        self.new_normal_modes = np.reshape(reordered_modes / np.sqrt(masses)[np.newaxis,:,np.newaxis], (nmodes,3*nions))
         # Calculate the distribution in energy for the normal modes
-        mode_energies = Calculator.calculate_energy_distribution(self.cell_of_molecules, self.frequencies_cm1, self.new_mass_weighted_normal_modes)
-        # Deal with degeneracies
-        degenerate_list = [ [] for f in self.frequencies_cm1]
-        for i,fi in enumerate(self.frequencies_cm1):
-            for j,fj in enumerate(self.frequencies_cm1):
-                if abs(fi-fj) < 1.0E-5:
-                    degenerate_list[i].append(j)
-        self.mode_energies = []
-        for i,fi in enumerate(self.frequencies_cm1):
-            tote,cme,rote,vibe,mole = mode_energies[i]
-            sums = [0.0]*5
-            sume = [0.0]*len(mole)
-            degeneracy = len(degenerate_list[i])
-            for j in degenerate_list[i]:
-                tote,cme,rote,vibe,mole = mode_energies[j]
-                sums[0] += tote / degeneracy
-                sums[1] += cme / degeneracy
-                sums[2] += rote / degeneracy
-                sums[3] += vibe / degeneracy
-                for k,e in enumerate(mole):
-                    sume[k] += e / degeneracy
-                sums[4] = sume
-            self.mode_energies.append(sums)
+        total, translational, rotational, vibrational, molecular = Calculator.calculate_energy_distribution(self.cell_of_molecules, self.frequencies_cm1, self.new_mass_weighted_normal_modes)
+        # Sum the contributions of all the molecules
+        cme = np.sum(translational, axis=1)
+        rote = np.sum(rotational, axis=1)
+        vibe = total - cme - rote
+        # Deal with degeneracies, average the energies over the degenerate modes
+        order, starts, groups = Calculator.degenerate_groups(self.frequencies_cm1, 1.0E-5)
+        energies = [ Calculator.degenerate_average(e, order, starts, groups) for e in (total, cme, rote, vibe, molecular) ]
+        self.mode_energies = [ list(e) for e in zip(*energies) ]
         # Store the results in the spread shee
         # if self.notebook.spreadsheet is not None:
         #     self.write_spreadsheet()
@@ -28,6 +28,7 @@ class MainTab(QWidget):
         self.settings['Excel file name'] = excelfile
         self.settings['QM program'] = ''
         self.settings['Hessian symmetrisation'] = 'symm'
+        self.settings['Keep scan index'] = False
         self.notebook = parent
         self.notebook.plottingCalculationRequired = True
         self.notebook.analysisCalculationRequired = True
@@ -108,6 +109,21 @@ class MainTab(QWidget):
         label.setToolTip('The Crystal program uses a different method for symmetrising the hessian.  Check this flag if you want to use the same method as used by Crystal14')
         form.addRow(label, self.hessian_symmetry_cb)
         #
+        # Keeping the scan index of the output file
+        #
+        self.scan_index_cb = QCheckBox(self)
+        self.scan_index_cb.setToolTip('Keep an index of the output file in a hidden file next to it, so the file is read faster next time.  The index is only used if the output file has not changed')
+        self.scan_index_cb.setText('')
+        self.scan_index_cb.setLayoutDirection(Qt.RightToLeft)
+        if self.settings['Keep scan index']:
+            self.scan_index_cb.setCheckState(Qt.Checked)
+        else:
+            self.scan_index_cb.setCheckState(Qt.Unchecked)
+        self.scan_index_cb.stateChanged.connect(self.on_scan_index_changed)
+        label = QLabel('Keep an index of the output file')
+        label.setToolTip('Keep an index of the output file in a hidden file next to it, so the file is read faster next time.  The index is only used if the output file has not changed')
+        form.addRow(label, self.scan_index_cb)
+        #
         # The store results
         #
         self.resultsfile_le = QLineEdit(self)
@@ -197,6 +213,10 @@ class MainTab(QWidget):
         #switch on debugging in the reader
         #self.reader.debug = self.debug
         self.reader.hessian_symmetrisation = self.settings['Hessian symmetrisation']
+        # Only output files large enough to be split into several ranges are scanned in parallel
+        self.reader.parallel_reading = os.path.getsize(self.settings['Output file name']) > self.reader.scan_chunk_size
+        # The index of the output file is only kept if asked for, as it is written next to the output file
+        self.reader.scan_cache = self.settings['Keep scan index']
         try:
             self.reader.read_output()
         except:
@@ -279,6 +299,11 @@ class MainTab(QWidget):
             self.settings['Hessian symmetrisation'] = 'symm'
         self.dirty = True
 
+    def on_scan_index_changed(self):
+        debugger.print('on scan index changed')
+        self.settings['Keep scan index'] = self.scan_index_cb.isChecked()
+        self.dirty = True
+
     def on_resultsfile_le_return(self):
         debugger.print('on resultsfile return ', self.resultsfile_le.text())
  
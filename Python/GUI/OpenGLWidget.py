@@ -1,4 +1,4 @@
-import os
+import sys
 import math
 import numpy as np
 # The following lines seem to fix a problem when running on low end machines
@@ -12,9 +12,9 @@ from OpenGL.GLUT     import *
 from PyQt5.QtWidgets import QOpenGLWidget
 from PyQt5.QtCore    import Qt
 from PyQt5.QtCore    import QTimer
-from PyQt5.QtGui     import QSurfaceFormat
-from Python.Constants import PI
+from PyQt5.QtGui     import QSurfaceFormat, QImage
 from Python.Utilities import Debug
+from Python.MovieWriter import MovieWriter
 
 class OpenGLWidget(QOpenGLWidget):
 
@@ -44,9 +44,26 @@ class OpenGLWidget(QOpenGLWidget):
         self.linearAttenuation      = True
         self.image_size             = 15.0
         self.white                  = np.array( [1.0, 1.0, 1.0, 1.0] )
-        self.spheres                = None
-        self.cylinders              = None
-        self.arrows                 = None
+        # The scene is held as arrays, positions are (nphases, n, 3) and colours are rgba in the range 0-1
+        self.sphere_positions       = None
+        self.sphere_radii           = None
+        self.sphere_colours         = None
+        self.cylinder_positions1    = None
+        self.cylinder_positions2    = None
+        self.cylinder_radii         = None
+        self.cylinder_colours       = None
+        self.cylinder_heights       = None
+        self.cylinder_angles        = None
+        self.cylinder_rotations     = None
+        self.arrow_colour           = None
+        self.arrow_radius           = None
+        self.arrow_heights          = None
+        self.arrow_angles           = None
+        self.arrow_rotations        = None
+        # Display lists for each (kind, phase) and for the tessellated unit meshes
+        self.display_lists          = {}
+        self.mesh_lists             = {}
+        self.stale_display_lists    = []
         self.current_phase          = 0
         self.phase_direction        = 1
         self.number_of_phases       = 1
@@ -54,6 +71,17 @@ class OpenGLWidget(QOpenGLWidget):
         self.sphere_stacks          = 20
         self.cylinder_slices        = 8
         self.cylinder_stacks        = 2
+        # Level of detail, the tessellation is reduced for small or numerous primitives
+        # maximum_* are the finest tessellations, minimum_* the coarsest before impostors are used
+        self.maximum_sphere_slices   = 20
+        self.minimum_sphere_slices   = 6
+        self.maximum_cylinder_slices = 8
+        self.minimum_cylinder_slices = 4
+        self.pixels_per_edge         = 3.0
+        self.zoom_scale              = 1.0
+        self.pixels_per_angstrom     = 1.0
+        self.impostors               = False
+        self.impostor_scale          = None
         self.timer                  = None
         self.show_arrows            = True
         self.timer_interval         = 60
@@ -148,40 +176,46 @@ class OpenGLWidget(QOpenGLWidget):
             glMatrixMode(GL_MODELVIEW)
             glLoadIdentity()
             self.matrix =  np.eye( 4, dtype=np.float32)
+            self.zoom_scale = 1.0
             self.current_phase = int(self.number_of_phases / 2)
             debugger.print('Home key', self.current_phase)
             self.update()
 
     def save_movie(self, filename):
-        import imageio
-        imageio.plugins.ffmpeg.download()
         debugger.print('save_movie', filename)
+        try:
+            writer = MovieWriter(filename, fps=24)
+        except Exception as error:
+            print('Error unable to write the movie', filename, error, file=sys.stderr)
+            return
         if self.timer is not None:
             self.timer.stop()
-        writer  = imageio.get_writer(filename, mode='I', fps=24)
-        tmpdir  = os.path.dirname(filename)
-        tmpfile = os.path.join(tmpdir,'.snapshot.png')
-        debugger.print('save_movie', filename)
-        for i in range(0,2*self.number_of_phases):
-            self.timeoutHandler()
-            image = self.grabFramebuffer()
-            x = image.width()
-            y = image.height()
-            modx = x%16
-            mody = y%16
-            startx = int(modx / 2)
-            starty = int(mody / 2)
-            x = x - modx + startx
-            y = y - mody + starty
-            # The image is cropped so that the height and widths are multiples of 16
-            image = image.copy(startx, starty, x,y)
-            image.save(tmpfile)
-            image = imageio.imread(tmpfile)
-            writer.append_data(image);
-        writer.close()
-        os.remove(tmpfile)
-        if self.timer is not None:
-            self.timer.start()
+        # The frames are grabbed here and encoded on the writer's thread
+        # The writer is always closed and the animation restarted, even if encoding fails
+        failure = None
+        try:
+            for i in range(0,2*self.number_of_phases):
+                self.timeoutHandler()
+                writer.append(self.grabFrame())
+        except Exception as error:
+            failure = error
+        finally:
+            try:
+                writer.close()
+            except Exception as error:
+                # An error in the encoder is raised again by close(), so only report it once
+                if failure is None:
+                    failure = error
+            if self.timer is not None:
+                self.timer.start()
+        if failure is not None:
+            print('Error writing the movie', filename, failure, file=sys.stderr)
+
+    def grabFrame(self):
+        # Render the current phase and return it as an rgb numpy array
+        # The image is cropped so that the height and widths are multiples of 16
+        image = self.grabFramebuffer().convertToFormat(QImage.Format_RGBA8888)
+        return image_to_array(image, multiple=16)
 
     def snapshot(self,filename):
         debugger.print('snapshot', filename)
@@ -219,6 +253,7 @@ class OpenGLWidget(QOpenGLWidget):
             zoom_factor = 0.94
         debugger.print('zoom factor', zoom_factor)
         glScalef(zoom_factor, zoom_factor, zoom_factor)
+        self.zoom_scale *= zoom_factor
         self.update()
 
     def mouseMoveEvent(self, event):
@@ -265,90 +300,207 @@ class OpenGLWidget(QOpenGLWidget):
 
     def paintGL(self):
         debugger.print('paintGL')
+        self.deleteStaleDisplayLists()
+        self.updateLevelOfDetail()
+        # Recompile any mesh whose tessellation has changed, the phase lists call the meshes by name
+        # Lists cannot be compiled inside one another, so this is done before any phase list is compiled
+        for mesh in ('sphere', 'cylinder', 'arrowhead'):
+            self.meshList(mesh)
         glMatrixMode(GL_MODELVIEW)
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
         self.background_colour = np.array(self.viewerTab.settings['Background colour'])/255.0
         glClearColor(*self.background_colour)
         glPushMatrix()
         glTranslatef(-self.rotation_centre[0],-self.rotation_centre[1],-self.rotation_centre[2] )
-        self.drawSpheres()
-        self.drawCylinders()
+        self.callDisplayList('spheres', self.drawSpheres)
+        self.callDisplayList('cylinders', self.drawCylinders)
         if self.show_arrows:
-            self.drawArrows()
+            self.callDisplayList('arrows', self.drawArrows)
         glPopMatrix()
 
-    def drawSpheres(self):
-        debugger.print('drawSpheres')
-        if self.spheres is None:
-            return
-        for sphere in self.spheres[self.current_phase]:
-            col       = sphere.colour
-            rad       = sphere.radius
-            (x, y, z) = sphere.position
-            diffMatColour =  col * self.diffuseMaterialFactor
-            ambMatColour =   col * self.ambientMaterialFactor
-            specMatColour =  self.white * self.specularLightFactor
-            glMaterialfv(GL_FRONT, GL_DIFFUSE, diffMatColour)
-            glMaterialfv(GL_FRONT, GL_AMBIENT, ambMatColour)
-            glMaterialfv(GL_FRONT, GL_SPECULAR, specMatColour)
-            glMaterialf( GL_FRONT, GL_SHININESS, self.glintMaterialFactor)
-            glPushMatrix()
-            glTranslatef( x, y, z )
-            gluSphere(self.quadric, rad, self.sphere_slices, self.sphere_stacks)
-            glPopMatrix()
+    def callDisplayList(self, kind, draw):
+        # Each kind of primitive is compiled into a display list for each phase the first time the phase is drawn
+        # After that a frame of the animation only needs one call per kind
+        key = (kind, self.current_phase)
+        if key not in self.display_lists:
+            index = glGenLists(1)
+            glNewList(index, GL_COMPILE)
+            draw(self.current_phase)
+            glEndList()
+            self.display_lists[key] = index
+        glCallList(self.display_lists[key])
+
+    def invalidateDisplayLists(self, kinds):
+        # The display lists can only be deleted when the context is current, so they are deleted by paintGL
+        for key in list(self.display_lists):
+            if key[0] in kinds:
+                self.stale_display_lists.append(self.display_lists.pop(key))
+        self.update()
 
-    def drawCylinders(self):
-        debugger.print('drawCylinders')
-        if self.cylinders is None:
+    def deleteStaleDisplayLists(self):
+        for index in self.stale_display_lists:
+            glDeleteLists(index, 1)
+        self.stale_display_lists = []
+
+    def meshList(self, kind):
+        # The unit sphere and cylinders are tessellated once into display lists and scaled when they are drawn
+        # Each mesh keeps its list, which is recompiled when the level of detail changes
+        # The phase lists call the mesh lists by name, so they do not need recompiling
+        if kind == 'sphere':
+            tessellation = (self.sphere_slices, self.sphere_stacks)
+        else:
+            tessellation = (self.cylinder_slices, self.cylinder_stacks)
+        if kind in self.mesh_lists and self.mesh_lists[kind][1] == tessellation:
+            return self.mesh_lists[kind][0]
+        if kind in self.mesh_lists:
+            index = self.mesh_lists[kind][0]
+        else:
+            index = glGenLists(1)
+        slices, stacks = tessellation
+        glNewList(index, GL_COMPILE)
+        if kind == 'sphere':
+            gluSphere(self.quadric, 1.0, slices, stacks)
+        elif kind == 'cylinder':
+            gluCylinder(self.quadric, 1.0, 1.0, 1.0, slices, stacks)
+        elif kind == 'arrowhead':
+            gluCylinder(self.quadric, 2.0, 0.1, 1.0, slices, stacks)
+        glEndList()
+        self.mesh_lists[kind] = (index, tessellation)
+        return index
+
+    def updateLevelOfDetail(self):
+        # Choose the tessellation from the size of the primitives on the screen and the triangle budget
+        # If even the coarsest tessellation is over budget, spheres are drawn as points and cylinders as lines
+        if self.my_width is None or self.my_height is None or not self.image_size:
             return
-        for cylinder in self.cylinders[self.current_phase]:
-            col    = cylinder.colour
-            rad    = cylinder.radius
-            pos1   = cylinder.position1
-            pos2   = cylinder.position2
-            length = cylinder.height
-            angle  = cylinder.angle
-            rot    = cylinder.rotation
-            diffMatColour =  col * self.diffuseMaterialFactor
-            ambMatColour =   col * self.ambientMaterialFactor
-            specMatColour =  self.white * self.specularLightFactor
-            glMaterialfv(GL_FRONT, GL_DIFFUSE, diffMatColour)
-            glMaterialfv(GL_FRONT, GL_AMBIENT, ambMatColour)
-            glMaterialfv(GL_FRONT, GL_SPECULAR, specMatColour)
-            glMaterialf( GL_FRONT, GL_SHININESS, self.glintMaterialFactor)
-            glPushMatrix()
-            glTranslated( pos2[0], pos2[1], pos2[2] )
-            glRotated(angle, rot[0], rot[1], rot[2])
-            gluCylinder(self.quadric, rad, rad, length, self.cylinder_slices, self.cylinder_stacks)
-            glPopMatrix()
-
-    def drawArrows(self):
-        debugger.print('drawArrows')
-        if self.arrows is None:
+        self.pixels_per_angstrom = self.zoom_scale * min(self.my_width,self.my_height) / (2.2 * self.image_size)
+        budget = self.viewerTab.settings['Triangle budget']
+        nspheres = 0 if self.sphere_positions is None else np.size(self.sphere_positions, 1)
+        ncylinders = 0 if self.cylinder_positions1 is None else np.size(self.cylinder_positions1, 1)
+        if self.show_arrows and self.arrow_heights is not None:
+            ncylinders += 2*len(self.arrow_heights)
+        def slices_for(radii, smallest, largest):
+            # Enough slices for an edge of about pixels_per_edge pixels on the largest primitive
+            if radii is None or len(radii) == 0:
+                return smallest
+            circumference = 2.0 * math.pi * np.max(radii) * self.pixels_per_angstrom
+            return int(min(largest, max(smallest, math.ceil(circumference / self.pixels_per_edge))))
+        sphere_slices = slices_for(self.sphere_radii, self.minimum_sphere_slices, self.maximum_sphere_slices)
+        cylinder_slices = slices_for(self.cylinder_radii, self.minimum_cylinder_slices, self.maximum_cylinder_slices)
+        def triangles():
+            return 2*nspheres*sphere_slices*sphere_slices + 2*ncylinders*cylinder_slices*self.cylinder_stacks
+        while triangles() > budget and sphere_slices > self.minimum_sphere_slices:
+            sphere_slices = max(self.minimum_sphere_slices, sphere_slices - 2)
+        while triangles() > budget and cylinder_slices > self.minimum_cylinder_slices:
+            cylinder_slices -= 1
+        self.sphere_slices = self.sphere_stacks = sphere_slices
+        self.cylinder_slices = cylinder_slices
+        impostors = triangles() > budget
+        if impostors:
+            # The size of the points depends on the zoom, so keep it in steps of about 20%
+            scale = 2.0**(round(4.0*math.log2(max(self.pixels_per_angstrom, 1.0E-6)))/4.0)
+        else:
+            scale = None
+        if impostors != self.impostors or (impostors and scale != self.impostor_scale):
+            debugger.print('updateLevelOfDetail impostors', impostors, scale)
+            self.impostors = impostors
+            self.impostor_scale = scale
+            self.invalidateDisplayLists( ('spheres', 'cylinders') )
+        debugger.print('updateLevelOfDetail', self.sphere_slices, self.cylinder_slices, self.impostors)
+
+    def setMaterial(self, colour):
+        diffMatColour =  colour * self.diffuseMaterialFactor
+        ambMatColour =   colour * self.ambientMaterialFactor
+        specMatColour =  self.white * self.specularLightFactor
+        glMaterialfv(GL_FRONT, GL_DIFFUSE, diffMatColour)
+        glMaterialfv(GL_FRONT, GL_AMBIENT, ambMatColour)
+        glMaterialfv(GL_FRONT, GL_SPECULAR, specMatColour)
+        glMaterialf( GL_FRONT, GL_SHININESS, self.glintMaterialFactor)
+
+    def drawSpheres(self, phase):
+        debugger.print('drawSpheres', phase)
+        if self.sphere_positions is None:
+            return
+        if self.impostors:
+            self.drawPointSpheres(phase)
+            return
+        mesh = self.meshList('sphere')
+        positions = self.sphere_positions[phase]
+        # The materials are set once for each colour
+        for colour, members in colour_groups(self.sphere_colours):
+            self.setMaterial(colour)
+            for rad, (x, y, z) in zip(self.sphere_radii[members], positions[members]):
+                glPushMatrix()
+                glTranslated( x, y, z )
+                glScaled( rad, rad, rad )
+                glCallList(mesh)
+                glPopMatrix()
+
+    def drawCylinders(self, phase):
+        debugger.print('drawCylinders', phase)
+        if self.cylinder_positions1 is None:
+            return
+        if self.impostors:
+            self.drawLineCylinders(phase)
             return
-        self.arrow_colour = np.array(self.viewerTab.settings['Arrow colour'])/255.0
-        for arrow,sphere in zip(self.arrows,self.spheres[self.current_phase]):
-            pos       = sphere.position
-            direction = arrow.direction
-            length    = arrow.height
-            angle     = arrow.angle
-            rot       = arrow.rotation
-            colour    = arrow.colour
-            radius    = arrow.radius
-            diffMatColour =  colour * self.diffuseMaterialFactor
-            ambMatColour =   colour * self.ambientMaterialFactor
-            specMatColour =  self.white * self.specularLightFactor
-            glMaterialfv(GL_FRONT, GL_DIFFUSE, diffMatColour)
-            glMaterialfv(GL_FRONT, GL_AMBIENT, ambMatColour)
-            glMaterialfv(GL_FRONT, GL_SPECULAR, specMatColour)
-            glMaterialf( GL_FRONT, GL_SHININESS, self.glintMaterialFactor)
+        mesh = self.meshList('cylinder')
+        for colour, members in colour_groups(self.cylinder_colours):
+            self.setMaterial(colour)
+            for rad, pos2, length, angle, rot in zip(self.cylinder_radii[members], self.cylinder_positions2[phase][members],
+                                                     self.cylinder_heights[phase][members], self.cylinder_angles[phase][members], self.cylinder_rotations[phase][members]):
+                glPushMatrix()
+                glTranslated( pos2[0], pos2[1], pos2[2] )
+                glRotated(angle, rot[0], rot[1], rot[2])
+                glScaled( rad, rad, length )
+                glCallList(mesh)
+                glPopMatrix()
+
+    def drawPointSpheres(self, phase):
+        # Impostors for very large systems, each sphere is an unlit round point of the projected diameter
+        glDisable(GL_LIGHTING)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        positions = self.sphere_positions[phase]
+        for colour, members in colour_groups(np.column_stack( (self.sphere_colours, self.sphere_radii) )):
+            glColor4dv(colour[0:4])
+            glPointSize(max(1.0, 2.0*colour[4]*self.impostor_scale))
+            glVertexPointer(3, GL_DOUBLE, 0, np.ascontiguousarray(positions[members]))
+            glDrawArrays(GL_POINTS, 0, len(members))
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glEnable(GL_LIGHTING)
+
+    def drawLineCylinders(self, phase):
+        # Impostors for very large systems, each cylinder is an unlit line of the projected width
+        glDisable(GL_LIGHTING)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        for colour, members in colour_groups(np.column_stack( (self.cylinder_colours, self.cylinder_radii) )):
+            glColor4dv(colour[0:4])
+            glLineWidth(max(1.0, 2.0*colour[4]*self.impostor_scale))
+            ends = np.stack( (self.cylinder_positions1[phase][members], self.cylinder_positions2[phase][members]), axis=1 )
+            glVertexPointer(3, GL_DOUBLE, 0, np.ascontiguousarray(np.reshape(ends, (-1,3))))
+            glDrawArrays(GL_LINES, 0, 2*len(members))
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glEnable(GL_LIGHTING)
+
+    def drawArrows(self, phase):
+        debugger.print('drawArrows', phase)
+        if self.arrow_heights is None or self.sphere_positions is None:
+            return
+        shaft = self.meshList('cylinder')
+        head = self.meshList('arrowhead')
+        radius = self.arrow_radius
+        self.setMaterial(self.arrow_colour)
+        # The arrows start at the atoms, which are the first spheres
+        for pos, length, angle, rot in zip(self.sphere_positions[phase], self.arrow_heights, self.arrow_angles, self.arrow_rotations):
             glPushMatrix()
             glTranslated( pos[0], pos[1], pos[2] )
             glRotated(angle, rot[0], rot[1], rot[2])
-            gluCylinder(self.quadric, radius, radius, length, self.cylinder_slices, self.cylinder_stacks)
+            glPushMatrix()
+            glScaled( radius, radius, length )
+            glCallList(shaft)
+            glPopMatrix()
             glTranslated( 0.0, 0.0, length )
-            length = 0.1
-            gluCylinder(self.quadric, 2.0*radius, 0.1*radius, length, self.cylinder_slices, self.cylinder_stacks)
+            glScaled( radius, radius, 0.1 )
+            glCallList(head)
             glPopMatrix()
 
 
@@ -361,6 +513,10 @@ class OpenGLWidget(QOpenGLWidget):
 
     def initializeGL(self):
         debugger.print('initializeGL')
+        # Any display lists belonged to an earlier context
+        self.display_lists = {}
+        self.mesh_lists = {}
+        self.stale_display_lists = []
         self.quadric  = gluNewQuadric()
         gluQuadricDrawStyle(self.quadric, GLU_FILL)
         gluQuadricNormals(self.quadric, GLU_SMOOTH)
@@ -384,23 +540,13 @@ class OpenGLWidget(QOpenGLWidget):
         glClearColor(*self.background_colour)
 
     def setImageSize(self):
+        # The image size is the largest distance of a sphere or a cylinder end from the rotation centre
         maxsize = 0.0
-        for sphere in self.spheres[self.current_phase]:
-            pos = sphere.position
-            vec = pos - self.rotation_centre
-            dist = math.sqrt(np.dot(vec,vec))
-            if dist > maxsize:
-                maxsize = dist
-        for cylinder in self.cylinders[self.current_phase]:
-            pos1 = cylinder.position1
-            pos2 = cylinder.position2
-            vec1 = pos1 - self.rotation_centre
-            dist1 = math.sqrt(np.dot(vec,vec))
-            vec2 = pos2 - self.rotation_centre
-            dist2 = math.sqrt(np.dot(vec,vec))
-            dist = max(dist1,dist2)
-            if dist > maxsize:
-                maxsize = dist
+        phase = self.current_phase
+        for positions in (self.sphere_positions, self.cylinder_positions1, self.cylinder_positions2):
+            if positions is not None and np.size(positions[phase]) > 0:
+                vec = positions[phase] - self.rotation_centre
+                maxsize = max(maxsize, math.sqrt(np.max(np.sum(vec*vec, axis=1))))
         self.image_size = maxsize
         self.setProjectionMatrix()
         debugger.print('setImageSize',self.image_size)
@@ -420,6 +566,7 @@ class OpenGLWidget(QOpenGLWidget):
         glMatrixMode(GL_MODELVIEW)
         glLoadIdentity()
         self.matrix =  np.eye( 4, dtype=np.float32)
+        self.zoom_scale = 1.0
         # reset the current phase to the centre of the phases
         self.current_phase = int(self.number_of_phases / 2)
         debugger.print('set projection matrix ortho', orthox, orthoy, orthoz)
@@ -449,76 +596,101 @@ class OpenGLWidget(QOpenGLWidget):
         debugger.print('set rotation centre',pos)
         self.rotation_centre = np.array(pos)
 
-    def createArrays(self, nphases):
-        debugger.print('createArrays')
-        #  Create an empty list for each phase
-        self.spheres    = [ [] for i in range(nphases) ]
-        self.cylinders  = [ [] for i in range(nphases) ]
-        self.number_of_phases = nphases
-        self.current_phase = int(self.number_of_phases / 2)
+    def setSpheres(self, colours, radii, positions):
+        '''Define the spheres for every phase
+           colours are rgba 0-255 (n, 4), radii are (n) and positions are (nphases, n, 3)'''
+        debugger.print('setSpheres')
+        self.sphere_positions = np.array(positions, dtype=float)
+        self.sphere_colours   = np.array(colours, dtype=float)/255.0
+        self.sphere_radii     = np.array(radii, dtype=float)
+        self.number_of_phases = len(self.sphere_positions)
+        self.current_phase    = int(self.number_of_phases / 2)
+        # The arrows are drawn from the atoms, so they change too
+        self.invalidateDisplayLists( ('spheres', 'arrows') )
+
+    def setCylinders(self, colours, radii, positions1, positions2):
+        '''Define the cylinders for every phase
+           colours are rgba 0-255 (n, 4), radii are (n) and the ends of each cylinder are (nphases, n, 3)
+           The cylinders are drawn from positions2 to positions1'''
+        debugger.print('setCylinders')
+        self.cylinder_positions1 = np.array(positions1, dtype=float)
+        self.cylinder_positions2 = np.array(positions2, dtype=float)
+        self.cylinder_colours    = np.array(colours, dtype=float)/255.0
+        self.cylinder_radii      = np.array(radii, dtype=float)
+        self.cylinder_heights, self.cylinder_angles, self.cylinder_rotations = orientations(self.cylinder_positions1 - self.cylinder_positions2)
+        self.invalidateDisplayLists( ('cylinders',) )
+
+    def setSphereAppearance(self, colours, radii):
+        '''Change the colours (rgba 0-255) and radii of the spheres, the positions are unchanged'''
+        debugger.print('setSphereAppearance')
+        self.sphere_colours = np.array(colours, dtype=float)/255.0
+        self.sphere_radii   = np.array(radii, dtype=float)
+        self.invalidateDisplayLists( ('spheres',) )
+
+    def setCylinderAppearance(self, colours, radii):
+        '''Change the colours (rgba 0-255) and radii of the cylinders, the positions and orientations are unchanged'''
+        debugger.print('setCylinderAppearance')
+        self.cylinder_colours = np.array(colours, dtype=float)/255.0
+        self.cylinder_radii   = np.array(radii, dtype=float)
+        self.invalidateDisplayLists( ('cylinders',) )
+
+    def setArrows(self, colour, radius, directions, scale):
+        '''Define an arrow for each atom, there is no phase requirement for arrows - they are just displacements
+           directions are the displacements (natoms, 3), which are scaled by scale'''
+        debugger.print('setArrows')
+        self.arrow_colour = np.array(colour, dtype=float)/255.0
+        self.arrow_radius = radius
+        heights, self.arrow_angles, self.arrow_rotations = orientations(np.array(directions, dtype=float), small=1.0E-8)
+        self.arrow_heights = heights*scale
+        self.invalidateDisplayLists( ('arrows',) )
 
     def deleteSpheres(self):
         debugger.print('deleteSpheres')
-        if self.spheres is not None:
-            for spheres in self.spheres:
-                spheres = []
+        self.sphere_positions = None
+        self.invalidateDisplayLists( ('spheres', 'arrows') )
 
     def deleteCylinders(self):
         debugger.print('deleteCylinders')
-        if self.cylinders is not None:
-            for cylinders in self.cylinders:
-                cylinders = []
+        self.cylinder_positions1 = None
+        self.cylinder_positions2 = None
+        self.invalidateDisplayLists( ('cylinders',) )
 
     def deleteArrows(self):
         debugger.print('deleteArrows')
-        self.arrows = []
-
-    def addArrows(self, colour, radius, direction, length, phase=0):
-        # There is no phase requirement for arrows - they are just displacements
-        self.arrows.append( Arrow(colour, radius, direction, length) )
-
-    def addCylinder(self, colour, radius, pos1, pos2, phase=0):
-        self.cylinders[phase].append( Cylinder(colour,radius,pos1,pos2) )
-
-    def addSphere(self, colour, radius, pos, phase=0):
-        self.spheres[phase].append( Sphere(colour,radius,pos) )
-
-class Sphere():
-    def __init__(self, colour, radius, position):
-        self.colour= np.array(colour)/255.0
-        self.radius = radius
-        self.position = np.array(position)
-
-class Cylinder():
-    def __init__(self, colour, radius, pos1, pos2):
-        a = np.array(pos1)
-        b = np.array(pos2)
-        self.colour= np.array(colour)/255.0
-        self.radius = radius
-        self.position1 = a
-        self.position2 = b
-        z = np.array( [0.0, 0.0, 1.0] )
-        p = a - b
-        t = np.cross(z, p)
-        height = math.sqrt(np.dot(p,p))
-        angle = 180.0 / PI * math.acos( np.dot(z,p) / height )
-        self.angle = angle
-        self.height = height
-        self.rotation = t
-
-class Arrow():
-    def __init__(self, colour, radius, direction, scale):
-        # Adds a displacement to each atom
-        self.colour= np.array(colour)/255.0
-        p = np.array(direction)
-        z = np.array( [0.0, 0.0, 1.0] )
-        t = np.cross(z, p)
-        height = math.sqrt(np.dot(p,p)) + 1.0E-8
-        angle = 180.0 / PI * math.acos( np.dot(z,p) / height )
-        p = p / height
-        self.angle = angle
-        self.height = height*scale
-        self.rotation = t
-        self.direction = p
-        self.radius = radius
-
+        self.arrow_heights = None
+        self.invalidateDisplayLists( ('arrows',) )
+
+def image_to_array(image, multiple=1):
+    '''Copy an RGBA8888 QImage into an rgb numpy array (height, width, 3) without a file
+       The image is cropped about its centre so that the height and width are multiples of multiple'''
+    width = image.width()
+    height = image.height()
+    pointer = image.constBits()
+    pointer.setsize(height * image.bytesPerLine())
+    pixels = np.frombuffer(pointer, dtype=np.uint8).reshape(height, image.bytesPerLine())
+    pixels = pixels[:, 0:4*width].reshape(height, width, 4)
+    startx = (width % multiple) // 2
+    starty = (height % multiple) // 2
+    width = width - width % multiple
+    height = height - height % multiple
+    return np.array(pixels[starty:starty+height, startx:startx+width, 0:3])
+
+def colour_groups(colours):
+    '''Group primitives by colour, returns a list of (colour, indices of the primitives with that colour)'''
+    if len(colours) == 0:
+        return []
+    unique, inverse = np.unique(colours, axis=0, return_inverse=True)
+    inverse = np.reshape(inverse, -1)
+    return [ (colour, np.nonzero(inverse == k)[0]) for k, colour in enumerate(unique) ]
+
+def orientations(vectors, small=0.0):
+    '''Calculate the length of each vector and the rotation which takes the z axis onto it
+       vectors can have any shape as long as the last dimension is 3
+       small is added to the length to avoid dividing by zero
+       The lengths, the angles of rotation in degrees and the axes of rotation are returned'''
+    z = np.array( [0.0, 0.0, 1.0] )
+    heights = np.sqrt(np.sum(vectors*vectors, axis=-1)) + small
+    cosines = np.clip(vectors[...,2] / np.where(heights > 0.0, heights, 1.0), -1.0, 1.0)
+    angles = np.degrees(np.arccos(cosines))
+    rotations = np.cross(z, vectors)
+    return heights, angles, rotations
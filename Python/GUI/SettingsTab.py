@@ -207,38 +207,32 @@ class SettingsTab(QWidget):
         self.mass_weighted_normal_modes = self.reader.calculate_mass_weighted_normal_modes()
         # convert cm-1 to au
         self.frequencies_cm1 = self.reader.frequencies
-        # work out the degeneraceies
-        degeneracy_threshold = 1.0E-8
-        self.degenerate_lists = {}
 #        #
         frequencies = np.array(self.frequencies_cm1) * wavenumber
         if len(self.sigmas_cm1) == 0:
             self.sigmas_cm1 = [ self.settings['Sigma value'] for i in self.frequencies_cm1 ]
         born_charges = np.array(self.reader.born_charges)
+        volume = self.reader.volume*angstrom*angstrom*angstrom
+        # Only modes above 10 cm-1 with an intensity contribute to the ionic permittivity
+        minimum_frequency = 10.0*wavenumber
+        minimum_intensity = 1.0E-6
         if self.reader.type == 'Experimental output':
             self.oscillator_strengths = self.reader.oscillator_strengths
+            # calculate the intensities from the trace of the oscillator strengths
+            self.intensities = Calculator.infrared_intensities(self.oscillator_strengths)
+            mode_list = [ index for index,(f,intensity) in enumerate(zip(frequencies,self.intensities)) if f > minimum_frequency and intensity > minimum_intensity ]
+            self.epsilon_ionic = Calculator.ionic_permittivity(mode_list, self.oscillator_strengths, frequencies, volume )
         else:
             #
             # calculate normal modes in xyz coordinate space
             masses = np.array(self.reader.masses) * amu
             normal_modes = Calculator.normal_modes(masses, self.mass_weighted_normal_modes)
-            # from the normal modes and the born charges calculate the oscillator strengths of each mode
-            self.oscillator_strengths = Calculator.oscillator_strengths(normal_modes, born_charges)
-        # calculate the intensities from the trace of the oscillator strengths
-        self.intensities = Calculator.infrared_intensities(self.oscillator_strengths)
+            # from the normal modes and the born charges calculate the oscillator strengths, intensities and the ionic permittivity
+            self.oscillator_strengths, self.intensities, self.epsilon_ionic, mode_list = Calculator.infrared_properties(normal_modes, born_charges, frequencies, volume,
+                                                                                                                       minimum_frequency=minimum_frequency, minimum_intensity=minimum_intensity)
         # Decide which modes to select
-        self.modes_selected = []
-        mode_list = []
-        for index,(f,intensity) in enumerate(zip(self.frequencies_cm1,self.intensities)):
-            if f > 10.0 and intensity > 1.0E-6:
-                self.modes_selected.append(True)
-                mode_list.append(index)
-            else:
-                self.modes_selected.append(False)
-        # Calculate the ionic contribution to the permittivity
-        frequencies = wavenumber*np.array(self.frequencies_cm1)
-        volume = self.reader.volume*angstrom*angstrom*angstrom
-        self.epsilon_ionic = Calculator.ionic_permittivity(mode_list, self.oscillator_strengths, frequencies, volume )
+        selected = set(mode_list)
+        self.modes_selected = [ index in selected for index in range(len(self.frequencies_cm1)) ]
         self.output_tw.setRowCount(len(self.sigmas_cm1))
         self.output_tw.setColumnCount(5)
         self.output_tw.setHorizontalHeaderLabels(['   Sigma   \n(cm-1)', ' Frequency \n(cm-1)', '  Intensity  \n(Debye2/Å2/amu)', 'Integrated Molar Absorption\n(L/mole/cm2)', 'Absorption maximum\n(L/mole/cm)'])
@@ -1,7 +1,11 @@
 import os
+import copy
 import math
+from collections import OrderedDict
 import numpy as np
 import Python.Calculator as Calculator
+import Python.ViewerScene as ViewerScene
+import Python.TrajectoryWriter as TrajectoryWriter
 from PyQt5.QtWidgets         import  QPushButton, QWidget
 from PyQt5.QtWidgets         import  QComboBox, QLabel, QLineEdit
 from PyQt5.QtWidgets         import  QVBoxLayout, QHBoxLayout, QFormLayout
@@ -23,17 +27,7 @@ class ViewerTab(QWidget):
         self.dirty = True
         self.setWindowTitle('Viewer')
         self.selected_mode = 0
-        self.settings = {}
-        self.settings['Atom scaling'] = 0.5
-        self.settings['Maximum displacement']  = 1.0
-        self.settings['Bond colour']           = [  80,  80,  80, 255 ]
-        self.settings['Bond radius']           = 0.1
-        self.settings['Cell colour']           = [ 255,   0,   0, 255 ]
-        self.settings['Cell radius']           = 0.1
-        self.settings['Background colour']     = [ 120, 120, 120, 255 ]
-        self.settings['Arrow colour']          = [   0, 255,   0, 255 ]
-        self.settings['Arrow radius']          = 0.07
-        self.settings['Number of phase steps'] = 41
+        self.settings = copy.deepcopy(ViewerScene.default_settings)
         self.light_switches = [False]*8
         self.light_switches[0] = True
         self.light_switches[1] = True
@@ -43,6 +37,11 @@ class ViewerTab(QWidget):
         self.unit_cell = None
         self.cell_edges = None
         self.cell_corners = None
+        # The displacements of every mode (nmodes, natoms, 3), built once each time the reader is processed
+        self.UVW = None
+        # The phase positions of the most recently viewed modes, the least recently used are discarded first
+        self.phase_positions_cache = OrderedDict()
+        self.phase_positions_cache_size = 8
         # element_colours is a dictionary
         self.element_colours = elemental_colours
         self.element_names = []
@@ -130,6 +129,15 @@ class ViewerTab(QWidget):
         self.maximum_displacement_sb.setToolTip('Set the size of the maximum displacement')
         self.maximum_displacement_sb.valueChanged.connect(self.on_maximum_displacement_changed)
         #
+        # The triangle budget
+        #
+        self.triangle_budget_sb = QSpinBox(self)
+        self.triangle_budget_sb.setRange(10000,100000000)
+        self.triangle_budget_sb.setSingleStep(100000)
+        self.triangle_budget_sb.setValue(self.settings['Triangle budget'])
+        self.triangle_budget_sb.setToolTip('The maximum number of triangles drawn, the tessellation of the atoms and bonds is reduced to keep within it.\nIf that is not possible the atoms are drawn as points and the bonds as lines')
+        self.triangle_budget_sb.valueChanged.connect(self.on_triangle_budget_changed)
+        #
         # Add a comb box to select which type of plot
         #
         self.plottype_cb = QComboBox(self) 
@@ -195,6 +203,7 @@ class ViewerTab(QWidget):
         self.settingsTab.addTab(self.bond_radius_sb, 'Bond Radius')
         self.settingsTab.addTab(self.cell_radius_sb, 'Cell Radius')
         self.settingsTab.addTab(self.arrow_radius_sb, 'Arrow Radius')
+        self.settingsTab.addTab(self.triangle_budget_sb, 'Triangle Budget')
         label = QLabel('Settings', self)
         form.addRow(label,self.settingsTab)
         #
@@ -202,7 +211,7 @@ class ViewerTab(QWidget):
         #
         hbox = QHBoxLayout()
         self.filename_le = QLineEdit(self)
-        self.filename_le.setToolTip('Give a file name in which to save the image.\nIf a return is pressed the filename is scanned to see whatyoe of file has been requested.')
+        self.filename_le.setToolTip('Give a file name in which to save the image.\nIf a return is pressed the filename is scanned to see whatyoe of file has been requested.\nA .xyz or .dcd file name saves every mode as a trajectory.')
         self.filename_le.setText(self.image_filename)
         self.filename_le.textChanged.connect(self.on_filename_le_changed)
         self.filename_le.returnPressed.connect(self.on_filename_le_return)
@@ -250,7 +259,7 @@ class ViewerTab(QWidget):
         #
         filename = self.image_filename
         root,extension = os.path.splitext(filename)
-        valid_extension = ( extension == '.mp4' or extension == '.avi' or extension == '.png' or extension == '.gif' )
+        valid_extension = ( extension == '.mp4' or extension == '.avi' or extension == '.png' or extension == '.gif' or extension == '.xyz' or extension == '.dcd' )
         if filename == '' or not valid_extension:
             debugger.print('Aborting on filename button clicked', filename)
             debugger.print('Aborting on filename button clicked', valid_extension)
@@ -274,6 +283,11 @@ class ViewerTab(QWidget):
             self.opengl_widget.save_movie(filename)
         elif extension == '.gif':
             self.opengl_widget.save_movie(filename)
+        elif ( extension == '.xyz' or extension == '.dcd' ) and self.UVW is not None:
+            # Every mode is written, with the phases and displacement used by the viewer
+            TrajectoryWriter.write_trajectory(filename, self.unit_cell, self.UVW, frequencies=self.frequencies_cm1,
+                                              maximum_displacement=self.settings['Maximum displacement'],
+                                              number_of_phase_steps=self.settings['Number of phase steps'])
         self.plot_type_index = old_plot_type
         QApplication.restoreOverrideCursor()
         return
@@ -285,8 +299,9 @@ class ViewerTab(QWidget):
         colour = QColorDialog.getColor(options=QColorDialog.DontUseNativeDialog)
         rgba = [ colour.red(), colour.green(), colour.blue(), colour.alpha() ]
         self.element_colours[text] = rgba
-        self.dirty = True
-        self.refresh()
+        button.setStyleSheet('background-color:rgba( {}, {}, {}, {});'.format(*rgba))
+        self.updateAppearance()
+        self.plot()
 
     def on_coloured_button_clicked(self,boolean):
         debugger.print('on coloured button clicked')
@@ -302,8 +317,13 @@ class ViewerTab(QWidget):
             self.settings['Bond colour'] = rgba
         elif text == 'Arrows':
             self.settings['Arrow colour'] = rgba
-        self.dirty = True
-        self.refresh()
+        button.setStyleSheet('background-color:rgba( {}, {}, {}, {});'.format(*rgba))
+        if text == 'Arrows':
+            if self.UVW is not None:
+                self.setArrows()
+        else:
+            self.updateAppearance()
+        self.plot()
 
 
     def on_light_switches_cb_activated(self, index):
@@ -314,48 +334,56 @@ class ViewerTab(QWidget):
             string = 'switch light {} on'.format(index)
         self.light_switches_cb.setItemText(index,string)
         self.opengl_widget.defineLights()
-        self.calculate()
         self.plot()
 
     def on_maximum_displacement_changed(self,value):
         debugger.print('on maximum_displacement changed ', value)
         self.settings['Maximum displacement'] = value
-        self.calculate()
+        if self.UVW is None:
+            return
+        self.calculatePhasePositions()
+        self.setArrows()
         self.plot()
         
     def on_atom_scaling_changed(self,value):
         debugger.print('on atom_scaling changed ', value)
         self.settings['Atom scaling'] = value
-        self.calculate()
+        self.updateAppearance()
         self.plot()
         
     def on_arrow_radius_changed(self,value):
         debugger.print('on arrow_radius changed ', value)
         self.settings['Arrow radius'] = value
-        self.calculate()
+        if self.UVW is None:
+            return
+        self.setArrows()
         self.plot()
 
     def on_cell_radius_changed(self,value):
         debugger.print('on cell_radius changed ', value)
         self.settings['Cell radius'] = value
-        self.calculate()
+        self.updateAppearance()
         self.plot()
         
+    def on_triangle_budget_changed(self,value):
+        debugger.print('on triangle_budget changed ', value)
+        self.settings['Triangle budget'] = value
+        self.opengl_widget.update()
+
     def on_bond_radius_changed(self,value):
         self.settings['Bond radius'] = value
-        self.calculate()
+        self.updateAppearance()
         self.plot()
         
     def on_selected_mode_changed(self):
         self.selected_mode = self.selected_mode_sb.value()
         debugger.print('on selected_mode change ', self.selected_mode)
         self.frequency_le.setText('{:.5f}'.format(self.notebook.settingsTab.frequencies_cm1[self.selected_mode]))
-        self.opengl_widget.deleteArrows()
-        maxR = np.max( np.abs(np.array(self.UVW[self.selected_mode])))
-        arrow_scaling = self.settings['Maximum displacement'] / maxR
-        for uvw in self.UVW[self.selected_mode]:
-            self.opengl_widget.addArrows( self.settings['Arrow colour'],self.settings['Arrow radius'], uvw, arrow_scaling )
-        self.calculate()
+        if self.UVW is None:
+            return
+        # Only the positions of the new mode are needed, the cell and its appearance are unchanged
+        self.calculatePhasePositions()
+        self.setArrows()
         self.plot()
 
     def on_plottype_cb_changed(self, index):
@@ -402,30 +430,26 @@ class ViewerTab(QWidget):
         self.cell_corners,self.cell_edges = self.unit_cell.getBoundingBox()
         self.element_names = self.unit_cell.element_names
         self.species = self.reader.getSpecies()
-        covalent_radii = self.notebook.analysisTab.element_radii
-        self.radii = [self.settings['Atom scaling']*covalent_radii[el] for el in self.element_names ]
-        self.colours = [ self.element_colours[el] for el in self.element_names ]
-        # reorder the displacement info in the normal modes into U,V and W lists 
-        self.UVW = []
-        for mode,displacements in enumerate(self.normal_modes):
-            uvw = []
-            for i in range(0,len(displacements),3):
-                uvw.append( displacements[i:i+3] )
-            self.UVW.append(uvw)
+        # The displacements of every mode (nmodes, natoms, 3), the phase positions calculated from them are out of date
+        self.UVW = np.reshape(np.asarray(self.normal_modes, dtype=float), (self.number_of_modes,-1,3))
+        self.phase_positions_cache.clear()
         # CalculatePhasePositions stores all the sphere and bond information
+        self.appearance = self.calculateAppearance()
         self.calculatePhasePositions()
         # Add the arrows
-        maxR = np.max( np.abs(np.array(self.UVW[self.selected_mode])))
-        arrow_scaling = self.settings['Maximum displacement'] / maxR
-        self.opengl_widget.deleteArrows()
-        for uvw in self.UVW[self.selected_mode]:
-            self.opengl_widget.addArrows( self.settings['Arrow colour'],self.settings['Arrow radius'], uvw, arrow_scaling )
+        self.setArrows()
         self.opengl_widget.setRotationCentre(self.unit_cell.calculateCentreOfMass() )
         self.opengl_widget.setImageSize()
         self.dirty = False
         QApplication.restoreOverrideCursor()
         return
 
+    def setArrows(self):
+        # There is an arrow for each atom showing its displacement in the selected mode
+        UVW = np.array( self.UVW[self.selected_mode] )
+        arrow_scaling = ViewerScene.displacement_scale(UVW, self.settings['Maximum displacement'])
+        self.opengl_widget.setArrows( self.settings['Arrow colour'],self.settings['Arrow radius'], UVW, arrow_scaling )
+
     def setColour(self, element, colour):
         if element == 'Background' or element == 'background':
             self.settings['Background colour'] = colour
@@ -433,44 +457,56 @@ class ViewerTab(QWidget):
             self.settings['Cell colour'] = colour
         elif element == 'Arrow' or element == 'arrow':
             self.settings['Arrow colour'] = colour
+            if self.UVW is not None:
+                self.setArrows()
         else:
             self.element_colours[element] = colour
+        if not ( element == 'Arrow' or element == 'arrow' ):
+            self.updateAppearance()
         self.plot()
 
+    def phasePositions(self, mode):
+        # The positions of the atoms at every phase (nphases, natoms, 3) of a mode
+        # They are kept for the most recently viewed modes, so switching back to a mode is immediate
+        key = (mode, self.settings['Maximum displacement'], self.settings['Number of phase steps'])
+        if key in self.phase_positions_cache:
+            self.phase_positions_cache.move_to_end(key)
+            return self.phase_positions_cache[key]
+        debugger.print('calculate phase positions', mode)
+        positions = ViewerScene.phase_positions(self.XYZ, self.UVW[mode], self.settings['Maximum displacement'], self.settings['Number of phase steps'])
+        self.phase_positions_cache[key] = positions
+        while len(self.phase_positions_cache) > self.phase_positions_cache_size:
+            self.phase_positions_cache.popitem(last=False)
+        return positions
+
     def calculatePhasePositions(self):
         # we need the number of phase steps to be odd
         if self.settings['Number of phase steps']%2 == 0:
             self.settings['Number of phase steps'] += 1
-        UVW = np.array( self.UVW[self.selected_mode] )
-        debugger.print('calculate phase positions')
-        maxR = np.amax(np.abs(UVW))
-        self.scale_vibrations = self.settings['Maximum displacement'] / maxR
-        self.newXYZ       = np.zeros( (self.settings['Number of phase steps'], self.natoms, 3) )
-        sign = +1.0
-        phases = []
-        small = 1.0E-8
-        n2 = int(self.settings['Number of phase steps']/2)
-        delta = 1.0 / float(n2)
-        phases = np.arange(-1.0, 1.0+delta-1.0E-10, delta)
-        for phase_index,phase in enumerate(phases):
-            self.newXYZ[phase_index] = self.XYZ+phase*self.scale_vibrations*UVW
-        # end for phase_index
+        self.scale_vibrations = ViewerScene.displacement_scale(self.UVW[self.selected_mode], self.settings['Maximum displacement'])
+        self.newXYZ = self.phasePositions(self.selected_mode)
         #
         # Store the results in the opengl widget
         #
-        self.opengl_widget.deleteSpheres()
-        self.opengl_widget.deleteCylinders()
-        self.opengl_widget.createArrays(len(phases))
-        for phase_index, phase in enumerate(phases):
-            for col, rad, xyz in zip(self.colours, self.radii, self.newXYZ[phase_index]):
-                self.opengl_widget.addSphere(col, rad, xyz, phase=phase_index )
-            for p in self.cell_corners:
-                self.opengl_widget.addSphere(self.settings['Cell colour'], self.settings['Cell radius'], p, phase=phase_index )
-            for bond in self.unit_cell.bonds:
-                i,j = bond
-                self.opengl_widget.addCylinder(self.settings['Bond colour'], self.settings['Bond radius'], self.newXYZ[phase_index,i], self.newXYZ[phase_index,j], phase=phase_index)
-            for p1,p2 in self.cell_edges:
-                self.opengl_widget.addCylinder(self.settings['Cell colour'], self.settings['Cell radius'], p1, p2, phase=phase_index)
+        scene = ViewerScene.scene_positions(self.newXYZ, self.unit_cell.bonds, self.cell_corners, self.cell_edges)
+        self.opengl_widget.setSpheres(self.appearance['sphere_colours'], self.appearance['sphere_radii'], scene['sphere_positions'])
+        self.opengl_widget.setCylinders(self.appearance['cylinder_colours'], self.appearance['cylinder_radii'], scene['cylinder_positions1'], scene['cylinder_positions2'])
+        return
+
+    def calculateAppearance(self):
+        # The colours and radii of the atoms, bonds and cell, which are the same for every mode
+        covalent_radii = self.notebook.analysisTab.element_radii
+        self.radii = [self.settings['Atom scaling']*covalent_radii[el] for el in self.element_names ]
+        self.colours = [ self.element_colours[el] for el in self.element_names ]
+        return ViewerScene.scene_appearance(self.radii, self.colours, len(self.unit_cell.bonds), self.cell_corners, self.cell_edges, self.settings)
+
+    def updateAppearance(self):
+        # Only the colours and radii have changed, so the phase positions and orientations are kept
+        if self.UVW is None:
+            return
+        self.appearance = self.calculateAppearance()
+        self.opengl_widget.setSphereAppearance(self.appearance['sphere_colours'], self.appearance['sphere_radii'])
+        self.opengl_widget.setCylinderAppearance(self.appearance['cylinder_colours'], self.appearance['cylinder_radii'])
         return
 
     def plot(self):
@@ -513,6 +549,7 @@ class ViewerTab(QWidget):
         self.bond_radius_sb.setValue(self.settings['Bond radius'])
         self.cell_radius_sb.setValue(self.settings['Cell radius'])
         self.maximum_displacement_sb.setValue(self.settings['Maximum displacement'])
+        self.triangle_budget_sb.setValue(self.settings['Triangle budget'])
         self.plottype_cb.setCurrentIndex(self.plot_type_index)
         for index,light in enumerate(self.light_switches):
             if light:
@@ -20,10 +20,86 @@ import math
 import os
 import sys
 import string
+import json
 import numpy as np
-from Python.Constants  import wavenumber, avogadro_si, atomic_number_to_element, amu
+import scipy.linalg
+from multiprocessing import Pool, cpu_count
+from Python.Constants  import wavenumber, avogadro_si, atomic_number_to_element, amu, angstrom
 from Python.Plotter    import print3x3, print_reals, print_strings, print_ints
 from Python.Calculator import cleanup_symbol
+from Python import Calculator
+from Python.EckartProjector import EckartProjector
+from Python.SymmetryAdapted import SymmetryAdaptedBasis
+
+# The number of hessian elements held at once when a sweep over several sets of masses is diagonalised
+mass_sweep_batch_size = 16*1024*1024
+
+def _scan_output_file(calling_parameters):
+    """Find the lines of a file which match the search phrases of a reader
+       This is a module function so that it can be called by a pool of worker processes
+       The calling parameters are the file name, the byte range (start, end) to be scanned and a list of (key, compiled phrase) tuples
+       Only lines starting in the byte range are scanned, so the ranges of a file can be scanned independently
+       The phrases are tested in order and only the first match on a line is recorded, as in _read_output_file
+       A list of (offset, key) tuples is returned, where offset is the byte position of the start of the line"""
+    name, start, end, phrases = calling_parameters
+    index = []
+    if not os.path.isfile(name):
+        return index
+    with open(name, 'rb') as fd:
+        if start > 0:
+            # Move to the first line which starts in the range
+            fd.seek(start-1)
+            fd.readline()
+        offset = fd.tell()
+        while offset < end:
+            bline = fd.readline()
+            if bline == b'':
+                break
+            line = bline.decode('utf-8', 'replace').replace('\r\n', '\n')
+            for key, phrase in phrases:
+                if phrase.match(line):
+                    index.append( (offset, key) )
+                    break
+            offset += len(bline)
+    return index
+
+def _scan_cache_name(name):
+    """The name of the sidecar file used to store the scan index of an output file"""
+    head, tail = os.path.split(name)
+    return os.path.join(head, '.'+tail+'.pdielec_index')
+
+def _read_scan_cache(name, phrases):
+    """Read the scan index of name from its sidecar file
+       The index is only returned if the file size, modification time and search phrases are unchanged, otherwise None is returned"""
+    cache_name = _scan_cache_name(name)
+    if not os.path.isfile(cache_name):
+        return None
+    try:
+        with open(cache_name, 'r') as fd:
+            cache = json.load(fd)
+    except (OSError, ValueError):
+        return None
+    status = os.stat(name)
+    if cache.get('size') != status.st_size or cache.get('mtime') != status.st_mtime:
+        return None
+    if cache.get('phrases') != [ [k, phrase.pattern] for k, phrase in phrases ]:
+        return None
+    return [ (offset, key) for offset, key in cache['index'] ]
+
+def _write_scan_cache(name, phrases, index):
+    """Write the scan index of name to its sidecar file, a failure to write the file is not an error"""
+    status = os.stat(name)
+    cache = {}
+    cache['size']    = status.st_size
+    cache['mtime']   = status.st_mtime
+    cache['phrases'] = [ [k, phrase.pattern] for k, phrase in phrases ]
+    cache['index']   = index
+    try:
+        with open(_scan_cache_name(name), 'w') as fd:
+            json.dump(cache, fd)
+    except OSError:
+        print('Warning unable to write the scan index for ', name, file=sys.stderr)
+    return
 
 class GenericOutputReader:
     """Generic reader of output files.  Actual reader should inherit from this class"""
@@ -67,7 +143,20 @@ class GenericOutputReader:
         self.masses_per_type            = []
         self.program_mass_dictionary    = {}
         self.eckart                     = False
+        # The projector caches the translation (and rotation) vectors for the current masses
+        self.eckart_projector           = EckartProjector()
         self.hessian_symmetrisation     = "symm"
+        # If set to (fmin, fmax) in cm-1, only the modes with frequencies in this range are calculated
+        # None (the default) calculates the full spectrum
+        self.frequency_window           = None
+        # If true the hessian is block diagonalised using the symmetry of the last unit cell
+        # Each mode is then labelled by its irreducible representation and infrared activity
+        self.symmetry_adapted           = False
+        self.symmetry_tolerance         = 1.0E-3
+        self.mode_irreps                = []
+        self.mode_ir_active             = []
+        self._symmetry_key              = None
+        self._symmetry_basis            = None
         self.open_filename              = ""
         self.open_directory             = ""
         self._old_masses                = []
@@ -75,11 +164,82 @@ class GenericOutputReader:
         self.nomass_hessian_has_been_set= False
         self.original_born_charges      = None
         self.original_born_charges_are_being_used = True
+        # If true the files are scanned for the search phrases in parallel before they are parsed
+        self.parallel_reading           = False
+        # Files larger than this (in bytes) are split into ranges which are scanned in parallel
+        self.scan_chunk_size            = 64*1024*1024
+        # If true the scan index of each file is stored in a sidecar file and reused if the file has not changed
+        # Without parallel reading the files which are not in the cache are scanned by this process
+        self.scan_cache                 = False
+        self._scan_pool                 = None
+        self._scan_keys                 = None
+        self._scan_phrases              = []
+        self._scan_results              = {}
         return
 
     def read_output(self):
         """Interface to the private read output files methods"""
         self._read_output_files()
+        if self._scan_pool is not None:
+            self._scan_pool.join()
+            self._scan_pool = None
+        self._scan_keys = None
+        self._scan_results = {}
+        return
+
+    def _scan_index(self, name):
+        """Return the list of (offset, key) tuples of the lines in name which match the search phrases
+           On the first call all the output files are submitted to a pool of processes to be scanned in parallel
+           Large files are split into byte ranges aligned on line boundaries, each range being scanned by a separate process
+           The files are still parsed in the order they are read by _read_output_files
+           None is returned if no scan is available for this file"""
+        keys = tuple(self.manage)
+        if self._scan_keys is None:
+            self._start_scan(keys)
+        # If the search phrases have changed since the scan started the scan cannot be used
+        if keys != self._scan_keys or name not in self._scan_results:
+            return None
+        index, chunks = self._scan_results[name]
+        if index is None:
+            index = []
+            for chunk in chunks:
+                index.extend(chunk.get())
+            if self.scan_cache:
+                _write_scan_cache(name, self._scan_phrases, index)
+            self._scan_results[name] = (index, [])
+        return index
+
+    def _start_scan(self, keys):
+        """Submit the scanning of all the output files to a pool of processes"""
+        self._scan_keys = keys
+        self._scan_phrases = [ (k, self.manage[k][0]) for k in keys ]
+        ranges = []
+        for f in self._outputfiles:
+            if not os.path.isfile(f):
+                continue
+            index = None
+            if self.scan_cache:
+                index = _read_scan_cache(f, self._scan_phrases)
+                if index is None and not self.parallel_reading:
+                    # A worker process cannot start a pool of its own, so the file is scanned here
+                    index = _scan_output_file( (f, 0, os.path.getsize(f)+1, self._scan_phrases) )
+                    _write_scan_cache(f, self._scan_phrases, index)
+            self._scan_results[f] = (index, [])
+            if index is None:
+                size = os.path.getsize(f)
+                nchunks = max(1, min(cpu_count(), size // self.scan_chunk_size))
+                bounds = [ (size * i) // nchunks for i in range(nchunks+1) ]
+                bounds[-1] = size + 1
+                for start, end in zip(bounds[:-1], bounds[1:]):
+                    ranges.append( (f, start, end) )
+        # end for f
+        if len(ranges) == 0:
+            return
+        self._scan_pool = Pool(max(1, min(len(ranges), cpu_count())))
+        for f, start, end in ranges:
+            chunk = self._scan_pool.apply_async(_scan_output_file, ( (f, start, end, self._scan_phrases), ))
+            self._scan_results[f][1].append(chunk)
+        self._scan_pool.close()
         return
 
     def reset_masses(self):
@@ -130,6 +290,66 @@ class GenericOutputReader:
             print("new masses", self.masses)
         return
 
+    def mass_sweep(self, mass_dictionaries):
+        """Calculate the frequencies, oscillator strengths and intensities for several sets of masses
+           mass_dictionaries is a list of dictionaries, each giving the mass of some of the elements
+           Elements not in a dictionary keep their current mass
+           The stored non mass-weighted hessian is reweighted for each set of masses and the
+           hessians are diagonalised together as a stack.  The masses of the reader are not changed.
+           If a frequency window or symmetry adapted diagonalisation has been requested each hessian
+           is diagonalised in turn with them, so the number of modes may differ between the sets.
+           A list with a dictionary for each set of masses is returned, the keys are
+             masses                 the mass of each atom (amu)
+             frequencies            the frequencies (cm-1)
+             normal_modes           the mass weighted normal modes (nmodes, nions, 3)
+             oscillator_strengths   the oscillator strengths (atomic units), ready for the dielectric calculations
+             intensities            the infrared intensities (D/A)^2/amu
+             epsilon_ionic          the ionic permittivity from the modes above 10 cm-1 with an intensity
+             mode_irreps            the irreducible representation of each mode, empty if the symmetry was not used
+             mode_ir_active         whether each mode is infrared active, empty if the symmetry was not used"""
+        if not self.nomass_hessian_has_been_set:
+            self.calculate_mass_weighted_normal_modes()
+        current = self.mass_dictionary()
+        born_charges = np.array(self.born_charges)
+        volume = self.volume*angstrom*angstrom*angstrom
+        mass_sets = []
+        for dictionary in mass_dictionaries:
+            masses_per_type = [ dictionary.get(cleanup_symbol(symbol), current[cleanup_symbol(symbol)]) for symbol in self.species ]
+            mass_sets.append( np.array([ masses_per_type[atype] for atype in self.atom_type_list ]) )
+        nmodes = 3*self.nions
+        batch = max(1, int(mass_sweep_batch_size / (nmodes*nmodes)))
+        results = []
+        for start in range(0, len(mass_sets), batch):
+            hessians = []
+            for masses in mass_sets[start:start+batch]:
+                hessian = self._modify_mass_weighting(self.nomass_hessian, masses*amu)
+                if self.eckart:
+                    xyzs = None
+                    if self.eckart_projector.rotations:
+                        xyzs = self.unit_cells[-1].xyz_coordinates
+                    hessian = self.eckart_projector.project(hessian, masses, xyzs)
+                hessians.append(hessian)
+            if self.frequency_window is None and not self.symmetry_adapted:
+                eig_vals, eig_vecs = np.linalg.eigh(np.array(hessians))
+                solutions = [ (eig_val, eig_vec, [], []) for eig_val, eig_vec in zip(eig_vals, eig_vecs) ]
+            else:
+                solutions = [ self._diagonalise_with_symmetry(hessian, wavenumber, masses) for hessian, masses in zip(hessians, mass_sets[start:start+batch]) ]
+            for masses, (eig_val, eig_vec, mode_irreps, mode_ir_active) in zip(mass_sets[start:start+batch], solutions):
+                mass_weighted_normal_modes = self._modes_from_eigenvectors(eig_vec)
+                normal_modes = Calculator.normal_modes(masses*amu, mass_weighted_normal_modes)
+                frequencies = self._frequencies_from_eigenvalues(eig_val)
+                strengths, intensities, epsilon_ionic, mode_list = Calculator.infrared_properties(normal_modes, born_charges, frequencies*wavenumber, volume,
+                                                                                                  minimum_frequency=10.0*wavenumber, minimum_intensity=1.0E-6)
+                results.append( { 'masses'               : masses.tolist(),
+                                  'frequencies'          : frequencies,
+                                  'normal_modes'         : mass_weighted_normal_modes,
+                                  'oscillator_strengths' : strengths,
+                                  'intensities'          : intensities,
+                                  'epsilon_ionic'        : epsilon_ionic,
+                                  'mode_irreps'          : mode_irreps,
+                                  'mode_ir_active'       : mode_ir_active } )
+        return results
+
     def print_info(self):
         """Print information about the system"""
         # Generic printing of information
@@ -185,6 +405,25 @@ class GenericOutputReader:
         self.open_directory = os.path.dirname(name)
         if self.open_directory == "":
             self.open_directory = "."
+        index = None
+        if self.parallel_reading or self.scan_cache:
+            index = self._scan_index(name)
+        if index is not None:
+            # The matching lines are known, so go straight to each one
+            # A match may already have been read by the method processing an earlier one
+            position = 0
+            for offset, k in index:
+                if offset < position:
+                    continue
+                self.file_descriptor.seek(offset)
+                line = self.file_descriptor.readline()
+                if self.debug:
+                    print('_read_output_file: Match found {}'.format(k))
+                self.manage[k][1](line)
+                position = self.file_descriptor.tell()
+            # end for offset
+            self.file_descriptor.close()
+            return
         # Loop through the contents of the file a line at a time and parse the contents
         line = self.file_descriptor.readline()
         while line != '':
@@ -202,22 +441,24 @@ class GenericOutputReader:
         self.file_descriptor.close()
         return
 
-    def _symmetric_orthogonalisation(self, A):
-        """Private routine to perform symetric orthogonalisation"""
+    def _symmetric_orthogonalisation(self, A, tolerance=1.0E-12):
+        """Private routine to perform symetric (Lowdin) orthogonalisation
+           The closest orthogonal matrix to A is the orthogonal factor of its polar decomposition,
+           which is U.VT where A = U.S.VT is the singular value decomposition of A
+           If A is already orthogonal to within tolerance it is returned unchanged"""
         # The matrix A is only approximately orthogonal
+        A = np.asarray(A, dtype=float)
         n = np.size(A, 0)
-        unity = np.eye(n)
-        Ak = A
-        for k in range(3):
-            Bk = np.dot(Ak, Ak.T)
-            error = unity - Bk
-            Ck = np.linalg.inv(unity + Bk)
-            Kk = np.dot(error, Ck)
-            Ak = np.dot((unity + Kk), Ak)
-            error  = np.sum(np.abs(error))
-            if self.debug:
-                print("Orthogonalisation iteration: ", error)
-        # end for k
+        error = np.max(np.abs(np.dot(A, A.T) - np.eye(n)))
+        if self.debug:
+            print("Orthogonalisation error: ", error)
+        if error < tolerance:
+            return A
+        u, s, vt = np.linalg.svd(A, full_matrices=False)
+        Ak = np.dot(u, vt)
+        if self.debug:
+            print("Orthogonalisation singular values: ", np.min(s), np.max(s))
+            print("Orthogonalisation error after: ", np.max(np.abs(np.dot(Ak, Ak.T) - np.eye(n))))
         return Ak
 
     def calculate_mass_weighted_normal_modes(self):
@@ -236,8 +477,6 @@ class GenericOutputReader:
             print("calculate mass weighted normal modes")
         n = np.size(self.mass_weighted_normal_modes, 0)
         m = np.size(self.mass_weighted_normal_modes, 1)*3
-        nmodes = 3*self.nions
-        UT = np.zeros((n, m))
         frequencies_a = np.array(self.frequencies) * wavenumber
         if self.debug:
             print("frequencies_a",frequencies_a)
@@ -247,27 +486,20 @@ class GenericOutputReader:
             if self.debug:
                 print("hessian was not set")
             self.nomass_hessian_has_been_set = True
-            for imode, mode in enumerate(self.mass_weighted_normal_modes):
-                n = 0
-                for atom in mode:
-                    # in python the first index is the row of the matrix, the second is the column
-                    UT[imode, n+0] = atom[0]
-                    UT[imode, n+1] = atom[1]
-                    UT[imode, n+2] = atom[2]
-                    n = n + 3
-                # end for atom
-            # end for imode
+            # Each row of UT is a mode, flattened to [x1, y1, z1, x2, y2, z2, ...]
+            UT = np.reshape(np.array(self.mass_weighted_normal_modes, dtype=float), (n, m))
             # convert the frequencies^2 to a real diagonal array
             # Warning we have to make sure the sign is correct here
             # The convention is that if the frequency is negative
             # then it is really imaginary, so the square of the frequency
             # will be negative too.
             frequencies_a = np.array(self.frequencies) * wavenumber
-            f2 = np.diag(np.sign(frequencies_a)*np.real(frequencies_a*frequencies_a))
+            f2 = np.sign(frequencies_a)*np.real(frequencies_a*frequencies_a)
             # The back transformation uses approximately orthogonal (unitary) matrices because of rounding issues on reading vectors
             # So before that lets orthogonalise them
             UT = self._symmetric_orthogonalisation(UT)
-            hessian = np.dot(np.dot(UT.T, f2), UT)
+            # UT.T . diag(f2) . UT without forming the diagonal matrix
+            hessian = np.dot(UT.T * f2, UT)
             # Make sure the dynamical matrix is real
             hessian = np.real(hessian)
             # We are going to store the non mass-weighted hessian, since the frequencies came from the MM/QM program
@@ -302,58 +534,32 @@ class GenericOutputReader:
             if self.debug:
                 print("projected hessian", hessian[0:4][0]) 
         # Find its eigenvalues and eigen vectors
-        eig_val, eig_vec = np.linalg.eigh(hessian)
-        self.mass_weighted_normal_modes = []
+        eig_val, eig_vec = self._diagonalise(hessian)
         # Store the new frequencies, using the negative convention for imaginary modes
-        for i in range(nmodes):
-            if eig_val[i] < 0:
-                frequencies_a[i] = -math.sqrt(-eig_val[i]) / wavenumber
-            else:
-                frequencies_a[i] = math.sqrt(eig_val[i]) / wavenumber
-        self.frequencies = frequencies_a.tolist()
+        self.frequencies = self._frequencies_from_eigenvalues(eig_val).tolist()
         if self.debug:
             print("calculated frequencies", self.frequencies)
         # Store the mass weighted normal modes
-        for i in range(nmodes):
-            mode = []
-            n = 0
-            for j in range(self.nions):
-                modea = [eig_vec[n][i], eig_vec[n+1][i], eig_vec[n+2][i]]
-                n = n + 3
-                mode.append(modea)
-            self.mass_weighted_normal_modes.append(mode)
-        # end for i
+        self.mass_weighted_normal_modes = self._modes_from_eigenvectors(eig_vec)
         return self.mass_weighted_normal_modes
 
     def project(self, hessian):
         """Apply projection operators to remove translation
         Take the given matrix (np.array)
-        Project out the translational modes"""
+        Project out the translational modes
+        If eckart_projector.rotations is set the rotations are projected out as well"""
         #
-        new_hessian = np.zeros_like(hessian)
-        nmodes = self.nions*3
-        unit = np.eye(nmodes)
-        p1 = np.zeros(nmodes)
-        p2 = np.zeros(nmodes)
-        p3 = np.zeros(nmodes)
-        for i in range(self.nions):
-            p1[i*3+0] = math.sqrt(self.masses[i])
-            p2[i*3+1] = math.sqrt(self.masses[i])
-            p3[i*3+2] = math.sqrt(self.masses[i])
-        # end for i
-        # Normalise
-        p1 = p1 / math.sqrt(np.dot(p1, p1))
-        p2 = p2 / math.sqrt(np.dot(p2, p2))
-        p3 = p3 / math.sqrt(np.dot(p3, p3))
-        # Form the projection operators
-        P1 = unit - np.outer(p1, p1)
-        P2 = unit - np.outer(p2, p2)
-        P3 = unit - np.outer(p3, p3)
-        # Now project out
-        new_hessian = np.dot(np.dot(P1.T, hessian), P1)
-        new_hessian = np.dot(np.dot(P2.T, new_hessian), P2)
-        new_hessian = np.dot(np.dot(P3.T, new_hessian), P3)
-        return new_hessian
+        xyzs = None
+        if self.eckart_projector.rotations:
+            xyzs = self.unit_cells[-1].xyz_coordinates
+        return self.eckart_projector.project(hessian, self.masses, xyzs)
+
+    def project_vectors(self, vectors):
+        """Project the translational (and if requested rotational) modes out of the rows of vectors"""
+        xyzs = None
+        if self.eckart_projector.rotations:
+            xyzs = self.unit_cells[-1].xyz_coordinates
+        return self.eckart_projector.project_vectors(vectors, self.masses, xyzs)
 
     def _read_till_phrase(self,phrase):
         """Read lines from the current file until a match with phrase is found
@@ -374,7 +580,6 @@ class GenericOutputReader:
             print("_dynamical_matrix")
             print("hessian", hessian[0:4][0]) 
         #
-        nmodes = self.nions*3
         masses = np.array(self.masses)*amu
         if self.debug:
             print("masses", self.masses, masses) 
@@ -400,32 +605,15 @@ class GenericOutputReader:
         if self.debug:
             print("projected hessian", hessian[0:4][0]) 
         # diagonalise
-        eig_val, eig_vec = np.linalg.eigh(hessian)
+        eig_val, eig_vec = self._diagonalise(hessian)
         #
         # If eig_val has negative values then we store the negative frequency
         # convert to cm-1
-        frequencies_a = np.zeros(nmodes)
-        for i, eig in enumerate(eig_val):
-            if eig < 0:
-                frequencies_a[i] = -math.sqrt(-eig) / wavenumber
-            else:
-                frequencies_a[i] = math.sqrt(eig) / wavenumber
-            # end if
-        # end for
-        self.mass_weighted_normal_modes = []
-        self.frequencies = frequencies_a.tolist()
+        self.frequencies = self._frequencies_from_eigenvalues(eig_val).tolist()
         if self.debug:
             print("frequencies", self.frequencies) 
         # Store the mass weighted normal modes
-        for i in range(nmodes):
-            mode = []
-            n = 0
-            for j in range(self.nions):
-                modea = [eig_vec[n][i], eig_vec[n+1][i], eig_vec[n+2][i]]
-                n = n + 3
-                mode.append(modea)
-            self.mass_weighted_normal_modes.append(mode)
-        # end for i
+        self.mass_weighted_normal_modes = self._modes_from_eigenvectors(eig_vec)
         if self.debug:
             print("non mass weighted hessian", self.nomass_hessian[0:4][0]) 
         return
@@ -453,42 +641,88 @@ class GenericOutputReader:
         self.born_charges = new_born_charges.tolist()
         return
 
+    def _diagonalise(self, hessian, unit=wavenumber):
+        """Diagonalise the mass weighted hessian, returning the eigenvalues and eigenvectors
+           If requested the hessian is block diagonalised using the symmetry of the cell,
+           if this is not possible the dense solver is used.
+           unit converts a frequency in cm-1 to the units of the hessian"""
+        eig_val, eig_vec, self.mode_irreps, self.mode_ir_active = self._diagonalise_with_symmetry(hessian, unit, self.masses)
+        return eig_val, eig_vec
+
+    def _diagonalise_with_symmetry(self, hessian, unit, masses):
+        """Diagonalise the mass weighted hessian of atoms with the given masses (amu)
+           Returns the eigenvalues, the eigenvectors, and the irreducible representation and infrared activity of each mode
+           The irreducible representations are empty lists if the symmetry was not used"""
+        if self.symmetry_adapted:
+            basis = self._symmetry_adapted_basis(masses)
+            if basis is not None:
+                result = basis.diagonalise(hessian, lambda block: self._eigh(block, unit))
+                if result is not None:
+                    return result
+            if self.debug:
+                print('Symmetry adapted diagonalisation was not possible, using the full hessian')
+        eig_val, eig_vec = self._eigh(hessian, unit)
+        return eig_val, eig_vec, [], []
+
+    def _symmetry_adapted_basis(self, masses=None):
+        """Return the symmetry adapted basis for the last unit cell, or None if it cannot be found
+           Atoms are only treated as equivalent if they have the same element and mass, by default the masses of the reader
+           The basis is kept until the cell or the masses change"""
+        if masses is None:
+            masses = self.masses
+        masses = list(masses)
+        if len(self.unit_cells) == 0:
+            return None
+        cell = self.unit_cells[-1]
+        if len(cell.fractional_coordinates) != self.nions or len(cell.element_names) != self.nions or len(masses) != self.nions:
+            return None
+        species = sorted(set(zip(cell.element_names, masses)))
+        types = [ species.index(s) for s in zip(cell.element_names, masses) ]
+        key = ( np.array(cell.lattice).tobytes(), np.array(cell.fractional_coordinates).tobytes(), tuple(types), self.symmetry_tolerance )
+        if key != self._symmetry_key:
+            self._symmetry_key = key
+            self._symmetry_basis = None
+            operations = cell.symmetry_operations(types, self.symmetry_tolerance)
+            if operations:
+                basis = SymmetryAdaptedBasis(operations, debug=self.debug)
+                if basis.valid:
+                    self._symmetry_basis = basis
+        return self._symmetry_basis
+
+    def _eigh(self, hessian, unit):
+        """Diagonalise a symmetric matrix, only returning the eigenpairs inside the frequency window if one has been set"""
+        if self.frequency_window is None:
+            return np.linalg.eigh(hessian)
+        # Convert the window to eigenvalues, using the negative convention for imaginary modes
+        fmin, fmax = self.frequency_window
+        emin = math.copysign((fmin*unit)**2, fmin)
+        emax = math.copysign((fmax*unit)**2, fmax)
+        if self.debug:
+            print("frequency window", fmin, fmax, emin, emax)
+        # The LAPACK subset selection returns the eigenvalues in the half open interval (emin, emax]
+        return scipy.linalg.eigh(hessian, subset_by_value=(emin, emax), driver='evr')
+
+    def _frequencies_from_eigenvalues(self, eig_val):
+        """Convert the eigenvalues of the mass weighted hessian to frequencies in cm-1
+           Negative eigenvalues are returned as negative (imaginary) frequencies"""
+        return np.sign(eig_val) * np.sqrt(np.abs(eig_val)) / wavenumber
+
+    def _modes_from_eigenvectors(self, eig_vec):
+        """Convert the columns of the eigenvector matrix to an array of normal modes
+           The returned array is contiguous with shape (nmodes, nions, 3)"""
+        nmodes = np.size(eig_vec, 1)
+        return np.ascontiguousarray(np.reshape(eig_vec.T, (nmodes, self.nions, 3)))
+
     def _modify_mass_weighting(self,hessian,new):
         #
         # Mass weight defined in new
         #
-        ipos = -1
-        new_hessian = np.empty_like(hessian)
-        for i in range(self.nions):
-            for ix in range(3):
-                ipos += 1
-                jpos = -1
-                for j in range(self.nions):
-                    for jx in range(3):
-                        jpos += 1
-                        new_hessian[ipos,jpos] = hessian[ipos,jpos] / math.sqrt(  new[i]*new[j] )
-                    # end for jx
-                # end for j
-            # end for ix
-        # end for i
-        return new_hessian
+        masses = np.repeat(np.array(new, dtype=float), 3)
+        return hessian / np.sqrt(np.outer(masses, masses))
 
     def _remove_mass_weighting(self,hessian,old):
         #
         # Remove the mass weighting imposed by the QM/MM program - defined in old
         #
-        new_hessian = np.empty_like(hessian)
-        ipos = -1
-        for i in range(self.nions):
-            for ix in range(3):
-                ipos += 1
-                jpos = -1
-                for j in range(self.nions):
-                    for jx in range(3):
-                        jpos += 1
-                        new_hessian[ipos,jpos] = hessian[ipos,jpos] * math.sqrt( old[i]*old[j] )
-                    # end for jx
-                # end for j
-            # end for ix
-        # end for i
-        return new_hessian
+        masses = np.repeat(np.array(old, dtype=float), 3)
+        return hessian * np.sqrt(np.outer(masses, masses))
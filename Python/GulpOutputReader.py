@@ -137,6 +137,7 @@ class GulpOutputReader(GenericOutputReader):
                 self.mass_weighted_normal_modes.append(mode)
             line = self.file_descriptor.readline()
             line = self.file_descriptor.readline()
+        self.mass_weighted_normal_modes = np.array(self.mass_weighted_normal_modes, dtype=float)
 
     def _read_total_number_of_atoms(self, line):
         """Read the number of atoms"""
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+#
+# Copyright 2015 John Kendrick
+#
+# This file is part of PDielec
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the MIT License
+# along with this program, if not see https://opensource.org/licenses/MIT
+#
+"""Write movies from frames held in memory
+
+   The frames are numpy arrays (height, width, 3) of uint8.
+   They are passed through a bounded queue to a thread which encodes them,
+   so that rendering the next frame overlaps with encoding the last one.
+   ffmpeg is only looked for locally, it is never downloaded."""
+from __future__ import print_function
+import os
+import shutil
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def find_ffmpeg():
+    """Return the path of a locally available ffmpeg, or None if there is none
+       The IMAGEIO_FFMPEG_EXE environment variable is tried first,
+       then the executable bundled with imageio-ffmpeg and finally the PATH"""
+    executable = os.environ.get('IMAGEIO_FFMPEG_EXE')
+    if executable:
+        if os.path.isfile(executable):
+            return executable
+        executable = shutil.which(executable)
+        if executable is not None:
+            return executable
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        pass
+    return shutil.which('ffmpeg')
+
+
+class MovieWriter:
+    """Encode frames into a movie on a separate thread
+
+       filename    the movie file, the extension (.mp4, .avi or .gif) determines the format
+       fps         the frames per second
+       queue_size  the number of frames which can wait to be encoded, append() blocks when the queue is full"""
+    def __init__(self, filename, fps=24, queue_size=8):
+        import imageio
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in ('.mp4', '.avi'):
+            executable = find_ffmpeg()
+            if executable is None:
+                raise RuntimeError('ffmpeg could not be found, install imageio-ffmpeg or set IMAGEIO_FFMPEG_EXE')
+            os.environ['IMAGEIO_FFMPEG_EXE'] = executable
+        self._writer = imageio.get_writer(filename, mode='I', fps=fps)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._encode)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _encode(self):
+        """Encode frames until the end of the movie is signalled by None"""
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                return
+            # After an error keep emptying the queue, so that append() does not block
+            if self._error is None:
+                try:
+                    self._writer.append_data(frame)
+                except Exception as error:
+                    self._error = error
+
+    def append(self, frame):
+        """Add a frame to the movie, the frame must not be changed afterwards"""
+        if self._error is not None:
+            raise self._error
+        self._queue.put(frame)
+
+    def close(self):
+        """Wait for all the frames to be encoded and close the movie"""
+        self._queue.put(None)
+        self._thread.join()
+        self._writer.close()
+        if self._error is not None:
+            raise self._error
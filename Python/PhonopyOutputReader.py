@@ -15,10 +15,13 @@
 # along with this program, if not see https://opensource.org/licenses/MIT
 #
 """Read the contents of a directory containg Phonopy input and output files"""
+from __future__ import print_function
 import re
 import os
+import sys
 import math
 import numpy as np
+from multiprocessing import Pool
 from Python.UnitCell import UnitCell
 from Python.GenericOutputReader import GenericOutputReader
 from Python.Constants import wavenumber
@@ -40,6 +43,14 @@ class PhonopyOutputReader(GenericOutputReader):
         self.qmreader.eckart = self.eckart
         self.qmreader.hessian_symmetrisation = self.hessian_symmetrisation
         self.qmreader.debug = self.debug
+        self.qmreader.parallel_reading = self.parallel_reading
+        self.qmreader.scan_chunk_size = self.scan_chunk_size
+        self.qmreader.scan_cache = self.scan_cache
+        # The phonopy files are independent of the qm files so they can be read at the same time
+        if self.parallel_reading:
+            pool = Pool(1)
+            phonopy_result = pool.apply_async(read_phonopy_hessian, (self._outputfiles, ))
+            pool.close()
         # trigger the reading of the qm files
         self.qmreader.read_output()
         # We don't call self._read_outputfile as this starts looking for keywords
@@ -72,64 +83,238 @@ class PhonopyOutputReader(GenericOutputReader):
         self.zerof_optical_dielectric= self.qmreader.zerof_optical_dielectric
         self.zerof_static_dielectric = self.qmreader.zerof_static_dielectric
         # Calculate dynamical matrix
-        self.read_dynamical_matrix()
+        if self.parallel_reading:
+            masses, hessian = phonopy_result.get()
+            pool.join()
+            self._phonopy_normal_modes(masses, hessian)
+        else:
+            self.read_dynamical_matrix()
         return
 
     def read_dynamical_matrix(self):
-        #
-        # Yaml imports of large files are really slow....
-        # Attempt to use the PyYaml C parser, using yaml.CLoader
-        #
-        import yaml
-        try: 
-            from yaml import CLoader as Loader
-        except:
-            print("WARNING: Yaml CLoader is not avaiable, using fallback")
-            from yaml import Loader as Loader
-        # the first name has to be the qpoints file
-        fd = open(self._outputfiles[0])
-        data_q = yaml.load(fd, Loader=Loader)
-        fd.close
-        # the second name has to be the phonopy file
-        fd = open(self._outputfiles[1])
-        data_p = yaml.load(fd, Loader=Loader)
-        fd.close
-        self._old_masses = []
-        for i in range(self.nions):
-            self._old_masses.append(data_p['primitive_cell']['points'][i]['mass'])
-        qpoints = data_q['phonon'][0]['q-position']
-        # print('q-points',qpoints)
-        natom = data_q['natom']
-        # print('natom:',natom)
-        dynmat = []
-        dynmat_data = data_q['phonon'][0]['dynamical_matrix']
-        for row in dynmat_data:
-            vals = np.reshape(row, (-1, 2))
-            dynmat.append(vals[:, 0] + vals[:, 1] * 1j)
-        dynmat = np.array(dynmat)
-        # Make sure the hessian is real
-        hessian = np.real(dynmat)
-        # We need to convert to cm-1
-        conversion_factor_to_THz = 15.633302
-        conversion_factor_to_cm1 = conversion_factor_to_THz * 33.35641
-        conv  = conversion_factor_to_cm1 
-        hessian = hessian * conv * conv
+        """Read the gamma point dynamical matrix and calculate the frequencies and normal modes"""
+        masses, hessian = read_phonopy_hessian(self._outputfiles)
+        self._phonopy_normal_modes(masses, hessian)
+        return
+
+    def _phonopy_normal_modes(self, masses, hessian):
+        """Diagonalise the phonopy dynamical matrix and store the frequencies and normal modes
+           masses  are the primitive cell masses from phonopy.yaml
+           hessian is the dynamical matrix in cm-1 squared"""
+        self._old_masses = masses.tolist()
         # Find its eigenvalues and eigen vectors
-        eig_val, eig_vec = np.linalg.eigh(hessian)
-        self.mass_weighted_normal_modes = []
-        nmodes = 3*self.nions
+        eig_val, eig_vec = self._diagonalise(hessian, unit=1.0)
         # Store the new frequencies, using the negative convention for imaginary modes
         frequencies_a = np.sqrt(np.abs(eig_val.real)) * np.sign(eig_val.real)
         self.frequencies = frequencies_a.tolist()
         # Store the mass weighted normal modes
-        for i in range(nmodes):
-            mode = []
-            n = 0
-            for j in range(self.nions):
-                modea = [eig_vec[n][i], eig_vec[n+1][i], eig_vec[n+2][i]]
-                n = n + 3
-                mode.append(modea)
-            self.mass_weighted_normal_modes.append(mode)
-        # end for i
+        self.mass_weighted_normal_modes = self._modes_from_eigenvectors(eig_vec)
         return
 
+
+def read_phonopy_hessian(filenames):
+    """Read the gamma point dynamical matrix of a phonopy calculation
+       This is a module function so that it can be called by a worker process
+       The first file name is the source of the dynamical matrix, it can be one of
+       qpoints.yaml, qpoints.hdf5, FORCE_CONSTANTS or force_constants.hdf5
+       The second file name has to be the phonopy.yaml file
+       The primitive cell masses and the real dynamical matrix in cm-1 squared are returned"""
+    phonopy_structure = _read_phonopy_structure(filenames[1])
+    masses = phonopy_structure['primitive_cell']['masses']
+    source = os.path.basename(filenames[0])
+    if source.endswith('.yaml'):
+        natom, dynmat = _read_qpoints_yaml(filenames[0])
+        hessian = np.real(dynmat)
+    elif source == 'qpoints.hdf5':
+        dynmat = _read_qpoints_hdf5(filenames[0], len(masses))
+        hessian = np.real(dynmat)
+    else:
+        # The force constants are for the supercell, so need to be folded back to the primitive cell
+        if source.endswith('.hdf5'):
+            force_constants, p2s_map = _read_force_constants_hdf5(filenames[0])
+        else:
+            force_constants, p2s_map = _read_force_constants(filenames[0])
+        hessian = _gamma_dynamical_matrix(force_constants, p2s_map, phonopy_structure)
+    # We need to convert to cm-1
+    conversion_factor_to_THz = 15.633302
+    conversion_factor_to_cm1 = conversion_factor_to_THz * 33.35641
+    conv  = conversion_factor_to_cm1 
+    hessian = hessian * conv * conv
+    return masses, hessian
+
+
+# The files which can provide the phonopy dynamical matrix, in order of preference
+phonopy_dynamical_matrix_files = ['qpoints.hdf5', 'qpoints.yaml', 'force_constants.hdf5', 'FORCE_CONSTANTS']
+
+
+def phonopy_dynamical_matrix_file(directory):
+    """Return the name of the file in directory which will provide the phonopy dynamical matrix
+       The files are searched for in the order of phonopy_dynamical_matrix_files
+       If none of them are present the name of the qpoints.yaml file is returned"""
+    for name in phonopy_dynamical_matrix_files:
+        filename = os.path.join(directory, name)
+        if os.path.isfile(filename):
+            return filename
+    return os.path.join(directory, 'qpoints.yaml')
+
+
+def _yaml_vector(line):
+    """Convert a yaml flow sequence such as '- [ 1.0, 2.0, 3.0 ] # a' to a numpy array"""
+    text = line[line.index('[')+1:line.index(']')]
+    return np.array(text.split(','), dtype=float)
+
+
+def _read_qpoints_yaml(filename):
+    """Read the dynamical matrix of the first q-point from a phonopy qpoints.yaml file
+       The file is read as a stream and reading stops as soon as the first dynamical matrix has been read
+       Returns the number of atoms and the complex dynamical matrix"""
+    natom = 0
+    rows = []
+    with open(filename, 'r') as fd:
+        for line in fd:
+            if line.startswith('natom:'):
+                natom = int(line.split()[1])
+            elif line.strip() == 'dynamical_matrix:':
+                break
+        # end for line
+        # Each row of the matrix is a yaml flow sequence, usually on one line
+        # the rows are gathered as text and converted by numpy in one go
+        for line in fd:
+            text = line.strip()
+            if not text.startswith('- ['):
+                break
+            while not text.endswith(']'):
+                text = text + fd.readline().strip()
+            rows.append(text[text.index('[')+1:-1])
+        # end for line
+    # end with
+    if len(rows) == 0:
+        print('Error: no dynamical matrix found in ', filename, file=sys.stderr)
+        print('       phonopy needs to be run with WRITEDM = .TRUE.', file=sys.stderr)
+        return natom, np.zeros((3*natom, 3*natom), dtype=complex)
+    values = np.array(','.join(rows).split(','), dtype=float)
+    n = len(rows)
+    values = np.reshape(values, (n, n, 2))
+    dynmat = values[:, :, 0] + values[:, :, 1] * 1j
+    return natom, dynmat
+
+
+def _read_qpoints_hdf5(filename, natom):
+    """Read the dynamical matrix of the first q-point from a phonopy qpoints.hdf5 file
+       natom is the number of atoms in the primitive cell, it is used if there is no dynamical matrix"""
+    try:
+        import h5py
+    except ImportError:
+        print('Error: h5py is needed to read ', filename, file=sys.stderr)
+        raise
+    with h5py.File(filename, 'r') as fd:
+        if 'dynamical_matrix' not in fd:
+            print('Error: no dynamical matrix found in ', filename, file=sys.stderr)
+            print('       phonopy needs to be run with WRITEDM = .TRUE.', file=sys.stderr)
+            return np.zeros((3*natom, 3*natom), dtype=complex)
+        # Only the first q-point is read from the file
+        dynmat = np.array(fd['dynamical_matrix'][0])
+    return dynmat
+
+
+def _read_force_constants(filename):
+    """Read a phonopy FORCE_CONSTANTS file
+       Returns the force constants as an array (n1, n2, 3, 3) and the supercell index of each of the n1 rows
+       Both the full (n1 = n2) and the compact (n1 = number of primitive atoms) formats are handled"""
+    with open(filename, 'r') as fd:
+        header = fd.readline().split()
+        n1 = int(header[0])
+        n2 = int(header[-1])
+        # Each block is a line of two atom indices followed by a 3x3 matrix
+        values = np.array(fd.read().split(), dtype=float)
+    values = np.reshape(values, (n1, n2, 11))
+    p2s_map = values[:, 0, 0].astype(int) - 1
+    force_constants = np.reshape(values[:, :, 2:], (n1, n2, 3, 3))
+    return force_constants, p2s_map
+
+
+def _read_force_constants_hdf5(filename):
+    """Read a phonopy force_constants.hdf5 file
+       Returns the force constants as an array (n1, n2, 3, 3) and the supercell index of each of the n1 rows"""
+    try:
+        import h5py
+    except ImportError:
+        print('Error: h5py is needed to read ', filename, file=sys.stderr)
+        raise
+    with h5py.File(filename, 'r') as fd:
+        force_constants = np.array(fd['force_constants'])
+        if 'p2s_map' in fd:
+            p2s_map = np.array(fd['p2s_map'], dtype=int)
+        else:
+            p2s_map = np.arange(force_constants.shape[0])
+    return force_constants, p2s_map
+
+
+def _gamma_dynamical_matrix(force_constants, p2s_map, phonopy_structure):
+    """Fold the supercell force constants into the gamma point dynamical matrix of the primitive cell
+       force_constants   is the (n1, n2, 3, 3) array of force constants in eV/A2
+       p2s_map           gives the supercell index of each of the n1 rows
+       phonopy_structure is the dictionary returned by _read_phonopy_structure
+       The dynamical matrix is returned in eV/A2/amu as a (3*nprim, 3*nprim) array"""
+    primitive = phonopy_structure['primitive_cell']
+    supercell = phonopy_structure['supercell']
+    masses = primitive['masses']
+    nprim = len(masses)
+    # Map every supercell atom onto an atom of the primitive cell
+    xyz = np.dot(supercell['coordinates'], supercell['lattice'])
+    abc = np.dot(xyz, np.linalg.inv(primitive['lattice']))
+    difference = abc[:, np.newaxis, :] - primitive['coordinates'][np.newaxis, :, :]
+    difference = difference - np.rint(difference)
+    distance = np.linalg.norm(np.dot(difference, primitive['lattice']), axis=2)
+    s2p_map = np.argmin(distance, axis=1)
+    # Sum the force constants over all the images of each primitive atom
+    images = np.zeros((len(s2p_map), nprim))
+    images[np.arange(len(s2p_map)), s2p_map] = 1.0
+    if force_constants.shape[0] == force_constants.shape[1]:
+        # For a full set of force constants pick the first supercell atom of each primitive atom
+        rows = [ np.where(s2p_map == p)[0][0] for p in range(nprim) ]
+    else:
+        rows = [ list(s2p_map[p2s_map]).index(p) for p in range(nprim) ]
+    folded = np.einsum('pjab,jq->paqb', force_constants[rows], images)
+    sqrt_masses = np.sqrt(np.repeat(masses, 3))
+    dynmat = np.reshape(folded, (3*nprim, 3*nprim)) / np.outer(sqrt_masses, sqrt_masses)
+    return dynmat
+
+
+def _read_phonopy_structure(filename):
+    """Read the primitive cell and supercell from a phonopy.yaml file
+       The file is read as a stream so only the lines describing the cells are processed
+       A dictionary is returned with keys 'primitive_cell' and 'supercell'
+       each entry is a dictionary with the lattice, fractional coordinates and masses as numpy arrays"""
+    structure = {}
+    section = None
+    subsection = None
+    with open(filename, 'r') as fd:
+        for line in fd:
+            if line.strip() == '':
+                continue
+            if not line.startswith(' '):
+                # A new top level entry
+                section = line.split(':')[0].strip()
+                subsection = None
+                if section in ['primitive_cell', 'supercell']:
+                    structure[section] = {'lattice': [], 'coordinates': [], 'masses': []}
+                continue
+            if section not in structure:
+                continue
+            text = line.strip()
+            if text.endswith(':') or text.startswith('reciprocal_lattice'):
+                subsection = text.split(':')[0]
+            elif subsection == 'lattice' and text.startswith('- ['):
+                structure[section]['lattice'].append(_yaml_vector(text))
+            elif subsection == 'points' and text.startswith('coordinates:'):
+                structure[section]['coordinates'].append(_yaml_vector(text))
+            elif subsection == 'points' and text.startswith('mass:'):
+                structure[section]['masses'].append(float(text.split()[1]))
+            # end if
+        # end for line
+    # end with
+    for cell in structure.values():
+        for key in cell:
+            cell[key] = np.array(cell[key])
+    return structure
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+#
+# Copyright 2015 John Kendrick
+#
+# This file is part of PDielec
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the MIT License
+# along with this program, if not see https://opensource.org/licenses/MIT
+#
+"""A cache of the results of reading output files, shared by preader and p2cif
+
+   The cache is a file of json entries, one per line, each holding the results of one file.
+   An entry is keyed by the name of the file and a json string of the options used to process it,
+   so the two programs (or one program with different options) can share a cache file.
+   The size and modification time of every file read to produce the result (the named file and its
+   companions, such as a QE log file or the phonopy files next to an OUTCAR) are kept with each entry,
+   and a cached result is only used if none of these files has changed, appeared or disappeared since it was cached."""
+from __future__ import print_function
+import os
+import json
+
+
+def file_signature(name):
+    """The size and modification time of a file, used to decide if a cached result is still valid"""
+    status = os.stat(name)
+    return [ status.st_size, status.st_mtime ]
+
+
+def file_signatures(names):
+    """The signature of each of the files in names, None for a file which does not exist
+       Recording the missing files means a companion file which appears later also invalidates a result"""
+    signatures = {}
+    for name in names:
+        if os.path.isfile(name):
+            signatures[name] = file_signature(name)
+        else:
+            signatures[name] = None
+    return signatures
+
+
+def read_cache(cachefile):
+    """Read the results cache
+       Returns a dictionary of the entries keyed by (name, options)
+       Later entries replace earlier ones, an incomplete last line (from a crash) is ignored"""
+    cache = {}
+    if not os.path.isfile(cachefile):
+        return cache
+    with open(cachefile,'r') as fd:
+        for line in fd:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            cache[(entry['name'],entry['options'])] = entry
+    return cache
+
+
+def cached_entry(cache, name, options, required='record'):
+    """Return the entry for name and options if it is still valid and holds required, otherwise None
+       An entry is only valid if none of the files it was read from has changed
+       Entries written before the companion files were recorded are not used"""
+    entry = cache.get( (name,options) )
+    if entry is None or required not in entry or 'files' not in entry:
+        return None
+    if entry['signature'] != file_signature(name):
+        return None
+    if entry['files'] != file_signatures(entry['files']):
+        return None
+    return entry
+
+
+def append_entry(fd, name, options, files, **results):
+    """Append the results of a file to the open cache file fd
+       files are the signatures of all the files read to produce the results, as returned by file_signatures()
+       The entry is flushed straight away, so the results survive if the program is stopped"""
+    entry = { 'name':name, 'options':options, 'signature':file_signature(name), 'files':files }
+    entry.update(results)
+    print(json.dumps(entry),file=fd)
+    fd.flush()
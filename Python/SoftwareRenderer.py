@@ -0,0 +1,203 @@
+#!/usr/bin/python
+#
+# Copyright 2015 John Kendrick
+#
+# This file is part of PDielec
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the MIT License
+# along with this program, if not see https://opensource.org/licenses/MIT
+#
+"""Render a scene described by ViewerScene without a display
+
+   The spheres and cylinders are ray cast analytically into a z-buffer using numpy, so no OpenGL
+   context (or X server) is needed and the renderer can run in worker processes.
+   The view, projection and lighting follow the default view of the OpenGL widget of the viewer tab;
+   an orthographic projection looking down the z axis, lit by the first two lights."""
+from __future__ import print_function
+import numpy as np
+
+# The material and light factors used by the OpenGL widget
+diffuse_material_factor  = 0.9
+ambient_material_factor  = 0.4
+specular_material_factor = 1.0
+glint_material_factor    = 100.0
+diffuse_light_factor     = 0.8
+ambient_light_factor     = 0.6
+specular_light_factor    = 1.0
+# The directions of the lights which are switched on by default
+light_directions = np.array( [ [-1.0, 1.0, 1.0], [ 1.0,-1.0, 1.0] ] ) / np.sqrt(3.0)
+
+
+class SoftwareRenderer:
+    """Render spheres, cylinders and arrows into an rgb image
+
+       width, height  the size of the image in pixels
+       background     the rgba background colour 0-255
+       supersample    each pixel is the average of supersample*supersample samples"""
+    def __init__(self, width=800, height=800, background=(120,120,120,255), supersample=2):
+        self.width = width
+        self.height = height
+        self.supersample = supersample
+        self.background = np.array(background[0:3], dtype=float) / 255.0
+        self.rotation_centre = np.zeros(3)
+        self.image_size = 15.0
+        self.clear()
+
+    def setView(self, rotation_centre, image_size):
+        """The image is centred on rotation_centre and shows everything within image_size of it"""
+        self.rotation_centre = np.array(rotation_centre, dtype=float)
+        self.image_size = image_size
+        # The half width and height of the orthographic projection, as in the OpenGL widget
+        smallest = min(self.width, self.height)
+        self.orthox = 1.1 * image_size * self.width  / smallest
+        self.orthoy = 1.1 * image_size * self.height / smallest
+
+    def clear(self):
+        """Start a new image"""
+        nx = self.width * self.supersample
+        ny = self.height * self.supersample
+        self.depth   = np.full( (ny, nx), -np.inf )
+        self.normals = np.zeros( (ny, nx, 3) )
+        self.colours = np.zeros( (ny, nx, 3) )
+        self.setView(self.rotation_centre, self.image_size)
+
+    def _pixels(self, lower, upper):
+        """The pixel indices and the scene x,y coordinates of the pixel centres within a box in the scene
+           Returns the column indices, the row indices and the x and y coordinates"""
+        nx = self.width * self.supersample
+        ny = self.height * self.supersample
+        dx = 2.0 * self.orthox / nx
+        dy = 2.0 * self.orthoy / ny
+        x0 = self.rotation_centre[0] - self.orthox
+        y0 = self.rotation_centre[1] + self.orthoy
+        i1 = max(int(np.floor((lower[0] - x0) / dx)), 0)
+        i2 = min(int(np.ceil((upper[0] - x0) / dx)) + 1, nx)
+        j1 = max(int(np.floor((y0 - upper[1]) / dy)), 0)
+        j2 = min(int(np.ceil((y0 - lower[1]) / dy)) + 1, ny)
+        columns = np.arange(i1, i2)
+        rows = np.arange(j1, j2)
+        x = x0 + (columns + 0.5) * dx
+        y = y0 - (rows + 0.5) * dy
+        return columns, rows, x, y
+
+    def _store(self, rows, columns, hit, z, normals, colour):
+        """Keep the hits which are nearer than anything already drawn"""
+        depth = self.depth[rows[0]:rows[-1]+1, columns[0]:columns[-1]+1]
+        nearer = hit & (z > depth)
+        if not np.any(nearer):
+            return
+        depth[nearer] = z[nearer]
+        self.normals[rows[0]:rows[-1]+1, columns[0]:columns[-1]+1][nearer] = normals[nearer]
+        self.colours[rows[0]:rows[-1]+1, columns[0]:columns[-1]+1][nearer] = colour
+
+    def drawSphere(self, colour, radius, position):
+        """Draw a sphere, colour is rgb 0-1"""
+        position = np.asarray(position, dtype=float)
+        columns, rows, x, y = self._pixels(position - radius, position + radius)
+        if len(columns) == 0 or len(rows) == 0:
+            return
+        dx, dy = np.meshgrid(x - position[0], y - position[1])
+        r2 = radius*radius - dx*dx - dy*dy
+        hit = r2 >= 0.0
+        dz = np.sqrt(np.where(hit, r2, 0.0))
+        normals = np.stack( (dx, dy, dz), axis=-1 ) / radius
+        self._store(rows, columns, hit, position[2] + dz, normals, colour)
+
+    def drawCylinder(self, colour, radius, start, end):
+        """Draw an open cylinder from start to end, colour is rgb 0-1"""
+        start = np.asarray(start, dtype=float)
+        end = np.asarray(end, dtype=float)
+        axis = end - start
+        length = np.sqrt(np.dot(axis, axis))
+        if length <= 0.0:
+            return
+        u = axis / length
+        columns, rows, x, y = self._pixels(np.minimum(start, end) - radius, np.maximum(start, end) + radius)
+        if len(columns) == 0 or len(rows) == 0:
+            return
+        # The ray through a pixel is p = w + t v, with v the viewing direction (towards the viewer)
+        # and w the point on the ray with z equal to the start of the cylinder
+        v = np.array( [0.0, 0.0, 1.0] )
+        vp = v - u[2]*u
+        a = np.dot(vp, vp)
+        if a < 1.0E-12:
+            # The cylinder is viewed end on, only its rim is seen
+            return
+        wx, wy = np.meshgrid(x - start[0], y - start[1])
+        s0 = wx*u[0] + wy*u[1]
+        wpx = wx - s0*u[0]
+        wpy = wy - s0*u[1]
+        wpz = -s0*u[2]
+        b = wpx*vp[0] + wpy*vp[1] + wpz*vp[2]
+        c = wpx*wpx + wpy*wpy + wpz*wpz - radius*radius
+        discriminant = b*b - a*c
+        hit = discriminant >= 0.0
+        # The larger root is the surface nearest the viewer
+        t = (-b + np.sqrt(np.where(hit, discriminant, 0.0))) / a
+        s = s0 + t*u[2]
+        hit = hit & (s >= 0.0) & (s <= length)
+        # The normal is the part of the hit point, relative to the start, perpendicular to the axis
+        normals = np.stack( (wx - s*u[0], wy - s*u[1], t - s*u[2]), axis=-1 ) / radius
+        self._store(rows, columns, hit, start[2] + t, normals, colour)
+
+    def drawCone(self, colour, radius1, radius2, start, end):
+        """Draw a truncated cone from start (radius1) to end (radius2) as a stack of short cylinders"""
+        start = np.asarray(start, dtype=float)
+        end = np.asarray(end, dtype=float)
+        steps = 4
+        for k in range(steps):
+            f1 = float(k) / steps
+            f2 = float(k+1) / steps
+            radius = radius1 + (radius2 - radius1) * (f1 + f2) * 0.5
+            self.drawCylinder(colour, radius, start + f1*(end - start), start + f2*(end - start))
+
+    def drawScene(self, scene, phase):
+        """Draw the spheres and cylinders of a ViewerScene at a phase"""
+        for colour, radius, position in zip(scene['sphere_colours'], scene['sphere_radii'], scene['sphere_positions'][phase]):
+            self.drawSphere(np.asarray(colour[0:3], dtype=float)/255.0, radius, position)
+        for colour, radius, position1, position2 in zip(scene['cylinder_colours'], scene['cylinder_radii'],
+                                                        scene['cylinder_positions1'][phase], scene['cylinder_positions2'][phase]):
+            self.drawCylinder(np.asarray(colour[0:3], dtype=float)/255.0, radius, position2, position1)
+
+    def drawArrows(self, colour, radius, positions, directions, scale):
+        """Draw an arrow from each position along its direction, as the OpenGL widget does
+           The head of the arrow is 0.1 long and twice the radius of the shaft"""
+        colour = np.asarray(colour[0:3], dtype=float)/255.0
+        for position, direction in zip(positions, directions):
+            length = np.sqrt(np.dot(direction, direction))
+            if length <= 0.0:
+                continue
+            u = np.asarray(direction, dtype=float) / length
+            tip = position + length*scale*u
+            self.drawCylinder(colour, radius, position, tip)
+            self.drawCone(colour, 2.0*radius, 0.1*radius, tip, tip + 0.1*u)
+
+    def image(self):
+        """Shade the image and return it as a uint8 rgb array (height, width, 3)"""
+        hit = np.isfinite(self.depth)
+        normals = self.normals
+        colours = self.colours
+        viewer = np.array( [0.0, 0.0, 1.0] )
+        intensity = np.zeros_like(colours)
+        specular = np.zeros(self.depth.shape)
+        for light in light_directions:
+            intensity += ambient_material_factor * ambient_light_factor * colours
+            diffuse = np.maximum(np.dot(normals, light), 0.0)
+            intensity += diffuse_material_factor * diffuse_light_factor * diffuse[...,np.newaxis] * colours
+            half = light + viewer
+            half = half / np.sqrt(np.dot(half, half))
+            glint = np.maximum(np.dot(normals, half), 0.0)
+            specular += np.where(diffuse > 0.0, specular_material_factor * specular_light_factor * glint**glint_material_factor, 0.0)
+        intensity += specular[...,np.newaxis]
+        pixels = np.where(hit[...,np.newaxis], np.clip(intensity, 0.0, 1.0), self.background)
+        n = self.supersample
+        if n > 1:
+            pixels = pixels.reshape(self.height, n, self.width, n, 3).mean(axis=(1,3))
+        return (pixels * 255.0 + 0.5).astype(np.uint8)
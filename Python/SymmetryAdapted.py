@@ -0,0 +1,236 @@
+#!/usr/bin/python
+#
+# Copyright 2015 John Kendrick
+#
+# This file is part of PDielec
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the MIT License
+# along with this program, if not see https://opensource.org/licenses/MIT
+#
+
+"""Block diagonalise a hessian using the symmetry of the crystal"""
+
+from __future__ import print_function
+import numpy as np
+
+
+class SymmetryAdaptedBasis:
+    """A symmetry adapted basis for the 3N cartesian displacements of the atoms in a cell
+
+       The operations are a list of (rotation, permutation) tuples, as returned by UnitCell.symmetry_operations().
+       The displacements of each orbit of symmetry equivalent atoms are decomposed into isotypic components
+       by diagonalising a random element of the centre of the group algebra.  Its eigenvalues are the same
+       for a given irreducible representation in every orbit, so they are used to label the basis vectors.
+       A hessian with the symmetry of the cell is block diagonal in this basis, with one block for each
+       irreducible representation (complex conjugate pairs of representations share a block).
+       If the decomposition is ambiguous valid is set to False and the basis should not be used."""
+    maximum_operations = 192
+
+    def __init__(self, operations, debug=False):
+        self.debug = debug
+        self.valid = False
+        self.labels = []
+        self.ir_active = []
+        self._orbits = []
+        self.nions = len(operations[0][1])
+        self._operations = self._unique_operations(operations)
+        # Supercells have many pure translations, for these the dense solver is used
+        if len(self._operations) > self.maximum_operations:
+            if self.debug:
+                print('Symmetry adapted basis: too many operations', len(self._operations))
+            return
+        classes = self._conjugacy_classes()
+        if classes is None:
+            return
+        self._decompose(classes)
+
+    def _key(self, rotation, permutation):
+        """A hashable key for an operation"""
+        return ( (np.round(rotation, 4) + 0.0).tobytes(), permutation.tobytes() )
+
+    def _unique_operations(self, operations):
+        """Remove any operations which act identically on the displacements, eg. lattice centring in a conventional cell"""
+        unique = {}
+        for rotation, permutation in operations:
+            # Avoid -0.0 and 0.0 giving different keys
+            rotation = np.round(rotation, 8) + 0.0
+            permutation = np.array(permutation, dtype=np.int64)
+            unique.setdefault(self._key(rotation, permutation), (rotation, permutation))
+        return list(unique.values())
+
+    def _conjugacy_classes(self):
+        """Return the conjugacy classes of the operations as lists of indices, or None if they do not form a group"""
+        index = { self._key(r, p): i for i, (r, p) in enumerate(self._operations) }
+        classes = []
+        assigned = set()
+        for i, (r, p) in enumerate(self._operations):
+            if i in assigned:
+                continue
+            members = set()
+            for rh, ph in self._operations:
+                # h g h^-1, where the inverse of h is the transpose of the rotation and the inverse permutation
+                rc = np.dot(np.dot(rh, r), rh.T)
+                pc = ph[p[np.argsort(ph)]]
+                j = index.get( self._key(np.round(rc, 8) + 0.0, pc) )
+                if j is None:
+                    if self.debug:
+                        print('Symmetry operations do not form a group')
+                    return None
+                members.add(j)
+            assigned.update(members)
+            classes.append(sorted(members))
+        return classes
+
+    def _local_permutation(self, atoms, permutation):
+        """The permutation of an operation restricted to the atoms of an orbit, using indices into atoms"""
+        local = { atom: i for i, atom in enumerate(atoms) }
+        return np.array([ local[permutation[atom]] for atom in atoms ])
+
+    def _decompose(self, classes):
+        """Find the isotypic components of the displacements of each orbit and check that they are consistent"""
+        order = len(self._operations)
+        # Find the orbits of symmetry equivalent atoms
+        orbit_of = -np.ones(self.nions, dtype=np.int64)
+        orbits = []
+        for atom in range(self.nions):
+            if orbit_of[atom] >= 0:
+                continue
+            members = sorted(set(int(p[atom]) for r, p in self._operations))
+            orbit_of[members] = len(orbits)
+            orbits.append(members)
+        # A random element of the centre of the group algebra, the same element is used for every orbit
+        coefficients = np.random.RandomState(12345).uniform(1.0, 2.0, len(classes))
+        vector_characters = np.array([ np.trace(r) for r, p in self._operations ])
+        eigenvalues = []
+        pieces = []
+        weights = np.zeros(order)
+        for c, members in zip(coefficients, classes):
+            weights[members] = c
+        for atoms in orbits:
+            s = len(atoms)
+            permutations = [ self._local_permutation(atoms, p) for r, p in self._operations ]
+            # The operation moves the displacement of atom i onto atom permutation[i], rotating it
+            centre = np.zeros((s, 3, s, 3))
+            for w, (r, p), local in zip(weights, self._operations, permutations):
+                centre[local, :, np.arange(s), :] += w * r
+            centre = np.reshape(centre, (3*s, 3*s))
+            centre = centre + centre.T
+            values, vectors = np.linalg.eigh(centre)
+            # The characters of each basis vector, summed over a component they give the character of the component
+            v = np.reshape(vectors, (s, 3, 3*s))
+            characters = np.array([ np.einsum('san,ab,sbn->n', v[local], r, v) for (r, p), local in zip(self._operations, permutations) ]).T
+            eigenvalues.append(values)
+            pieces.append( (atoms, vectors, characters) )
+        # Group the eigenvalues of all the orbits into irreducible representations
+        all_values = np.concatenate(eigenvalues)
+        tolerance = 1.0E-6 * 4.0 * order
+        sorted_values = np.sort(all_values)
+        breaks = np.where(np.diff(sorted_values) > tolerance)[0] + 1
+        groups = np.split(sorted_values, breaks)
+        centres = [ np.mean(g) for g in groups ]
+        component_characters = np.zeros((len(groups), order))
+        assignments = []
+        for values, (atoms, vectors, characters) in zip(eigenvalues, pieces):
+            component = np.array([ int(np.argmin(np.abs(np.array(centres) - v))) for v in values ])
+            for k, v in zip(component, values):
+                if abs(centres[k] - v) > tolerance:
+                    return
+            for k in range(len(groups)):
+                component_characters[k] += np.sum(characters[component == k], axis=0)
+            assignments.append(component)
+        # The characters of different components must be orthogonal
+        overlaps = np.dot(component_characters, component_characters.T) / order
+        scale = np.sqrt(np.outer(np.diag(overlaps), np.diag(overlaps)))
+        off_diagonal = np.abs(overlaps - np.diag(np.diag(overlaps)))
+        if np.any(off_diagonal > 1.0E-6 * scale + 1.0E-8):
+            if self.debug:
+                print('Symmetry adapted basis: the components are not orthogonal')
+            return
+        # Order the components so the totally symmetric one is first
+        identities = [ g for g, (r, p) in enumerate(self._operations) if np.allclose(r, np.eye(3)) and np.all(p == np.arange(self.nions)) ]
+        if len(identities) != 1:
+            return
+        identity = component_characters[:, identities[0]]
+        symmetric = np.sum(component_characters / identity[:, np.newaxis], axis=1)
+        component_order = sorted(range(len(groups)), key=lambda k: (-round(symmetric[k], 6), identity[k]))
+        rank = { k: i for i, k in enumerate(component_order) }
+        self.labels = [ 'G{}'.format(i+1) for i in range(len(groups)) ]
+        # A component is infrared active if it contains the vector representation
+        self.ir_active = [ abs(np.dot(component_characters[k], vector_characters)) / order > 1.0E-6 for k in component_order ]
+        # Assign each basis vector a column, with the columns of each component together
+        self._component = np.concatenate([ [ rank[k] for k in component ] for component in assignments ])
+        columns = np.argsort(self._component, kind='stable')
+        positions = np.empty_like(columns)
+        positions[columns] = np.arange(len(columns))
+        self._component = self._component[columns]
+        self._slices = []
+        for i in range(len(groups)):
+            where = np.where(self._component == i)[0]
+            self._slices.append( slice(where[0], where[-1]+1) )
+        start = 0
+        for atoms, vectors, characters in pieces:
+            rows = np.ravel([ [3*a, 3*a+1, 3*a+2] for a in atoms ])
+            n = len(rows)
+            self._orbits.append( (rows, vectors, positions[start:start+n]) )
+            start += n
+        self.valid = True
+        return
+
+    def transform(self, hessian):
+        """Transform the hessian to the symmetry adapted basis, Q^T.H.Q"""
+        n = np.size(hessian, 0)
+        hq = np.empty((n, n))
+        for rows, vectors, columns in self._orbits:
+            hq[:, columns] = np.dot(hessian[:, rows], vectors)
+        qhq = np.empty((n, n))
+        for rows, vectors, columns in self._orbits:
+            qhq[columns, :] = np.dot(vectors.T, hq[rows, :])
+        return qhq
+
+    def back_transform(self, y):
+        """Transform vectors in the symmetry adapted basis back to cartesian displacements, Q.Y"""
+        x = np.empty_like(y)
+        for rows, vectors, columns in self._orbits:
+            x[rows, :] = np.dot(vectors, y[columns, :])
+        return x
+
+    def diagonalise(self, hessian, eigensolver=np.linalg.eigh, tolerance=1.0E-3):
+        """Diagonalise the hessian block by block
+           eigensolver is called for each block and returns its eigenvalues and eigenvectors
+           tolerance is the largest element allowed outside the blocks, relative to the largest element
+           (hessians reconstructed from printed normal modes are only symmetric to a few figures)
+           Returns the eigenvalues, the eigenvectors (as columns), the irrep label and the infrared activity of each mode
+           None is returned if the hessian is not block diagonal in the symmetry adapted basis"""
+        qhq = self.transform(hessian)
+        # Check that the hessian has the symmetry of the basis
+        off_blocks = qhq.copy()
+        for block in self._slices:
+            off_blocks[block, block] = 0.0
+        if np.max(np.abs(off_blocks)) > tolerance * np.max(np.abs(qhq)):
+            if self.debug:
+                print('Symmetry adapted basis: the hessian is not block diagonal', np.max(np.abs(off_blocks)))
+            return None
+        n = np.size(hessian, 0)
+        values = []
+        vectors = []
+        labels = []
+        active = []
+        for label, ir, block in zip(self.labels, self.ir_active, self._slices):
+            eig_val, eig_vec = eigensolver(qhq[block, block])
+            y = np.zeros((n, len(eig_val)))
+            y[block, :] = eig_vec
+            values.append(eig_val)
+            vectors.append(y)
+            labels += [ label ] * len(eig_val)
+            active += [ ir ] * len(eig_val)
+        eig_val = np.concatenate(values)
+        order = np.argsort(eig_val, kind='stable')
+        eig_vec = self.back_transform(np.concatenate(vectors, axis=1)[:, order])
+        return eig_val[order], eig_vec, [ labels[i] for i in order ], [ active[i] for i in order ]
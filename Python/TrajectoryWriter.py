@@ -0,0 +1,147 @@
+#!/usr/bin/python
+#
+# Copyright 2015 John Kendrick
+#
+# This file is part of PDielec
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the MIT License
+# along with this program, if not see https://opensource.org/licenses/MIT
+#
+"""Write the normal modes of a unit cell as multi-frame trajectories for other visualisers
+
+   Each mode is written as one period of its vibration, using the phases and maximum displacement
+   of the viewer (see ViewerScene), so a file holds 2*(number_of_phase_steps-1) frames for each mode.
+   Two formats are supported, chosen by the extension of the file name
+     .xyz or .extxyz  extended xyz, one text frame after another with the cell and mode in the comment line
+     .dcd             a CHARMM/NAMD style binary trajectory with a unit cell record for each frame
+   Only the positions of one mode are held in memory at a time.  The dcd file is memory mapped
+   and each mode is written straight into its frames, so memory does not grow with the number of frames."""
+from __future__ import print_function
+import os
+import struct
+import numpy as np
+import Python.ViewerScene as ViewerScene
+
+
+def mode_trajectories(xyz, normal_modes, modes, maximum_displacement, number_of_phase_steps):
+    """Generate the frames (nframes, natoms, 3) of each mode in turn
+       xyz are the equilibrium positions (natoms, 3) and normal_modes the displacements (nmodes, natoms, 3)"""
+    for mode in modes:
+        positions = ViewerScene.phase_positions(xyz, normal_modes[mode], maximum_displacement, number_of_phase_steps)
+        yield mode, positions[ViewerScene.animation_phases(len(positions))]
+
+
+def write_extxyz(filename, cell, normal_modes, modes, frequencies=None, maximum_displacement=1.0, number_of_phase_steps=41):
+    """Write the modes as a multi-frame extended xyz file
+       cell is a UnitCell and normal_modes are the displacements (nmodes, natoms, 3) in the order of the cell's atoms
+       frequencies (cm-1) are written to the comment line of each frame if they are given"""
+    xyz = np.asarray(cell.xyz_coordinates, dtype=float)
+    natoms = len(xyz)
+    lattice = ' '.join( '{:.8f}'.format(x) for x in np.ravel(cell.lattice) )
+    # The template for the atoms of a frame is built once, each frame is then a single formatting operation
+    atom_lines = ''.join( '{:<3s} %15.8f %15.8f %15.8f\n'.format(el) for el in cell.element_names )
+    with open(filename, 'w') as fd:
+        for mode, frames in mode_trajectories(xyz, normal_modes, modes, maximum_displacement, number_of_phase_steps):
+            comment = 'Lattice="{}" Properties=species:S:1:pos:R:3 pbc="T T T" mode={}'.format(lattice, mode)
+            if frequencies is not None:
+                comment += ' frequency={:.5f}'.format(np.real(frequencies[mode]))
+            header = '{}\n{} frame='.format(natoms, comment)
+            for frame, positions in enumerate(frames):
+                fd.write(header + '{}\n'.format(frame))
+                fd.write(atom_lines % tuple(positions.ravel().tolist()))
+    return
+
+
+def _dcd_frame_dtype(natoms):
+    """The layout of a frame of a dcd file, each Fortran record is surrounded by its length in bytes"""
+    return np.dtype( [ ('cell_start', '<i4'), ('cell', '<f8', 6), ('cell_end', '<i4'),
+                       ('x_start', '<i4'), ('x', '<f4', natoms), ('x_end', '<i4'),
+                       ('y_start', '<i4'), ('y', '<f4', natoms), ('y_end', '<i4'),
+                       ('z_start', '<i4'), ('z', '<f4', natoms), ('z_end', '<i4') ] )
+
+
+def _dcd_header(nframes, natoms, titles):
+    """The three header records of a dcd file"""
+    control = [0]*20
+    control[0] = nframes      # the number of frames
+    control[1] = 0            # the first step
+    control[2] = 1            # the steps between frames
+    control[3] = nframes      # the total number of steps
+    control[10] = 1           # there is a unit cell record for each frame
+    control[19] = 24          # the CHARMM version
+    record1 = b'CORD' + struct.pack('<20i', *control)
+    # The time step is a 4 byte float in place of the tenth control integer
+    record1 = record1[0:40] + struct.pack('<f', 1.0) + record1[44:]
+    titles = [ t.encode('ascii', 'replace')[0:80].ljust(80) for t in titles ]
+    record2 = struct.pack('<i', len(titles)) + b''.join(titles)
+    record3 = struct.pack('<i', natoms)
+    header = b''
+    for record in (record1, record2, record3):
+        header += struct.pack('<i', len(record)) + record + struct.pack('<i', len(record))
+    return header
+
+
+def write_dcd(filename, cell, normal_modes, modes, frequencies=None, maximum_displacement=1.0, number_of_phase_steps=41):
+    """Write the modes as a dcd trajectory, the atoms are in the order of the cell
+       The file is memory mapped and the frames of each mode are written as a block
+       The titles record the modes (and frequencies) in the order they appear in the file"""
+    xyz = np.asarray(cell.xyz_coordinates, dtype=float)
+    natoms = len(xyz)
+    modes = list(modes)
+    if number_of_phase_steps%2 == 0:
+        number_of_phase_steps += 1
+    frames_per_mode = 2*(number_of_phase_steps - 1)
+    nframes = frames_per_mode * len(modes)
+    titles = [ 'PDielec normal modes, {} frames for each mode'.format(frames_per_mode) ]
+    for mode in modes:
+        if frequencies is not None:
+            titles.append( 'mode {} frequency {:.5f} cm-1'.format(mode, np.real(frequencies[mode])) )
+        else:
+            titles.append( 'mode {}'.format(mode) )
+    header = _dcd_header(nframes, natoms, titles)
+    frame_dtype = _dcd_frame_dtype(natoms)
+    with open(filename, 'wb') as fd:
+        fd.write(header)
+        fd.truncate(len(header) + nframes*frame_dtype.itemsize)
+    if nframes == 0:
+        return
+    frames = np.memmap(filename, dtype=frame_dtype, mode='r+', offset=len(header), shape=(nframes,))
+    # The unit cell is a, gamma, b, beta, alpha, c with the angles in degrees
+    unit_cell = np.array( [ cell.a, cell.gamma, cell.b, cell.beta, cell.alpha, cell.c ] )
+    start = 0
+    for mode, positions in mode_trajectories(xyz, normal_modes, modes, maximum_displacement, number_of_phase_steps):
+        block = frames[start:start+len(positions)]
+        block['cell_start'] = 48
+        block['cell'] = unit_cell
+        block['cell_end'] = 48
+        for axis, name in enumerate( ('x', 'y', 'z') ):
+            block[name+'_start'] = 4*natoms
+            block[name] = positions[:, :, axis]
+            block[name+'_end'] = 4*natoms
+        start += len(positions)
+    frames.flush()
+    del frames
+    return
+
+
+def write_trajectory(filename, cell, normal_modes, modes=None, frequencies=None, maximum_displacement=1.0, number_of_phase_steps=41):
+    """Write the modes to filename, the format is chosen from the extension (.xyz, .extxyz or .dcd)
+       normal_modes are the displacements of the atoms of the cell (nmodes, natoms, 3), by default all the modes are written"""
+    normal_modes = np.reshape(np.asarray(normal_modes, dtype=float), (len(normal_modes), -1, 3))
+    if modes is None:
+        modes = range(len(normal_modes))
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ('.xyz', '.extxyz'):
+        write_extxyz(filename, cell, normal_modes, modes, frequencies, maximum_displacement, number_of_phase_steps)
+    elif extension == '.dcd':
+        write_dcd(filename, cell, normal_modes, modes, frequencies, maximum_displacement, number_of_phase_steps)
+    else:
+        raise ValueError('Unknown trajectory format '+extension)
+    return
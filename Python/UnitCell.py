@@ -19,26 +19,51 @@
 
 from __future__ import print_function
 import numpy as np
-import math
-from Python.Calculator  import calculate_distance
+import heapq
+from scipy.spatial      import cKDTree
 from Python.Plotter     import print_reals, print_ints, print_strings
 from Python.Calculator  import cleanup_symbol
 import sys
 
+# The start of a P1 cif file, the data block name and the cell lengths and angles are filled in
+cif_header_template = """data_{}
+_space_group_IT_number 1
+_symmetry_space_group_name_H-M 'P1'
+_cell_length_a      {:12.6f}
+_cell_length_b      {:12.6f}
+_cell_length_c      {:12.6f}
+_cell_angle_alpha   {:12.6f}
+_cell_angle_beta    {:12.6f}
+_cell_angle_gamma   {:12.6f}
+loop_
+_atom_site_label
+_atom_site_fract_x
+_atom_site_fract_y
+_atom_site_fract_z
+_atom_site_site_type_symbol
+"""
+
 
 class UnitCell:
-    """Hold unit cell information and its associated calculated properties"""
+    """Hold unit cell information and its associated calculated properties
+       The coordinates (nions, 3), masses and element indices are held as contiguous numpy arrays"""
+    __slots__ = ( 'fractional_coordinates', 'xyz_coordinates', 'element_names', 'element_indices', 'atom_labels',
+                  'bonds', 'nions', 'molecules', 'atomic_masses', 'centres_of_mass', 'total_mass', 'spacegroup',
+                  'lattice', 'inverse_lattice', 'reciprocal_lattice', 'volume', 'a', 'b', 'c', 'alpha', 'beta', 'gamma' )
+
     def __init__(self, a=None, b=None, c=None, alpha=None, beta=None, gamma=None):
-        self.fractional_coordinates = []
-        self.xyz_coordinates = []
+        self.fractional_coordinates = np.zeros( (0, 3) )
+        self.xyz_coordinates = np.zeros( (0, 3) )
         self.element_names = []
+        self.element_indices = np.zeros(0, dtype=int)
         self.atom_labels = []
         self.bonds = []
         self.nions = 0
         self.molecules = []
-        self.atomic_masses = []
-        self.centres_of_mass = []
+        self.atomic_masses = np.zeros(0)
+        self.centres_of_mass = np.zeros( (0, 3) )
         self.total_mass = 0.0
+        self.spacegroup = None
         self.lattice = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
         if gamma is not None:
             self.lattice = self.convert_abc_to_unitcell(a, b, c, alpha, beta, gamma)
@@ -48,25 +73,15 @@ class UnitCell:
             self.lattice[2] = c
         self._calculate_reciprocal_lattice(self.lattice)
 
+    def cif_string(self, filename=''):
+        """Return the contents of a P1 cif file describing the cell
+           The coordinates of all the atoms are formatted in a single operation from a template"""
+        header = cif_header_template.format(filename, self.a, self.b, self.c, self.alpha, self.beta, self.gamma)
+        atoms = ''.join( [ '{}{} %12.6f %12.6f %12.6f {}\n'.format(el, i+1, el) for i,el in enumerate(self.element_names) ] )
+        return header + atoms % tuple(self.fractional_coordinates[0:len(self.element_names)].ravel().tolist())
+
     def write_cif(self, filename='', file_=sys.stdout):
-        print('data_'+filename,                                 file=file_)
-        print('_space_group_IT_number 1',                       file=file_)
-        print('_symmetry_space_group_name_H-M \'P1\'',          file=file_)
-        print('_cell_length_a      {:12.6f}'.format(self.a),    file=file_)
-        print('_cell_length_b      {:12.6f}'.format(self.b),    file=file_)
-        print('_cell_length_c      {:12.6f}'.format(self.c),    file=file_)
-        print('_cell_angle_alpha   {:12.6f}'.format(self.alpha),file=file_)
-        print('_cell_angle_beta    {:12.6f}'.format(self.beta), file=file_)
-        print('_cell_angle_gamma   {:12.6f}'.format(self.gamma),file=file_)
-        print('loop_',                                          file=file_)
-        print('_atom_site_label',                               file=file_)
-        print('_atom_site_fract_x',                             file=file_)
-        print('_atom_site_fract_y',                             file=file_)
-        print('_atom_site_fract_z',                             file=file_)
-        print('_atom_site_site_type_symbol',                    file=file_)
-        for i,(frac,el) in enumerate(zip(self.fractional_coordinates,self.element_names)):
-            symbol = el+str(i+1)
-            print( '{} {:12.6f} {:12.6f} {:12.6f} {}'.format(symbol,frac[0], frac[1], frac[2], el), file=file_)
+        file_.write(self.cif_string(filename))
         return
 
     def getBoundingBox(self):
@@ -77,31 +92,13 @@ class UnitCell:
         # |4--|5
         # 0---1/
         # Corners in abc space
-        corners = []
-        corners.append( np.array( [0.0,0.0,0.0] ) )
-        corners.append( np.array( [1.0,0.0,0.0] ) )
-        corners.append( np.array( [1.0,1.0,0.0] ) )
-        corners.append( np.array( [0.0,1.0,0.0] ) )
-        corners.append( np.array( [0.0,0.0,1.0] ) )
-        corners.append( np.array( [1.0,0.0,1.0] ) )
-        corners.append( np.array( [1.0,1.0,1.0] ) )
-        corners.append( np.array( [0.0,1.0,1.0] ) )
-        # Now calculate the corners in cartesian space
-        corners_xyz = [ self.convert_abc_to_xyz(corner) for corner in corners ]
-        # Now calculate the edges each edge is a tuple with a beginning coordinate and an end coordinate
-        edges = []
-        edges.append( (corners_xyz[1] , corners_xyz[0]) )
-        edges.append( (corners_xyz[2] , corners_xyz[1]) )
-        edges.append( (corners_xyz[3] , corners_xyz[2]) )
-        edges.append( (corners_xyz[3] , corners_xyz[0]) )
-        edges.append( (corners_xyz[4] , corners_xyz[0]) )
-        edges.append( (corners_xyz[5] , corners_xyz[1]) )
-        edges.append( (corners_xyz[6] , corners_xyz[2]) )
-        edges.append( (corners_xyz[7] , corners_xyz[3]) )
-        edges.append( (corners_xyz[5] , corners_xyz[4]) )
-        edges.append( (corners_xyz[6] , corners_xyz[5]) )
-        edges.append( (corners_xyz[7] , corners_xyz[6]) )
-        edges.append( (corners_xyz[7] , corners_xyz[4]) )
+        corners = np.array( [ [0.0,0.0,0.0], [1.0,0.0,0.0], [1.0,1.0,0.0], [0.0,1.0,0.0],
+                              [0.0,0.0,1.0], [1.0,0.0,1.0], [1.0,1.0,1.0], [0.0,1.0,1.0] ] )
+        # Now calculate the corners in cartesian space (8, 3)
+        corners_xyz = self.convert_abc_to_xyz(corners)
+        # Now calculate the edges (12, 2, 3), each edge has a beginning coordinate and an end coordinate
+        ends = np.array( [ [1,0], [2,1], [3,2], [3,0], [4,0], [5,1], [6,2], [7,3], [5,4], [6,5], [7,6], [7,4] ] )
+        edges = corners_xyz[ends]
         return corners_xyz,edges
          
 
@@ -119,8 +116,8 @@ class UnitCell:
         for xyz in self.xyz_coordinates[1:]:
             print_reals('',xyz, format='{:12.6f}')
         if self.molecules:
-            for molid,atoms in enumerate(self.molecules):
-                mass, cm_xyz, cm_frac = self.calculateCentreOfMass(atom_list=atoms,units='all')
+            masses, cms_xyz, cms_frac = self.calculateCentresOfMass(units='all')
+            for molid,(atoms,mass,cm_xyz,cm_frac) in enumerate(zip(self.molecules,masses,cms_xyz,cms_frac)):
                 molstring = 'Molecule '+str(molid)+':'
                 print_ints('Atoms in '+molstring,atoms)
                 print_reals('Mass of '+molstring,[ mass ], format='{:12.6f}')
@@ -131,14 +128,15 @@ class UnitCell:
         # Calculate the centre of mass - if the atom list is given just use that
         # The centre of mass can be returned in units of 'xyz' space or 'abc' space
         # if units='all' a tuple of (mass,cm_xyz,cm_abc) is returned
-        if atom_list == None:
-            atom_list = range(self.nions)
-        mass = 0.0
-        cm = np.zeros(3)
-        for atom_index in atom_list:
-            mass += self.atomic_masses[atom_index]
-            cm = cm + self.atomic_masses[atom_index] * self.xyz_coordinates[atom_index]
-        cm_xyz = cm / mass
+        if atom_list is None:
+            masses = self.atomic_masses
+            xyz = self.xyz_coordinates
+        else:
+            atom_list = np.asarray(atom_list, dtype=int)
+            masses = self.atomic_masses[atom_list]
+            xyz = self.xyz_coordinates[atom_list]
+        mass = np.sum(masses)
+        cm_xyz = np.dot(masses, xyz) / mass
         if units == 'xyz':
             return cm_xyz
         elif units == 'mass':
@@ -150,8 +148,27 @@ class UnitCell:
             cm_fractional = self.convert_xyz_to_abc(cm_xyz)
             return mass, cm_xyz, cm_fractional
 
+    def calculateCentresOfMass(self, units='xyz'):
+        # Calculate the centre of mass of every molecule in one pass
+        # The atoms are gathered in molecule order and summed with np.add.reduceat
+        # The units are as for calculateCentreOfMass, arrays with one entry for each molecule are returned
+        sizes = np.array( [ len(atoms) for atoms in self.molecules ], dtype=int )
+        order = np.concatenate( [ np.asarray(atoms, dtype=int) for atoms in self.molecules ] )
+        starts = np.concatenate( ( [0], np.cumsum(sizes)[:-1] ) )
+        masses = self.atomic_masses[order]
+        mass = np.add.reduceat(masses, starts)
+        cm_xyz = np.add.reduceat(masses[:, np.newaxis] * self.xyz_coordinates[order], starts, axis=0) / mass[:, np.newaxis]
+        if units == 'xyz':
+            return cm_xyz
+        elif units == 'mass':
+            return mass
+        elif units == 'abc':
+            return self.convert_xyz_to_abc(cm_xyz)
+        else:
+            return mass, cm_xyz, self.convert_xyz_to_abc(cm_xyz)
+
     def set_atomic_masses(self, masses):
-        self.atomic_masses = masses
+        self.atomic_masses = np.array(masses, dtype=float)
 
     def convert_unitcell_to_abc(self):
         """Convert a unit cell to the equivalent a, b, c, alpha, beta, gamma designation"""
@@ -194,7 +211,7 @@ class UnitCell:
 
     def convert_xyz_to_abc(self, xyz):
         """Convert xyz coordinates to abc lattice coordinates"""
-        xyz = np.array(xyz)
+        xyz = np.asarray(xyz, dtype=float)
         abc = np.dot(xyz, self.reciprocal_lattice)
         return abc
 
@@ -206,7 +223,7 @@ class UnitCell:
 
     def convert_abc_to_xyz(self, abc):
         """Convert abc coordinates to xyz coordinates"""
-        abc = np.array(abc)
+        abc = np.asarray(abc, dtype=float)
         xyz = np.dot(abc, self.lattice)
         return xyz
 
@@ -238,23 +255,25 @@ class UnitCell:
 
     def set_fractional_coordinates(self, coords):
         """Set the fractional coordinates and calculate the xyz coordinates"""
-        self.fractional_coordinates = coords
-        self.xyz_coordinates = self.convert_abc_to_xyz(coords)
+        self.fractional_coordinates = np.array(coords, dtype=float).reshape(-1, 3)
+        self.xyz_coordinates = self.convert_abc_to_xyz(self.fractional_coordinates)
         self.nions = len(coords)
         return
 
     def set_xyz_coordinates(self, coords):
         """Set the xyz coordinates and calculate the fractional coordinates"""
-        self.xyz_coordinates = coords
-        self.fractional_coordinates = self.convert_xyz_to_abc(coords)
+        self.xyz_coordinates = np.array(coords, dtype=float).reshape(-1, 3)
+        self.fractional_coordinates = self.convert_xyz_to_abc(self.xyz_coordinates)
         self.nions = len(coords)
         return
 
     def set_element_names(self, element_names):
-        self.element_names = []
-        for el in element_names:
-          el = cleanup_symbol(el)
-          self.element_names.append(el)
+        self.element_names = [ cleanup_symbol(el) for el in element_names ]
+        # The index of each element in the sorted list of the different elements
+        if len(self.element_names) > 0:
+            self.element_indices = np.unique(self.element_names, return_inverse=True)[1].reshape(-1)
+        else:
+            self.element_indices = np.zeros(0, dtype=int)
         return
 
     def set_atom_labels(self, atom_labels):
@@ -263,217 +282,144 @@ class UnitCell:
           self.atom_labels.append(el)
         return
 
+    def _species_types(self):
+        """Return an integer type for each atom, atoms with the same element name have the same type"""
+        return self.element_indices.tolist()
+
     def find_symmetry(self):
         """Find the space group symmetry of the unit cell"""
         from spglib import get_spacegroup
-        cell = ( self.lattice, self.fractional_coordinates, self.atomic_nos )
-        self.spacegroup = get_spacegroup(cell, symmprec=1e-5)
+        cell = ( self.lattice, self.fractional_coordinates, self._species_types() )
+        self.spacegroup = get_spacegroup(cell, symprec=1e-5)
         print("Symmetry space group is", self.spacegroup)
 
+    def symmetry_operations(self, types=None, symprec=1e-5):
+        """Find the symmetry operations of the unit cell as they act on the atoms
+           types is an optional list of integers used to distinguish the atoms, the default is the element names
+           A list of (rotation, permutation) tuples is returned, where rotation is the 3x3 cartesian rotation
+           and permutation[i] is the atom that atom i is moved onto.
+           None is returned if spglib is not available or the atom mapping cannot be found."""
+        try:
+            from spglib import get_symmetry
+        except ImportError:
+            return None
+        if types is None:
+            types = self._species_types()
+        types = np.array(types)
+        fractional = np.array(self.fractional_coordinates, dtype=float)
+        cell = ( self.lattice, fractional, types )
+        symmetry = get_symmetry(cell, symprec=symprec)
+        if symmetry is None:
+            return None
+        lattice_t = np.array(self.lattice).T
+        inverse_lattice_t = np.linalg.inv(lattice_t)
+        # Only atoms of the same type can be mapped onto each other
+        different = types[:, np.newaxis] != types[np.newaxis, :]
+        operations = []
+        for rotation, translation in zip(symmetry['rotations'], symmetry['translations']):
+            new_positions = np.dot(fractional, rotation.T) + translation
+            # Periodic distances between every moved atom and every original atom
+            diff = new_positions[:, np.newaxis, :] - fractional[np.newaxis, :, :]
+            diff = diff - np.round(diff)
+            distances = np.sqrt(np.sum(np.dot(diff, self.lattice)**2, axis=2))
+            distances[different] = np.inf
+            permutation = np.argmin(distances, axis=1)
+            if np.max(distances[np.arange(len(types)), permutation]) > 10*symprec:
+                return None
+            if len(set(permutation)) != len(permutation):
+                return None
+            rotation_xyz = np.dot(np.dot(lattice_t, rotation), inverse_lattice_t)
+            operations.append( (rotation_xyz, permutation) )
+        return operations
+
     def calculate_molecular_contents(self, scale, toler, covalent_radii):
         """Find whole molecules in the unit cell
            scale and toler are used to manipulate the covalent radii, thus the largest distance 
            apart atoms i and j can be for a bond is
-           scale*( radi + radj) + toler """
-        # Calculate the contents of all the cells adjacent to the central cell
+           scale*( radi + radj) + toler 
+           The bonds between the cell and its 26 neighbouring images are found with a KD-tree search.
+           Each molecule is grown from the first atom not yet in a molecule, by repeated sweeps through the
+           images in order, adding any image bonded to the molecule whose atom is not yet in a molecule.
+           The atoms of each molecule are kept in the order they are found and the first image found for each atom
+           is the one used, so the molecule is whole.  The neighbours of each image are visited in the order of the
+           original search through boxes of atoms, so the order of the atoms in the new cell is unchanged.
+           A new unit cell is returned with the atoms ordered by molecule, together with the number
+           of molecules and the original index of each atom in the new cell"""
+        fractional = self.fractional_coordinates
+        nions = len(fractional)
+        radii = np.array( [ covalent_radii[el] for el in self.element_names ] )
+        cutoff = 2.0*scale*np.max(radii) + toler
+        # The central cell comes first, so the first nions images are the atoms of the cell
         adjacents = ( 0, -1, 1 )
-        translations = [ (i, j, k) for i in adjacents for j in adjacents for k in adjacents ]
-        fractional_supercell = []
-        index_supercell = []
-        for tr in translations:
-            for l,a in enumerate(self.fractional_coordinates):
-                i,j,k = tr
-                index_supercell.append( l )
-                new_position = [ (xyz1 + xyz2)  for xyz1, xyz2 in zip(a, tr) ]
-                fractional_supercell.append( new_position )
-                #jk print('New positions ',new_position,l,i,j,k)
-        # Convert fractional supercell coordinates to xyz
-        # xyz_supercell will be an np array
-        xyz_supercell = np.empty_like(fractional_supercell)
-        for i,abc in enumerate(fractional_supercell):
-            xyz_supercell[i] = self.convert_abc_to_xyz(abc)
-        # put the atoms into boxes of boxSize
-        BoxAtoms = {}
-        BoxNeighbours = {}
-        boxSize = 0.0
-        # calculate boxsize
-        rmax = 0.0
-        for el in self.element_names:
-            #jk print("Element name",el)
-            if covalent_radii[el] > rmax:
-                rmax = covalent_radii[el]
-        boxSize = 2.0*scale*rmax + 0.5 + toler
-        #jk print('rmax = ',rmax)
-        # Put atoms into boxes and store the box info in Atom_box_id
-        Atom_box_id = []
-        for i,xyz in enumerate(xyz_supercell):
-            a = int( math.floor(xyz[0]/boxSize) )
-            b = int( math.floor(xyz[1]/boxSize) )
-            c = int( math.floor(xyz[2]/boxSize) )
-            abc = (a,b,c)
-            Atom_box_id.append(abc)
-            try:
-                BoxAtoms[abc].append(i)
-            except:
-                BoxAtoms[abc] = [i]
-        # Calculate the neighbouring boxes for each occupied box
-        for abc in BoxAtoms:
-            #jk print('Box ',abc, BoxAtoms[abc])
-            a,b,c = abc
-            BoxNeighbours[abc] = []
-            for i in [ -1, 0, 1]:
-              for j in [ -1, 0, 1]:
-                for k in [ -1, 0, 1]:
-                  BoxNeighbours[abc].append( (a+i,b+j,c+k) )
-        # end for abc in Box1
-         
-        # Calculate the bonding the supercell 
-        bondedToAtom = {}
-        for i,xyzi in enumerate(xyz_supercell):
-            #jk print('Calculating bonding to ',i,xyzi)
-            bondedToAtom[i] = []
-            # Find the element name for this atom in the supercell
-            ip = index_supercell[i]
-            i_el = self.element_names[ip]
-            # lookup all of the boxes that might hold a bonding atom
-            cell = Atom_box_id[i]
-            for abc in BoxNeighbours[cell]:
-                # lookup all the atoms that are in that cell
-                try: 
-                    for j in BoxAtoms[abc]:
-                        if j < i:
-                            # Find the element name for this atom in the supercell
-                            jp = index_supercell[j]
-                            j_el = self.element_names[jp]
-                            dist1 = scale*( covalent_radii[i_el] + covalent_radii[j_el]) + toler
-                            dist2 = calculate_distance(xyzi,xyz_supercell[j])
-                            if dist2 < dist1:
-                                bondedToAtom[i].append(j)
-                                bondedToAtom[j].append(i)
-                                #jk print('new bond', i, j, i_el, j_el, xyzi, xyz_supercell[j], dist1, dist2)
-                            # end if dist2 < dist1
-                        # end if j < i
-                    # end for j
-                except KeyError: 
-                    pass
-            # end for abc 
-        # end for i,a
-        # 
-        # Now we have to find how many molecules we have in the cell
-        # There must be at least one molecule in the cell and it must contain the first atom
-        #
-        # BelongsToMolecule[i] holds which molecule the ith atom belongs to
-        belongsToMolecule = {}
-        # molecules is a dictionary of molecules each entry is a is a list of atoms
-        molecules = {}
-        molID = -1
-        # We stop when all the atoms in the original cell belong to a molecule
-        remainingAtoms = [ atom for atom in range(self.nions) ]
-        bonds = []
-        while len(remainingAtoms) > 0:
-            #jk print("Remaining atoms")
-            #jk print(remainingAtoms)
-            # create a new molecule from the first atom which has no molecule assigned to it
-            molID += 1
-            useAtom = remainingAtoms[0]
-            belongsToMolecule[useAtom] = molID
-            molecules[molID] = [ useAtom ]
-            remainingAtoms.remove(useAtom)
-            # Now using this new molecule with its only atom as a seed find any atoms connected to it
-            # We need to continue searching for bonded atoms until there are no more to be found
-            moreAtomsToBeFound = True
-            while moreAtomsToBeFound:
-                moreAtomsToBeFound = False
-                for i in range(len(xyz_supercell)):
-                    # has this atom been assigned a molecule yet?
-                    if i in belongsToMolecule:
-                        # atom i is already assigned to a molecule
-                        useThisMolecule = belongsToMolecule[i]
-                        #jk print("Using this molecule", useThisMolecule)
-                        # Go through all the atoms bonded to i and add to the current molecule
-                        for j in bondedToAtom[i]:
-                            jx = index_supercell[j]
-                            #jk print("atom j / jx is bonded to atom i",j,jx,i)
-                            # The image of j in the original cell might not be available, and j might be bonded
-                            if jx in remainingAtoms and not j in belongsToMolecule:
-                                # if j was not already in a molecule then we have new information
-                                bonds.append( (i,j) )
-                                moreAtomsToBeFound = True
-                                molecules[useThisMolecule].append(j)
-                                belongsToMolecule[j] = useThisMolecule
-                                #jk print("Removing atom index(j) from remaining atoms",index_supercell[j])
-                                remainingAtoms.remove(jx)
-                        # end for j
-                    # end if i in
-                # end for i
-            # while moreAtomsToBeFound
-        # until all the atoms belong to a molecule
-        #jk print('Number of molecules', molID+1)
-        self.centres_of_mass = []
+        translations = np.array( [ (i, j, k) for i in adjacents for j in adjacents for k in adjacents ] )
+        images = np.reshape(fractional[np.newaxis, :, :] + translations[:, np.newaxis, :], (-1, 3))
+        xyz_images = self.convert_abc_to_xyz(images)
+        pairs = cKDTree(xyz_images).query_pairs(cutoff, output_type='ndarray')
+        lower, upper = pairs[:, 0], pairs[:, 1]
+        distances = np.linalg.norm(xyz_images[lower] - xyz_images[upper], axis=1)
+        bonded = distances < scale*( radii[lower % nions] + radii[upper % nions] ) + toler
+        lower, upper = lower[bonded], upper[bonded]
+        # Order the neighbours of each image as the search through boxes of boxSize found them
+        # Lower images come first, ordered by their box and then their index, followed by the higher images in order
+        boxSize = cutoff + 0.5
+        boxes = np.floor(xyz_images / boxSize).astype(int)
+        sources = np.concatenate( (upper, lower) )
+        neighbours = np.concatenate( (lower, upper) )
+        later = np.concatenate( ( np.zeros(len(lower), dtype=int), np.ones(len(upper), dtype=int) ) )
+        box_keys = boxes[neighbours] * ( 1 - later[:, np.newaxis] )
+        sort = np.lexsort( (neighbours, box_keys[:, 2], box_keys[:, 1], box_keys[:, 0], later, sources) )
+        sources, neighbours = sources[sort], neighbours[sort]
+        offsets = np.searchsorted(sources, np.arange(len(images)+1))
+        # Grow the molecules, each atom of the cell is placed at the first of its images to be found
+        # An image found ahead of the current sweep is searched in that sweep, otherwise it waits for the next one
+        image_of_atom = np.full(nions, -1, dtype=int)
+        molecules = []
+        for seed in range(nions):
+            if image_of_atom[seed] >= 0:
+                continue
+            image_of_atom[seed] = seed
+            molecule = [ seed ]
+            next_sweep = [ seed ]
+            while len(next_sweep) > 0:
+                sweep = next_sweep
+                heapq.heapify(sweep)
+                next_sweep = []
+                while len(sweep) > 0:
+                    i = heapq.heappop(sweep)
+                    for j in neighbours[offsets[i]:offsets[i+1]].tolist():
+                        if image_of_atom[j % nions] < 0:
+                            image_of_atom[j % nions] = j
+                            molecule.append(j)
+                            if j > i:
+                                heapq.heappush(sweep, j)
+                            else:
+                                next_sweep.append(j)
+            molecules.append(molecule)
+        nmols = len(molecules)
+        order = np.concatenate(molecules)
+        old_order = order % nions
+        invert_old_order = np.empty(nions, dtype=int)
+        invert_old_order[old_order] = np.arange(nions)
+        sizes = np.array( [ len(molecule) for molecule in molecules ] )
+        starts = np.concatenate( ( [0], np.cumsum(sizes) ) )
+        labels = np.repeat(np.arange(nmols), sizes)
+        # Calculate the centre of mass of each molecule, the molecules are contiguous in the new order
+        new_masses = self.atomic_masses[old_order]
+        molecular_masses = np.add.reduceat(new_masses, starts[:-1])
+        cm_fractional = np.add.reduceat(new_masses[:, np.newaxis] * images[order], starts[:-1], axis=0) / molecular_masses[:, np.newaxis]
+        self.centres_of_mass = cm_fractional
         self.total_mass = 0.0
-        for mol_index in molecules:
-            #jk print('Molecule ',mol_index)
-            #jk print('Atoms ',molecules[mol_index])
-            for atom_index in molecules[mol_index]:
-                index = index_supercell[atom_index]
-                #jk print('New atom index, old index', atom_index, index, self.element_names[index])
-            # Calculate centre of mass
-            mass = 0.0
-            cm = np.zeros(3)
-            for atom_index in molecules[mol_index]:
-                index = index_supercell[atom_index]
-                mass += self.atomic_masses[index]
-                cm = cm + self.atomic_masses[index] * xyz_supercell[atom_index]
-            cm_xyz = cm / mass
-            cm_fractional = self.convert_xyz_to_abc(cm_xyz)
-            self.centres_of_mass.append( cm_fractional )
-            #jk print('Mass', mass)
-            #jk print('Centre of mass', cm_fractional)
         # Create a new unit cell with the atoms shifted so that whole molecules are ordered and within the cell
-        new_molecules = []
-        new_fractional = np.empty_like(self.fractional_coordinates)
-        new_element_names = []
-        new_index = 0
-        new_masses = []
-        old_order = []
-        for mol_index in molecules:
-            new_atom_index = []
-            cm = self.centres_of_mass[mol_index]
-            shift = np.array( [ 0.0, 0.0, 0.0] )
-            if cm[0] < 0.0:
-                shift += [ 1.0, 0.0, 0.0 ]
-            elif cm[0] > 1.0:
-                shift += [-1.0, 0.0, 0.0 ]
-            if cm[1] < 0.0:
-                shift += [ 0.0, 1.0, 0.0 ]
-            elif cm[1] > 1.0:
-                shift += [ 0.0,-1.0, 0.0 ]
-            if cm[2] < 0.0:
-                shift += [ 0.0, 0.0, 1.0 ]
-            elif cm[2] > 1.0:
-                shift += [ 0.0, 0.0,-1.0 ]
-            for atom_index in molecules[mol_index]:
-                old_index = index_supercell[atom_index]
-                old_order.append(old_index)
-                new_fractional[new_index] = shift + np.array(fractional_supercell[atom_index])
-                new_element_names.append(self.element_names[old_index])
-                new_masses.append(self.atomic_masses[old_index])
-                new_atom_index.append(new_index)
-                new_index += 1
-            new_molecules.append(new_atom_index)
-        # as well as being able to go from the new order and look up the old order
-        # we need to be able to take the old order and look up what the new order is
-        invert_old_order = np.zeros_like(old_order)
-        for i,j in enumerate(old_order):
-            invert_old_order[j] = i
-        new_bonds = []
-        for bond in bonds:
-            i,j = bond
-            ix = invert_old_order[index_supercell[i]]
-            jx = invert_old_order[index_supercell[j]]
-            new_bonds.append( (ix,jx) )
+        shifts = ( cm_fractional < 0.0 ).astype(int) - ( cm_fractional > 1.0 ).astype(int)
+        new_fractional = images[order] + shifts[labels]
+        new_element_names = [ self.element_names[i] for i in old_order ]
+        new_molecules = [ list(range(starts[mol], starts[mol+1])) for mol in range(nmols) ]
+        # Keep the bonds between the images chosen for the atoms of each whole molecule
+        internal = ( image_of_atom[lower % nions] == lower ) & ( image_of_atom[upper % nions] == upper )
+        new_bonds = sorted(set( zip(invert_old_order[lower[internal] % nions].tolist(), invert_old_order[upper[internal] % nions].tolist()) ))
+        old_order = old_order.tolist()
         new_unit_cell = UnitCell( self.a, self.b, self.c, self.alpha, self.beta, self.gamma )
-        new_unit_cell.set_fractional_coordinates(new_fractional.tolist())
+        new_unit_cell.set_fractional_coordinates(new_fractional)
         new_unit_cell.set_element_names(new_element_names)
         new_unit_cell.set_atomic_masses(new_masses)
         new_unit_cell.set_molecules(new_molecules)
@@ -22,7 +22,7 @@ import sys
 import numpy as np
 
 from Python.VaspOutputReader import VaspOutputReader
-from Python.PhonopyOutputReader import PhonopyOutputReader
+from Python.PhonopyOutputReader import PhonopyOutputReader, phonopy_dynamical_matrix_file
 from Python.CastepOutputReader import CastepOutputReader
 from Python.GulpOutputReader import GulpOutputReader
 from Python.CrystalOutputReader import CrystalOutputReader
@@ -83,8 +83,8 @@ def get_reader(program,names,qmprogram):
             # Creat a list of phonopy files
             pnames = []
             head,tail = os.path.split(names[0])
-            pnames.append(head+os.path.join('qpoints.yaml'))
-            pnames.append(head+os.path.join('phonopy.yaml'))
+            pnames.append(phonopy_dynamical_matrix_file(head))
+            pnames.append(os.path.join(head,'phonopy.yaml'))
             # Creat a list of VASP files NB.  They all have to be in the same directory
             vnames = names
             pnames.extend(vnames)
@@ -146,3 +146,8 @@ class Debug():
             print(self.text,*args)
         return
 
+def write_time(seconds):
+    """Format a time in seconds as hours:minutes:seconds"""
+    minutes,seconds = divmod(int(seconds),60)
+    hours,minutes = divmod(minutes,60)
+    return '{:d}:{:02d}:{:02d}'.format(hours,minutes,seconds)
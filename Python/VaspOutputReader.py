@@ -176,6 +176,7 @@ class VaspOutputReader(GenericOutputReader):
             # end for j
             self.mass_weighted_normal_modes.append(a)
         # end of for i in range(n)
+        self.mass_weighted_normal_modes = np.array(self.mass_weighted_normal_modes, dtype=float)
         return
 
     def _read_born_charges(self, line):
@@ -112,20 +112,10 @@ class ViewerClass(HasTraits):
         self.number_of_modes = len(normal_modes)
         self.number_of_modesm1 = len(normal_modes)-1
         # reorder the displacement info in the normal modes into U,V and W lists
-        self.U, self.V, self.W = [], [], []
-        for mode,displacements in enumerate(self.normal_modes):
-            U = np.zeros_like( self.X )
-            V = np.zeros_like( self.X )
-            W = np.zeros_like( self.X )
-            index = -1
-            for i in range(0,len(displacements),3):
-                index += 1
-                U[index] = displacements[i + 0]
-                V[index] = displacements[i + 1]
-                W[index] = displacements[i + 2]
-            self.U.append(U)
-            self.V.append(V)
-            self.W.append(W)
+        UVW = np.reshape(self.normal_modes, (self.number_of_modes,self.natoms,3))
+        self.U = UVW[:,:,0]
+        self.V = UVW[:,:,1]
+        self.W = UVW[:,:,2]
         # get the cell edges for the bounding box
         corners,self.cell_edges = self.unit_cell.getBoundingBox()
         self.element_names = self.unit_cell.element_names
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+#
+# Copyright 2015 John Kendrick
+#
+# This file is part of PDielec
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the MIT License
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# You should have received a copy of the MIT License
+# along with this program, if not see https://opensource.org/licenses/MIT
+#
+"""The description of a scene showing a normal mode of a unit cell
+
+   The scene is a dictionary of arrays, which is drawn either by the OpenGL widget of the viewer tab
+   or by the SoftwareRenderer when there is no display.
+     sphere_colours       (nspheres, 4) rgba 0-255
+     sphere_radii         (nspheres)
+     sphere_positions     (nphases, nspheres, 3)
+     cylinder_colours     (ncylinders, 4) rgba 0-255
+     cylinder_radii       (ncylinders)
+     cylinder_positions1  (nphases, ncylinders, 3)
+     cylinder_positions2  (nphases, ncylinders, 3)
+   The atoms are the first spheres, followed by the corners of the cell.
+   The bonds are the first cylinders, followed by the edges of the cell."""
+from __future__ import print_function
+import numpy as np
+
+# The default settings of the viewer
+default_settings = {}
+default_settings['Atom scaling']          = 0.5
+default_settings['Maximum displacement']  = 1.0
+default_settings['Bond colour']           = [  80,  80,  80, 255 ]
+default_settings['Bond radius']           = 0.1
+default_settings['Cell colour']           = [ 255,   0,   0, 255 ]
+default_settings['Cell radius']           = 0.1
+default_settings['Background colour']     = [ 120, 120, 120, 255 ]
+default_settings['Arrow colour']          = [   0, 255,   0, 255 ]
+default_settings['Arrow radius']          = 0.07
+default_settings['Number of phase steps'] = 41
+default_settings['Triangle budget']       = 2000000
+
+
+def displacement_scale(displacements, maximum_displacement):
+    """The scale factor which makes the largest component of the displacements equal to maximum_displacement"""
+    return maximum_displacement / np.amax(np.abs(displacements))
+
+
+def phase_positions(xyz, displacements, maximum_displacement, number_of_phase_steps):
+    """The positions of the atoms at each phase of the vibration (nphases, natoms, 3)
+       xyz are the equilibrium positions and displacements the normal mode (natoms, 3)
+       The phases run from -1 to +1, number_of_phase_steps should be odd"""
+    n2 = int(number_of_phase_steps/2)
+    delta = 1.0 / float(n2)
+    phases = np.arange(-1.0, 1.0+delta-1.0E-10, delta)
+    scale = displacement_scale(displacements, maximum_displacement)
+    return np.array(xyz)[np.newaxis,:,:] + (phases*scale)[:,np.newaxis,np.newaxis]*np.array(displacements)[np.newaxis,:,:]
+
+
+def animation_phases(number_of_phases):
+    """The order of the phases for one period of the vibration
+       From the centre (the equilibrium positions) to one extreme, back to the other and back towards the centre"""
+    centre = number_of_phases // 2
+    return list(range(centre, number_of_phases)) + list(range(number_of_phases-2, -1, -1)) + list(range(1, centre))
+
+
+def scene_positions(positions, bonds, cell_corners, cell_edges):
+    """The positions of the spheres and the ends of the cylinders at each phase
+       positions are the atom positions at each phase (nphases, natoms, 3)
+       bonds are pairs of atom indices
+       cell_corners and cell_edges are returned by UnitCell.getBoundingBox()"""
+    nphases = len(positions)
+    # The atoms come first followed by the corners of the cell, which do not move
+    corners = np.reshape(cell_corners, (-1,3))
+    ncorners = len(corners)
+    scene = {}
+    scene['sphere_positions'] = np.concatenate( (positions, np.broadcast_to(corners, (nphases,ncorners,3))), axis=1 )
+    # The bonds come first followed by the edges of the cell
+    bonds = np.reshape(np.array(bonds, dtype=int), (-1,2))
+    edges = np.reshape(cell_edges, (-1,2,3))
+    nedges = len(edges)
+    scene['cylinder_positions1'] = np.concatenate( (positions[:,bonds[:,0]], np.broadcast_to(edges[:,0], (nphases,nedges,3))), axis=1 )
+    scene['cylinder_positions2'] = np.concatenate( (positions[:,bonds[:,1]], np.broadcast_to(edges[:,1], (nphases,nedges,3))), axis=1 )
+    return scene
+
+
+def scene_appearance(radii, colours, nbonds, cell_corners, cell_edges, settings):
+    """The colours and radii of the spheres and cylinders, which do not depend on the mode
+       radii and colours are the radius and rgba colour of each atom
+       settings provides the cell and bond colours and radii"""
+    ncorners = len(np.reshape(cell_corners, (-1,3)))
+    nedges = len(np.reshape(cell_edges, (-1,2,3)))
+    scene = {}
+    scene['sphere_colours'] = np.concatenate( (np.reshape(colours,(-1,4)), np.tile(settings['Cell colour'], (ncorners,1))) )
+    scene['sphere_radii'] = np.concatenate( (radii, np.full(ncorners, settings['Cell radius'])) )
+    scene['cylinder_colours'] = np.concatenate( (np.tile(settings['Bond colour'], (nbonds,1)), np.tile(settings['Cell colour'], (nedges,1))) )
+    scene['cylinder_radii'] = np.concatenate( (np.full(nbonds, settings['Bond radius']), np.full(nedges, settings['Cell radius'])) )
+    return scene
+
+
+def build_scene(positions, radii, colours, bonds, cell_corners, cell_edges, settings):
+    """Assemble the scene from the atom positions at each phase (nphases, natoms, 3)
+       radii and colours are the radius and rgba colour of each atom
+       bonds are pairs of atom indices
+       cell_corners and cell_edges are returned by UnitCell.getBoundingBox()
+       settings provides the cell and bond colours and radii"""
+    scene = scene_positions(positions, bonds, cell_corners, cell_edges)
+    scene.update( scene_appearance(radii, colours, len(bonds), cell_corners, cell_edges, settings) )
+    return scene
@@ -5,6 +5,9 @@ import string
 import re
 import numpy as np
 import os, sys
+import json
+import fnmatch
+import time
 from Python.Constants import amu, PI, avogadro_si, wavenumber, angstrom, isotope_masses, average_masses
 from Python.VaspOutputReader import VaspOutputReader
 from Python.CastepOutputReader import CastepOutputReader
@@ -12,10 +15,21 @@ from Python.GulpOutputReader import GulpOutputReader
 from Python.CrystalOutputReader import CrystalOutputReader
 from Python.AbinitOutputReader import AbinitOutputReader
 from Python.QEOutputReader import QEOutputReader
-from Python.PhonopyOutputReader import PhonopyOutputReader
+from Python.PhonopyOutputReader import PhonopyOutputReader, phonopy_dynamical_matrix_file, phonopy_dynamical_matrix_files
+from Python.ColumnStore import append_batch
+from Python.ReaderCache import read_cache, cached_entry, append_entry, file_signatures
+from Python.Utilities import write_time
 from multiprocessing import Pool, cpu_count
 import Python.Calculator as Calculator
 
+# The number of records written to a column store at a time
+column_store_batch_size = 100
+# The columns of a column store which have a different length for each record
+ragged_columns = [ 'element_names', 'fractional_coordinates' ]
+# The names of the output files of each program, used to search directories
+output_file_patterns = { 'abinit':'*.out', 'castep':'*.castep', 'crystal':'*.out', 'gulp':'*.gout',
+                         'phonopy':'OUTCAR', 'qe':'*.dynG', 'vasp':'OUTCAR' }
+
 def set_affinity_on_worker():
     """When a new worker process is created, the affinity is set to all CPUs"""
     #JK print("I'm the process %d, setting affinity to all CPUs." % os.getpid())
@@ -23,10 +37,12 @@ def set_affinity_on_worker():
     #os.system("taskset -p 0xff %d > /dev/null" % os.getpid())
 
 def read_a_file( calling_parameters):
-    name, program, qmprogram, debug = calling_parameters
+    name, program, qmprogram, scan_cache, debug = calling_parameters
     fulldirname = name
     head,tail = os.path.split(fulldirname)
     root,ext = os.path.splitext(tail)
+    # Files which may be read if they are present, as well as the files given to the reader
+    companions = []
     if program == "castep":
         names = [ name ]
         reader = CastepOutputReader( names )
@@ -54,6 +70,7 @@ def read_a_file( calling_parameters):
         # We want the dynG entry last rounding causes problems otherwise
         name4 = os.path.join(head,tail1)
         names = []
+        companions = [ name1, name2, name3, name4 ]
         for n in [ name1, name2, name3, name4 ]:
             if os.path.isfile(n):
                 if not n in names:
@@ -61,7 +78,7 @@ def read_a_file( calling_parameters):
         reader = QEOutputReader( names )
     elif program == "phonopy":
         # The order is important
-        pname1 = os.path.join(head,'qpoints.yaml')
+        pname1 = phonopy_dynamical_matrix_file(head)
         pname2 = os.path.join(head,'phonopy.yaml')
         # Only works for VASP at the moment
         vname1 = os.path.join(head,'OUTCAR')
@@ -70,6 +87,7 @@ def read_a_file( calling_parameters):
         vnames = [ vname1, vname2 ]
         pnames.extend(vnames)
         names = pnames
+        companions = [ os.path.join(head,n) for n in phonopy_dynamical_matrix_files ]
         # Which QM program was used by PHONOPY?
         if qmprogram == "castep":
             print("Error in qmreader",qmprogram)
@@ -101,9 +119,78 @@ def read_a_file( calling_parameters):
 
     print('  Analysing ',names, file=sys.stderr)
     reader.debug = debug
+    reader.scan_cache = scan_cache
+    # The files are signed before they are read, so a change while they are being read invalidates the cached result
+    signatures = file_signatures( sorted( set( reader.names + [ os.path.abspath(f) for f in companions ] ) ) )
     reader.read_output()
-    return name,reader.unit_cells[-1]
-        
+    return name,reader.unit_cells[-1],signatures
+
+def cell_record(name, cell):
+    """Assemble the typed contents of a unit cell for a column store"""
+    record = {}
+    record['name']                   = name
+    record['cell']                   = [ float(x) for x in cell.convert_unitcell_to_abc() ]
+    record['volume']                 = float(cell.volume)
+    record['lattice']                = np.array(cell.lattice).tolist()
+    record['element_names']          = list(cell.element_names)
+    record['fractional_coordinates'] = np.array(cell.fractional_coordinates).tolist()
+    return record
+
+def read_a_file_safely( calling_parameters):
+    """Call read_a_file and format the cif file in the worker, so that a failure in one file does not stop the others
+       Returns the name, the cif file contents, the column store record, the signatures of the files read
+       and an error message (None if there was no error)"""
+    name = calling_parameters[0]
+    try:
+        name,cell,signatures = read_a_file(calling_parameters)
+        cif = cell.cif_string(filename=name)
+        record = cell_record(name,cell)
+    except Exception as error:
+        return name,None,None,None,'{}: {}'.format(type(error).__name__, error)
+    return name,cif,record,signatures,None
+
+def find_output_files(directory, program):
+    """Return the output files of program in directory and all its sub-directories"""
+    pattern = output_file_patterns[program]
+    files = []
+    for root,dirs,names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(fnmatch.filter(names,pattern)):
+            files.append(os.path.join(root,name))
+    return files
+
+def cif_filename(name):
+    """The cif file written alongside an output file in directory mode"""
+    return os.path.splitext(name)[0]+'.cif'
+
+def write_result(name, cif, record, npzfile, directory_mode, batch):
+    """Write the cif file of name, to its own file in directory mode or to stdout
+       If npzfile is given the record is added to batch, which is written to the column store when it is full"""
+    if npzfile != '':
+        batch.append(record)
+        if len(batch) >= column_store_batch_size:
+            append_batch(npzfile, batch, ragged_columns)
+            del batch[:]
+    elif directory_mode:
+        with open(cif_filename(name),'w') as fd:
+            fd.write(cif)
+    else:
+        sys.stdout.write(cif)
+        sys.stdout.flush()
+
+def write_results(files, next_file, results_dictionary, npzfile, batch):
+    """Write out the cell of files[next_file] and of any following files whose cells are available
+       results_dictionary holds the (cif, record) results of each file, a file which could not be read has None
+       The results of a file are removed from results_dictionary once they have been written
+       Returns the index of the next file to be written"""
+    while next_file < len(files) and files[next_file] in results_dictionary:
+        name = files[next_file]
+        cif,record = results_dictionary.pop(name)
+        if cif is not None:
+            write_result(name, cif, record, npzfile, False, batch)
+        next_file += 1
+    return next_file
+
 def main(sys):
     # Start processing the directories
     if len(sys.argv) <= 1 :
@@ -111,6 +198,14 @@ def main(sys):
         print('  \"program\" must be one of \"abinit\", \"castep\", \"crystal\", \"gulp\"       ', file=sys.stderr)
         print('           \"phonopy\", \"qe\", \"vasp\"                                         ', file=sys.stderr)
         print('           If phonopy is used it must be followed by the QM package              ', file=sys.stderr)
+        print('  -dir directory  converts the output files of the program found in directory and ', file=sys.stderr)
+        print('           its sub-directories, the option can be repeated.  In directory mode     ', file=sys.stderr)
+        print('           each cif file is written next to its output file as it is completed    ', file=sys.stderr)
+        print('  -npz filename  the unit cells are written to a column store in filename instead', file=sys.stderr)
+        print('           of cif files on stdout, if filename exists the cells are appended     ', file=sys.stderr)
+        print('  -cache filename  keeps the cell of each file in filename, which can be shared  ', file=sys.stderr)
+        print('           with preader.  Files which have not changed are not read again        ', file=sys.stderr)
+        print('  -cpus n  the number of processes to use (default all the cpus)                 ', file=sys.stderr)
         print('  -debug   to switch on more debug information                                   ', file=sys.stderr)
         exit()
     
@@ -120,12 +215,28 @@ def main(sys):
     itoken = -1
     program = ''
     qmprogram = ''
+    npzfile = ''
+    cachefile = ''
+    directories = []
+    cpus = None
     debug = False
     while itoken < ntokens:
         itoken += 1
         token = tokens[itoken]
         if token == "-debug":
             debug = True
+        elif token == "-npz":
+            itoken += 1
+            npzfile = tokens[itoken]
+        elif token == "-cache":
+            itoken += 1
+            cachefile = tokens[itoken]
+        elif token == "-dir":
+            itoken += 1
+            directories.append(tokens[itoken])
+        elif token == "-cpus":
+            itoken += 1
+            cpus = int(tokens[itoken])
         elif token == "-program":
             itoken += 1
             program = tokens[itoken]
@@ -151,28 +262,81 @@ def main(sys):
     
     print('  Program is ',program,file=sys.stderr)
     
+    for directory in directories:
+        if not os.path.isdir(directory):
+            print('Error directory requested for analysis does not exist',directory,file=sys.stderr)
+            exit()
+        files.extend(find_output_files(directory,program))
+    directory_mode = len(directories) > 0
+
     for f in files:
         if not os.path.isfile(f):
             print('Error file requested for analysis does not exist',f,file=sys.stderr)
             exit()
-    
+
     #
-    # Create a pool of processors to handle reading the files
+    # Cells which are already in the cache do not need to be read
     #
-    p = Pool(initializer=set_affinity_on_worker)
-    # Create a tuple list of calling parameters 
+    files = sorted(set(files))
+    options = json.dumps( [ 'p2cif', program, qmprogram ] )
+    cache = {}
+    if cachefile != '':
+        cache = read_cache(cachefile)
+    results_dictionary = {}
+    for name in files:
+        entry = cached_entry(cache, name, options, required='cif')
+        if entry is not None:
+            results_dictionary[name] = (entry['cif'],entry['record'])
+    # Create a tuple list of calling parameters for those files which need to be read
     calling_parameters = []
-    files.sort()
     for name in files:
-        calling_parameters.append( (name, program, qmprogram, debug) )
-    # Calculate the results in parallel
-    results_map_object = p.map_async(read_a_file,calling_parameters)
-    results_map_object.wait()
-    results = results_map_object.get()
-    # Convert the results into a dictionary
-    results_dictionary = {}
-    for name,cell in results:
-        cell.write_cif(filename=name,file_=sys.stdout)
+        if not name in results_dictionary:
+            calling_parameters.append( (name, program, qmprogram, cachefile != '', debug) )
+    print('  Number of files to be read is ',len(calling_parameters),' ( ',len(results_dictionary),' cells taken from the cache )',file=sys.stderr)
+    #
+    # Create a pool of processors to handle reading the files
+    # In directory mode each cif file is written as soon as its file has been read,
+    # otherwise the cells are written in the order of the files as they become available
+    # results_dictionary holds the cells which cannot yet be written, because an earlier file has not finished
+    #
+    batch = []
+    next_file = 0
+    if directory_mode:
+        for name in files:
+            if name in results_dictionary:
+                cif,record = results_dictionary.pop(name)
+                write_result(name, cif, record, npzfile, directory_mode, batch)
+    else:
+        next_file = write_results(files, next_file, results_dictionary, npzfile, batch)
+    nfiles = len(calling_parameters)
+    if nfiles > 0:
+        cache_fd = None
+        if cachefile != '':
+            cache_fd = open(cachefile,'a')
+        p = Pool(cpus, initializer=set_affinity_on_worker)
+        start = time.time()
+        for ifile,(name,cif,record,signatures,error) in enumerate(p.imap_unordered(read_a_file_safely,calling_parameters)):
+            if error is not None:
+                print('  Error reading ',name,error,file=sys.stderr)
+            elif cache_fd is not None:
+                append_entry(cache_fd, name, options, signatures, cif=cif, record=record)
+            if directory_mode:
+                if error is None:
+                    write_result(name, cif, record, npzfile, directory_mode, batch)
+            else:
+                results_dictionary[name] = (cif,record)
+                next_file = write_results(files, next_file, results_dictionary, npzfile, batch)
+            elapsed = time.time() - start
+            remaining = elapsed * (nfiles - ifile - 1) / (ifile + 1)
+            print('  Completed {} of {} files, elapsed {}, remaining {}'.format(ifile+1, nfiles, write_time(elapsed), write_time(remaining)),file=sys.stderr)
+        # end for
+        p.close()
+        p.join()
+        if cache_fd is not None:
+            cache_fd.close()
+    # Write any remaining records to the column store
+    if npzfile != '' and len(batch) > 0:
+        append_batch(npzfile, batch, ragged_columns)
     #
     exit()
 # end of def main
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""Render snapshots and animations of the normal modes of a DFT or force field calculation without a display"""
+from __future__ import print_function
+import numpy as np
+import os, sys
+from multiprocessing import Pool
+from Python.Constants import covalent_radii, elemental_colours
+from Python.Utilities import get_reader
+from Python.SoftwareRenderer import SoftwareRenderer
+import Python.ViewerScene as ViewerScene
+import Python.TrajectoryWriter as TrajectoryWriter
+
+def set_affinity_on_worker():
+    """When a new worker process is created, the affinity is set to all CPUs"""
+    #os.system("taskset -p 0xff %d > /dev/null" % os.getpid())
+
+def render_mode( calling_parameters):
+    """Render a snapshot with arrows and/or an animation of one normal mode"""
+    mode, frequency, scene_parameters, outdir, root, formats, width, height = calling_parameters
+    xyz, displacements, radii, colours, bonds, cell_corners, cell_edges, centre, settings = scene_parameters
+    positions = ViewerScene.phase_positions(xyz, displacements, settings['Maximum displacement'], settings['Number of phase steps'])
+    scene = ViewerScene.build_scene(positions, radii, colours, bonds, cell_corners, cell_edges, settings)
+    # The image size is the largest distance of a sphere or a cylinder end from the centre, as in the viewer
+    centre_phase = len(positions) // 2
+    image_size = 0.0
+    for key in ('sphere_positions', 'cylinder_positions1', 'cylinder_positions2'):
+        if np.size(scene[key][centre_phase]) > 0:
+            vec = scene[key][centre_phase] - centre
+            image_size = max(image_size, np.sqrt(np.max(np.sum(vec*vec, axis=1))))
+    renderer = SoftwareRenderer(width, height, settings['Background colour'])
+    renderer.setView(centre, image_size)
+    written = []
+    basename = os.path.join(outdir, '{}_mode_{:03d}'.format(root, mode))
+    if 'png' in formats:
+        import imageio
+        renderer.clear()
+        renderer.drawScene(scene, centre_phase)
+        scale = ViewerScene.displacement_scale(displacements, settings['Maximum displacement'])
+        renderer.drawArrows(settings['Arrow colour'], settings['Arrow radius'], positions[centre_phase][0:len(xyz)], displacements, scale)
+        imageio.imwrite(basename+'.png', renderer.image())
+        written.append(basename+'.png')
+    movies = [ f for f in formats if f != 'png' ]
+    if len(movies) > 0:
+        from Python.MovieWriter import MovieWriter
+        writers = [ MovieWriter(basename+'.'+f) for f in movies ]
+        for phase in ViewerScene.animation_phases(len(positions)):
+            renderer.clear()
+            renderer.drawScene(scene, phase)
+            frame = renderer.image()
+            for writer in writers:
+                writer.append(frame)
+        for writer in writers:
+            writer.close()
+        written.extend( [ basename+'.'+f for f in movies ] )
+    return mode, frequency, written
+
+def main(sys):
+    # Start processing the command line
+    if len(sys.argv) <= 1 :
+        print('pdmodes -program program filename .....', file=sys.stderr)
+        print('  \"program\" must be one of \"abinit\", \"castep\", \"crystal\", \"gulp\"       ', file=sys.stderr)
+        print('           \"phonopy\", \"qe\", \"vasp\"                                         ', file=sys.stderr)
+        print('           If phonopy is used it must be followed by the QM package              ', file=sys.stderr)
+        print('  -mode n  render mode n, the option can be repeated, by default all modes       ', file=sys.stderr)
+        print('  -png     write a snapshot of each mode showing the displacements (default)     ', file=sys.stderr)
+        print('  -mp4     write an animation of each mode as an mp4 movie                       ', file=sys.stderr)
+        print('  -gif     write an animation of each mode as an animated gif                    ', file=sys.stderr)
+        print('  -xyz     write all the selected modes to a single extended xyz trajectory          ', file=sys.stderr)
+        print('  -dcd     write all the selected modes to a single dcd trajectory                   ', file=sys.stderr)
+        print('  -size width height  the size of the images in pixels (default 800 800)        ', file=sys.stderr)
+        print('  -outdir directory  the directory for the images (default the current directory)', file=sys.stderr)
+        print('  -cpus n  the number of processes to use (default all the cpus)                 ', file=sys.stderr)
+        print('  -debug   to switch on more debug information                                   ', file=sys.stderr)
+        exit()
+
+    tokens = sys.argv[1:]
+    ntokens = len(tokens)-1
+    itoken = -1
+    program = ''
+    qmprogram = ''
+    filename = ''
+    outdir = '.'
+    modes = []
+    formats = []
+    trajectories = []
+    width = 800
+    height = 800
+    cpus = None
+    debug = False
+    while itoken < ntokens:
+        itoken += 1
+        token = tokens[itoken]
+        if token == "-debug":
+            debug = True
+        elif token == "-mode":
+            itoken += 1
+            modes.append(int(tokens[itoken]))
+        elif token in [ "-png", "-mp4", "-gif" ]:
+            formats.append(token[1:])
+        elif token in [ "-xyz", "-dcd" ]:
+            trajectories.append(token[1:])
+        elif token == "-size":
+            itoken += 1
+            width = int(tokens[itoken])
+            itoken += 1
+            height = int(tokens[itoken])
+        elif token == "-outdir":
+            itoken += 1
+            outdir = tokens[itoken]
+        elif token == "-cpus":
+            itoken += 1
+            cpus = int(tokens[itoken])
+        elif token == "-program":
+            itoken += 1
+            program = tokens[itoken]
+            if program == 'phonopy':
+                itoken += 1
+                qmprogram = tokens[itoken]
+        else:
+            filename = token
+
+    if len(program) < 1:
+        print('Please use -program to define the package used to generate the output files',file=sys.stderr)
+        exit()
+
+    if not program in ['abinit','castep','crystal','gulp','qe','vasp','phonopy']:
+        print('Program is not recognised: ',program,file=sys.stderr)
+        exit()
+
+    if program == 'phonopy':
+        if not qmprogram in ['abinit','castep','crystal','gulp','qe','vasp']:
+            print('Phonopy QM program is not recognised: ',qmprogram,file=sys.stderr)
+            exit()
+        print('  QM program used by Phonopy is: ',qmprogram,file=sys.stderr)
+
+    if not os.path.isfile(filename):
+        print('Error file requested for analysis does not exist',filename,file=sys.stderr)
+        exit()
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    if len(formats) == 0 and len(trajectories) == 0:
+        formats = [ 'png' ]
+
+    print('  Program is ',program,file=sys.stderr)
+    reader = get_reader(program,[filename],qmprogram)
+    reader.debug = debug
+    reader.read_output()
+    frequencies = reader.frequencies
+    if len(modes) == 0:
+        modes = list(range(len(frequencies)))
+    for mode in modes:
+        if mode < 0 or mode >= len(frequencies):
+            print('Error the mode requested does not exist',mode,file=sys.stderr)
+            exit()
+    # Find the molecules in the cell and reorder the normal modes to match, as the analysis tab of pdgui does
+    cell = reader.unit_cells[-1]
+    cell.set_atomic_masses(reader.masses)
+    cell_of_molecules,nmols,old_order = cell.calculate_molecular_contents(1.1, 0.1, covalent_radii)
+    masses = np.array(cell_of_molecules.atomic_masses)
+    mass_weighted_normal_modes = np.asarray(reader.calculate_mass_weighted_normal_modes())
+    normal_modes = mass_weighted_normal_modes[:,old_order,:] / np.sqrt(masses)[np.newaxis,:,np.newaxis]
+    # The description of the scene which is common to all the modes
+    settings = ViewerScene.default_settings
+    xyz = np.array(cell_of_molecules.xyz_coordinates)
+    element_names = cell_of_molecules.element_names
+    radii = [ settings['Atom scaling']*covalent_radii[el] for el in element_names ]
+    colours = [ elemental_colours[el] for el in element_names ]
+    cell_corners,cell_edges = cell_of_molecules.getBoundingBox()
+    centre = np.array(cell_of_molecules.calculateCentreOfMass())
+    root = os.path.splitext(os.path.basename(filename))[0]
+    #
+    # The trajectories hold all the modes in one file, they are streamed from the normal modes
+    #
+    for trajectory in trajectories:
+        trajectory_file = os.path.join(outdir, '{}_modes.{}'.format(root, trajectory))
+        TrajectoryWriter.write_trajectory(trajectory_file, cell_of_molecules, normal_modes, modes, frequencies,
+                                          settings['Maximum displacement'], settings['Number of phase steps'])
+        print('  Trajectory of modes written to',trajectory_file,file=sys.stderr)
+    if len(formats) == 0:
+        exit()
+    #
+    # Create a pool of processors to render the modes
+    #
+    p = Pool(cpus, initializer=set_affinity_on_worker)
+    # Create a tuple list of calling parameters
+    calling_parameters = []
+    for mode in modes:
+        scene_parameters = (xyz, normal_modes[mode], radii, colours, cell_of_molecules.bonds, cell_corners, cell_edges, centre, settings)
+        calling_parameters.append( (mode, frequencies[mode], scene_parameters, outdir, root, formats, width, height) )
+    # Render the modes in parallel
+    results_map_object = p.map_async(render_mode,calling_parameters)
+    results_map_object.wait()
+    results = results_map_object.get()
+    for mode,frequency,written in results:
+        print('  Mode {:4d} {:10.2f} cm-1 '.format(mode,np.real(frequency)),' '.join(written),file=sys.stderr)
+    #
+    exit()
+# end of def main
+
+if __name__ == "__main__":
+    main(sys)
@@ -5,6 +5,8 @@ import string
 import re
 import numpy as np
 import os, sys
+import json
+import time
 from Python.Constants import amu, PI, avogadro_si, wavenumber, angstrom, isotope_masses, average_masses
 from Python.VaspOutputReader import VaspOutputReader
 from Python.CastepOutputReader import CastepOutputReader
@@ -12,10 +14,18 @@ from Python.GulpOutputReader import GulpOutputReader
 from Python.CrystalOutputReader import CrystalOutputReader
 from Python.AbinitOutputReader import AbinitOutputReader
 from Python.QEOutputReader import QEOutputReader
-from Python.PhonopyOutputReader import PhonopyOutputReader
+from Python.PhonopyOutputReader import PhonopyOutputReader, phonopy_dynamical_matrix_file, phonopy_dynamical_matrix_files
+from Python.ColumnStore import append_batch
+from Python.ReaderCache import read_cache, cached_entry, append_entry, file_signatures
+from Python.Utilities import write_time
 from multiprocessing import Pool, cpu_count
 import Python.Calculator as Calculator
 
+# The number of records written to a column store at a time
+column_store_batch_size = 100
+# The columns of a column store which have a different length for each record
+ragged_columns = [ 'frequencies', 'calculated_frequencies', 'intensities' ]
+
 def set_affinity_on_worker():
     """When a new worker process is created, the affinity is set to all CPUs"""
     #JK print("I'm the process %d, setting affinity to all CPUs." % os.getpid())
@@ -23,10 +33,12 @@ def set_affinity_on_worker():
     #os.system("taskset -p 0xff %d > /dev/null" % os.getpid())
 
 def read_a_file( calling_parameters):
-    name, eckart, neutral, mass_definition, mass_dictionary, global_no_calculation, program, hessian_symmetrisation, qmprogram, debug = calling_parameters
+    name, eckart, neutral, mass_definition, mass_dictionary, global_no_calculation, program, hessian_symmetrisation, qmprogram, frequency_window, symmetry_adapted, scan_cache, debug = calling_parameters
     fulldirname = name
     head,tail = os.path.split(fulldirname)
     root,ext = os.path.splitext(tail)
+    # Files which may be read if they are present, as well as the files given to the reader
+    companions = []
     if program == "castep":
         names = [ name ]
         reader = CastepOutputReader( names )
@@ -54,6 +66,7 @@ def read_a_file( calling_parameters):
         # We want the dynG entry last rounding causes problems otherwise
         name4 = os.path.join(head,tail1)
         names = []
+        companions = [ name1, name2, name3, name4 ]
         for n in [ name1, name2, name3, name4 ]:
             if os.path.isfile(n):
                 if not n in names:
@@ -61,7 +74,7 @@ def read_a_file( calling_parameters):
         reader = QEOutputReader( names )
     elif program == "phonopy":
         # The order is important
-        pname1 = os.path.join(head,'qpoints.yaml')
+        pname1 = phonopy_dynamical_matrix_file(head)
         pname2 = os.path.join(head,'phonopy.yaml')
         # Only works for VASP at the moment
         vname1 = os.path.join(head,'OUTCAR')
@@ -70,6 +83,7 @@ def read_a_file( calling_parameters):
         vnames = [ vname1, vname2 ]
         pnames.extend(vnames)
         names = pnames
+        companions = [ os.path.join(head,n) for n in phonopy_dynamical_matrix_files ]
         # Which QM program was used by PHONOPY?
         if qmprogram == "castep":
             print("Error in qmreader",qmprogram)
@@ -104,7 +118,12 @@ def read_a_file( calling_parameters):
     # Symmetry is applied before the file is read, it is an integral part of the hessian
     # Eckart and neutral are applied after the file has been read, this way the original frequencies are those before any calculations
     reader.debug = debug
+    reader.scan_cache = scan_cache
     reader.hessian_symmetrisation = hessian_symmetrisation
+    reader.frequency_window = frequency_window
+    reader.symmetry_adapted = symmetry_adapted
+    # The files are signed before they are read, so a change while they are being read invalidates the cached result
+    signatures = file_signatures( sorted( set( reader.names + [ os.path.abspath(f) for f in companions ] ) ) )
     reader.read_output()
     frequencies_cm1 = reader.frequencies
     frequencies = np.array(frequencies_cm1)
@@ -148,22 +167,13 @@ def read_a_file( calling_parameters):
         # Calculate eps0
         volume = reader.volume*angstrom*angstrom*angstrom
         #
-        # Calculate degenerate lists
+        # Group the degenerate modes and find the largest intensity in the group of each mode
         #
         degeneracy_threshold = 1.0E-8
         threshold_intensity = 1.0E-6
         threshold_frequency = 5.0
-        degenerate_lists = {}
-        mmax = len(modified_frequencies_cm1)
-        for m1 in range(len(modified_frequencies_cm1)):
-            degenerate_lists[m1] = []
-        for m1 in range(len(modified_frequencies_cm1)):
-            f1 = modified_frequencies[m1]
-            for m2 in range(m1+1,min(mmax,m1+3)):
-                f2 = modified_frequencies_cm1[m2]
-                if abs(f2-f1) < degeneracy_threshold:
-                    degenerate_lists[m1].append(m2)
-                    degenerate_lists[m2].append(m1)
+        order, starts, groups = Calculator.degenerate_groups(modified_frequencies_cm1, degeneracy_threshold)
+        degenerate_intensities = np.maximum.reduceat(np.array(intensities)[order], starts)[groups]
         #
         # Only modes with non-zero oscillator strengths contribute to the dielectric
         # so calculate those modes which we can safely ignore and store them in ignore_modes
@@ -173,11 +183,7 @@ def read_a_file( calling_parameters):
                 # ignore modes with a low oscillator strength
                 if intensity < threshold_intensity:
                     # If any of its degenerate modes have intensity then we shouldn't ignore it
-                    ignore = True
-                    for m in degenerate_lists[mode]:
-                        if intensities[m] > threshold_intensity:
-                            ignore = False
-                    if ignore:
+                    if degenerate_intensities[mode] <= threshold_intensity:
                         ignore_modes.append(mode)
                 # ignore modes with low real frequency
                 elif np.real(modified_frequencies_cm1[mode])/wavenumber < threshold_frequency:
@@ -263,6 +269,8 @@ def read_a_file( calling_parameters):
             option_string = option_string+' neutral'
         option_string = option_string+' hessian_symmetrisation='+hessian_symmetrisation
         option_string = option_string+' mass_definition='+mass_definition
+        if frequency_window is not None:
+            option_string = option_string+' window={}-{}'.format(frequency_window[0],frequency_window[1])
         header = fulldirname+','+option_string
         string = header + common_output 
         for f in modified_frequencies_cm1:
@@ -281,8 +289,67 @@ def read_a_file( calling_parameters):
             string = string + ',' + str(f*4225.6)
         results_string.append(string)
     # End if not no_calculation
-    return name,results_string
-        
+    # Assemble the typed results for a column store
+    record = {}
+    record['name']                         = fulldirname
+    record['electrons']                    = float(reader.electrons)
+    record['magnetization']                = float(reader.magnetization)
+    record['kpoints']                      = int(reader.kpoints)
+    record['kpoint_grid']                  = [ float(k) for k in reader.kpoint_grid ]
+    record['energy_cutoff_eV']             = float(reader.energy_cutoff)
+    record['final_free_energy_eV']         = float(reader.final_free_energy)
+    record['final_energy_without_entropy_eV'] = float(reader.final_energy_without_entropy)
+    record['pressure_GPa']                 = float(reader.pressure)
+    record['cell']                         = [ float(x) for x in [ a, b, c, alpha, beta, gamma ] ]
+    record['volume']                       = float(reader.volume)
+    record['eps0']                         = np.real(eps0).tolist()
+    record['epsinf']                       = np.real(epsinf).tolist()
+    record['elastic_constants_GPa']        = carray.astype(float).tolist()
+    record['calculated']                   = not no_calculation
+    record['frequencies']                  = [ float(f) for f in frequencies_cm1 ]
+    record['calculated_frequencies']       = []
+    record['intensities']                  = []
+    if not no_calculation:
+        record['calculated_frequencies']   = [ float(f) for f in modified_frequencies_cm1 ]
+        record['intensities']              = [ float(f) for f in intensities ]
+    return name,results_string,record,signatures
+
+def read_a_file_safely( calling_parameters):
+    """Call read_a_file, so that a failure in one file does not stop the processing of the others
+       Returns the name, the results strings, the results record, the signatures of the files read
+       and an error message (None if there was no error)"""
+    name = calling_parameters[0]
+    try:
+        name,results_string,record,signatures = read_a_file(calling_parameters)
+    except Exception as error:
+        return name,[],None,None,'{}: {}'.format(type(error).__name__, error)
+    return name,results_string,record,signatures,None
+
+def write_results(files, next_file, results_dictionary, npzfile, batch):
+    """Write out the results of files[next_file] and any following files whose results are available
+       results_dictionary holds the (strings, record) results of each file
+       The results of a file are removed from results_dictionary once they have been written
+       If npzfile is given the records are added to batch and written to the column store in batches,
+       otherwise the csv strings are printed
+       Returns the index of the next file to be written"""
+    while next_file < len(files) and files[next_file] in results_dictionary:
+        name = files[next_file]
+        strings,record = results_dictionary[name]
+        if npzfile == '':
+            for string in strings:
+                print(string)
+        elif record is not None:
+            batch.append(record)
+            if len(batch) >= column_store_batch_size:
+                append_batch(npzfile, batch, ragged_columns)
+                del batch[:]
+        next_file += 1
+        # The files are sorted so any repeated name follows immediately
+        if next_file >= len(files) or files[next_file] != name:
+            del results_dictionary[name]
+    sys.stdout.flush()
+    return next_file
+
 def main(sys):
     # Start processing the directories
     if len(sys.argv) <= 1 :
@@ -301,9 +368,19 @@ def main(sys):
         print('           \"crystal\" imposes Crystal14 symmetrisation                          ', file=sys.stderr)
         print('           \"symm\" symmetrises by averaging the hessian with its transpose      ', file=sys.stderr)
         print('           \"symm\" is the default                                               ', file=sys.stderr)
+        print('  -window fmin fmax only calculates the modes with frequencies (cm-1) in the range', file=sys.stderr)
+        print('           The default is to calculate all the modes                             ', file=sys.stderr)
+        print('  -symmetry block diagonalises the hessian using the symmetry of the cell         ', file=sys.stderr)
+        print('           If the symmetry cannot be used the full hessian is diagonalised       ', file=sys.stderr)
         print('  -nocalculation requests no calculations are performed                          ', file=sys.stderr)
         print('           A single line is output with results obtained by reading the output   ', file=sys.stderr)
         print('           any of -mass -masses -eckart -neutral or -crystal are ignored         ', file=sys.stderr)
+        print('  -cache filename  keeps the results of each file in filename                    ', file=sys.stderr)
+        print('           Files which have not changed since they were cached are not read again', file=sys.stderr)
+        print('           The line index of each file read is also kept in a hidden sidecar file,  ', file=sys.stderr)
+        print('           so it is read faster if it is read again with other options           ', file=sys.stderr)
+        print('  -npz filename  the results are written to a column store in filename instead of', file=sys.stderr)
+        print('           csv lines on stdout, if filename exists the results are appended      ', file=sys.stderr)
         print('  -debug   to switch on more debug information                                   ', file=sys.stderr)
         exit()
     
@@ -315,11 +392,15 @@ def main(sys):
     mass_definition = "average"
     mass_dictionary = {}
     global_no_calculation = False
+    frequency_window = None
+    symmetry_adapted = False
     tokens = sys.argv[1:]
     ntokens = len(tokens)-1
     itoken = -1
     program = ''
     qmprogram = ''
+    cachefile = ''
+    npzfile = ''
     debug = False
     while itoken < ntokens:
         itoken += 1
@@ -328,6 +409,12 @@ def main(sys):
             observables = True
         elif token == "-debug":
             debug = True
+        elif token == "-cache":
+            itoken += 1
+            cachefile = tokens[itoken]
+        elif token == "-npz":
+            itoken += 1
+            npzfile = tokens[itoken]
         elif token == "-eckart":
             eckart = True
         elif token == "-neutral":
@@ -356,6 +443,13 @@ def main(sys):
             itoken += 1
             mass = float(tokens[itoken])
             mass_dictionary[element] = mass
+        elif token == "-window":
+            fmin = float(tokens[itoken+1])
+            fmax = float(tokens[itoken+2])
+            itoken += 2
+            frequency_window = (fmin, fmax)
+        elif token == "-symmetry":
+            symmetry_adapted = True
         elif token == "-nocalculation":
             global_no_calculation = True
         elif token == "-program":
@@ -409,28 +503,65 @@ def main(sys):
         print('  Neutral is ',neutral,file=sys.stderr)
         print('  Mass definition is ',mass_definition,file=sys.stderr)
         print('  Hessian symmetrisation is ',hessian_symmetrisation,file=sys.stderr)
+        if frequency_window is not None:
+            print('  Frequency window is ',frequency_window,file=sys.stderr)
+        print('  Symmetry adapted diagonalisation is ',symmetry_adapted,file=sys.stderr)
     #
-    # Create a pool of processors to handle reading the files
+    # Results which are already in the cache do not need to be calculated
     #
-    p = Pool(initializer=set_affinity_on_worker)
-    # Create a tuple list of calling parameters 
-    calling_parameters = []
     files.sort()
-    for name in files:
-        calling_parameters.append( (name, eckart, neutral, mass_definition, mass_dictionary, global_no_calculation, program, hessian_symmetrisation, qmprogram, debug) )
-    # Calculate the results in parallel
-    results_map_object = p.map_async(read_a_file,calling_parameters)
-    results_map_object.wait()
-    results = results_map_object.get()
-    # Convert the results into a dictionary
+    options = json.dumps( [eckart, neutral, mass_definition, mass_dictionary, global_no_calculation, program, hessian_symmetrisation, qmprogram, frequency_window, symmetry_adapted] )
+    cache = {}
+    if cachefile != '':
+        cache = read_cache(cachefile)
     results_dictionary = {}
-    for name,strings in results:
-        results_dictionary[name] = strings
-    # Print out the results
-    print('directory,information,electrons,magnetization,kpnts,kpnt_1,kpnt_2,kpnt_3,energy_cutoff_eV,final_free_energy_eV,final_energy_without_entropy_eV,pressure_GPa,a_A,b_A,c_A,alpha,beta,gamma,volume,eps0_xx,eps0_yy,eps0_zz,eps0_xy,eps0_xz,eps0_yz,epsinf_xx,epsinf_yy,epsinf_zz,epsinf_xy,epsinf_xz,epsinf_yz, c11_gpa, c22_gpa, c33_gpa, c44_gpa, c55_gpa, c66_gpa, c12_gpa,  c13_gpa, c23_gpa,f1,f2,f3,f4,f5,f6....')
     for name in files:
-        for string in results_dictionary[name]:
-            print(string)
+        entry = cached_entry(cache, name, options)
+        if entry is not None:
+            results_dictionary[name] = (entry['results'],entry['record'])
+    # Create a tuple list of calling parameters for those files which need to be read
+    calling_parameters = []
+    for name in sorted(set(files)):
+        if not name in results_dictionary:
+            calling_parameters.append( (name, eckart, neutral, mass_definition, mass_dictionary, global_no_calculation, program, hessian_symmetrisation, qmprogram, frequency_window, symmetry_adapted, cachefile != '', debug) )
+    print('  Number of files to be read is ',len(calling_parameters),' ( ',len(results_dictionary),' results taken from the cache )',file=sys.stderr)
+    # Print out the header
+    if npzfile == '':
+        print('directory,information,electrons,magnetization,kpnts,kpnt_1,kpnt_2,kpnt_3,energy_cutoff_eV,final_free_energy_eV,final_energy_without_entropy_eV,pressure_GPa,a_A,b_A,c_A,alpha,beta,gamma,volume,eps0_xx,eps0_yy,eps0_zz,eps0_xy,eps0_xz,eps0_yz,epsinf_xx,epsinf_yy,epsinf_zz,epsinf_xy,epsinf_xz,epsinf_yz, c11_gpa, c22_gpa, c33_gpa, c44_gpa, c55_gpa, c66_gpa, c12_gpa,  c13_gpa, c23_gpa,f1,f2,f3,f4,f5,f6....')
+    #
+    # Create a pool of processors to handle reading the files
+    # The results are collected as each file finishes and written out in sorted order
+    # results_dictionary holds the results which cannot yet be written, because an earlier file has not finished
+    #
+    nfiles = len(calling_parameters)
+    batch = []
+    next_file = 0
+    next_file = write_results(files, next_file, results_dictionary, npzfile, batch)
+    if nfiles > 0:
+        cache_fd = None
+        if cachefile != '':
+            cache_fd = open(cachefile,'a')
+        p = Pool(initializer=set_affinity_on_worker)
+        start = time.time()
+        for ifile,(name,strings,record,signatures,error) in enumerate(p.imap_unordered(read_a_file_safely,calling_parameters)):
+            if error is not None:
+                print('  Error reading ',name,error,file=sys.stderr)
+            else:
+                if cache_fd is not None:
+                    append_entry(cache_fd, name, options, signatures, results=strings, record=record)
+            results_dictionary[name] = (strings,record)
+            next_file = write_results(files, next_file, results_dictionary, npzfile, batch)
+            elapsed = time.time() - start
+            remaining = elapsed * (nfiles - ifile - 1) / (ifile + 1)
+            print('  Completed {} of {} files, elapsed {}, remaining {}'.format(ifile+1, nfiles, write_time(elapsed), write_time(remaining)),file=sys.stderr)
+        # end for
+        p.close()
+        p.join()
+        if cache_fd is not None:
+            cache_fd.close()
+    # Write any remaining records to the column store
+    if npzfile != '' and len(batch) > 0:
+        append_batch(npzfile, batch, ragged_columns)
     #
     # Process the observables switch
     # ( for the time being this is commented out )